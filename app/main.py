@@ -1,15 +1,18 @@
 
+import asyncio
 import logging
 import os
 
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 import app.logging_config
 from app.service.message_queue_manager import initialize_message_queue_manager
-from app.routes import process_audio_endpoint, sse_endpoint, health_endpoint, cancel_endpoint, missing_content_endpoint
+from app.routes import process_audio_endpoint, sse_endpoint, health_endpoint, cancel_endpoint, missing_content_endpoint, ws_endpoint, cache_stats_endpoint, upload_endpoint
 from app.routes.cancel_endpoint import cleanup_task
+from app.service.audio_files_code import AudioFiles
+from app.service.transcription_state_code import TranscriptionStatesSingleton
+from app.service.upload_session_code import UploadSessions
 
 logger = logging.getLogger(__name__)
 
@@ -22,11 +25,19 @@ async def lifespan(app: FastAPI):
      os.makedirs("audio", exist_ok=True)
 
 
-     # The message queue is reinitialized when a post comes in. This call is perhaps redundant. However, it helps to not only ensure the message queue is initially created, but also the app state that is used for this process.
+     # The message queue is reinitialized when a post comes in. Creating it here means clients can subscribe (e.g. open the SSE connection) before the first post.
      app.state.message_queue_manager = await initialize_message_queue_manager()
 
+     # States cached by an earlier version of the service may use older keys.
+     await TranscriptionStatesSingleton.get_states().migrate_keys_async()
+
+     # Upload sessions expire, and the files of the sessions that ended with the last restart are removed, from now on.
+     app.state.upload_sessions = UploadSessions()
+     upload_cleanup = asyncio.create_task(app.state.upload_sessions.remove_expired_periodically())
+
      yield # Run the application
 
+     upload_cleanup.cancel()
      await cleanup_task(app.state.task, app.state.message_queue_manager)
 
 
@@ -41,7 +52,8 @@ app.add_middleware(
 )
 
 os.makedirs("audio", exist_ok=True)
-app.mount("/audio", StaticFiles(directory="audio"), name="audio")
+# mp3s of YouTube audio are made when they are first asked for. See AudioFiles.
+app.mount("/audio", AudioFiles(directory="audio"), name="audio")
 
 # Note: Only one client at a time. See the route.
 app.include_router(process_audio_endpoint.router, prefix="/api/v1", tags=["process_audio"])
@@ -49,6 +61,9 @@ app.include_router(sse_endpoint.router, prefix="/api/v1", tags=["sse"])
 app.include_router(health_endpoint.router, prefix="/api/v1", tags=["health"])
 app.include_router(cancel_endpoint.router, prefix="/api/v1", tags=["cancel"])
 app.include_router(missing_content_endpoint.router, prefix="/api/v1", tags=["missing_content"])
+app.include_router(ws_endpoint.router, prefix="/api/v1", tags=["ws"])
+app.include_router(upload_endpoint.router, prefix="/api/v1", tags=["uploads"])
+app.include_router(cache_stats_endpoint.router, prefix="/api/v1", tags=["admin"])
 
 if __name__ == "__main__":
     import uvicorn
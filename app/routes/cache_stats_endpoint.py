@@ -0,0 +1,14 @@
+from fastapi import APIRouter, Request
+import logging
+
+from app.service.transcription_state_code import TranscriptionStatesSingleton
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+@router.get("/admin/cache_stats")
+async def cache_stats(request: Request):
+    '''How full the state cache is and how often it is hit. Use it to size STATE_CACHE_SIZE_LIMIT and
+    STATE_MEMORY_CACHE_BYTES for the hit rate you want. The hit, miss and eviction counts are those of this process.'''
+    logger.debug(f"app.cache_stats: Request received: {request.method} {request.url}")
+    return await TranscriptionStatesSingleton.get_states().stats_async()
@@ -2,6 +2,10 @@ from fastapi import APIRouter
 from fastapi import Request
 import logging
 
+from app.service.metadata_probe_code import MetadataProbesSingleton
+from app.service.pcm_cache_code import PCMCacheSingleton
+from app.service.transcription_state_code import TranscriptionStatesSingleton
+
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
@@ -15,4 +19,10 @@ async def health_check(request: Request):
     logger.debug(f"app.health_check: Health check endpoint accessed. Request received: {method} {url} from {client_ip}")
     logger.debug(f"app.health_check: User-Agent: {user_agent}")
 
-    return {"status": "ok"}
\ No newline at end of file
+    # Queue depth and drops show whether the connected client keeps up with the messages of the current job.
+    message_queue = getattr(request.app.state, "message_queue_manager", None)
+    # The hit rate of the in-memory tier shows whether it is big enough for the states that are asked for again.
+    return {"status": "ok", "message_queue": message_queue.metrics() if message_queue else None,
+            "state_cache": TranscriptionStatesSingleton.get_states().metrics(),
+            "pcm_cache": PCMCacheSingleton.get_cache().metrics(),
+            "metadata_probes": MetadataProbesSingleton.get_probes().metrics()}
\ No newline at end of file
@@ -23,11 +23,15 @@ async def missing_content(
     ):
     queue = request.app.state.message_queue_manager
     logger.debug(f"Received missing content list: {missing_content}")
+    return await resend_missing_content(queue, missing_content.key, missing_content.missing_contents)
+
+async def resend_missing_content(queue: MessageQueueManager, key: str, missing_contents: List[str]) -> dict:
+    '''Sends the requested content of a cached state to the client again. Shared by the /missing_content endpoint and the in-band resend command of the websocket.'''
     try:
         states = TranscriptionStatesSingleton.get_states()
-        state = states.get_state(missing_content.key)
+        state = await states.get_state_async(key)
         if not state:
-            error_message = f"No state found for key: {missing_content.key}. Do not know what content is wanted."
+            error_message = f"No state found for key: {key}. Do not know what content is wanted."
             await send_sse_message(queue, "server-error", error_message)
             raise KeyError(error_message)
     except KeyError as e:
@@ -36,10 +40,10 @@ async def missing_content(
     try:
         # The missing_content prop is perhaps most useful for testing.
         # Understanding whether a missing_content event has been sent.
-        await send_sse_data_messages(queue, state, missing_content.missing_contents)
+        await send_sse_data_messages(queue, state, missing_contents)
     except MissingContentException as e:
         error_message = f"Error processing missing content. Error: {e}"
         await send_sse_message(queue, "server-error", error_message)
         return {"status": error_message}
 
-    return {"status": f"{', '.join(missing_content.missing_contents)}"}
\ No newline at end of file
+    return {"status": f"{', '.join(missing_contents)}"}
@@ -2,14 +2,17 @@ import asyncio
 import logging
 import os
 
-from fastapi import APIRouter, Request, Depends, File, Form, UploadFile, HTTPException
-from typing import Optional
+from fastapi import APIRouter, Request, HTTPException
+from typing import Dict, Optional, Tuple
 
 import app.logging_config
 
-from app.service.message_queue_manager import initialize_message_queue_manager
-from app.service.utils import send_sse_message, get_audio_directory
-from app.service.audio_processing_model import AudioProcessRequest
+from app.service.message_queue_manager import MessageQueueManager, initialize_message_queue_manager
+from app.service.utils import get_audio_directory, send_sse_message
+from app.service.audio_handler_code import AudioHandler
+from app.service.audio_processing_model import AUDIO_QUALITY_MAP, COMPUTE_TYPE_LIST, AudioProcessRequest
+from app.service.exceptions_code import UploadValidationException
+from app.service.multipart_upload_code import AudioFormParser, SavedUpload
 from app.service.process_audio import process_audio
 # from app.services.audio_processor import process_audio
 
@@ -20,83 +23,126 @@ logger = logging.getLogger(__name__)
 # Global lock for processing
 processing_lock = asyncio.Lock()
 
-@router.post("/process_audio")
-async def init_process_audio(request: Request,
-                             youtube_url: Optional[str] = Form(None),
-                             upload_file: UploadFile = File(None),
-                             audio_quality: str = Form("default"),
-                             compute_type: str = Form("int8"),
-                             chapter_chunk_time: int = Form(10)):
+def _form_field(name: str, schema: Dict) -> Dict:
+    return {**schema, "description": AudioProcessRequest.model_fields[name].description}
 
+# The form is read by AudioFormParser rather than by FastAPI, so FastAPI can't describe it. This is the form that
+# FastAPI's File and Form parameters used to describe, so the Swagger UI can still send it.
+PROCESS_AUDIO_FORM = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "youtube_url": _form_field("youtube_url", {"type": "string"}),
+                        "upload_file": {"type": "string", "format": "binary", "description": "The audio file to transcribe, if there is no youtube_url."},
+                        "audio_quality": _form_field("audio_quality", {"type": "string", "enum": list(AUDIO_QUALITY_MAP), "default": "default"}),
+                        "compute_type": _form_field("compute_type", {"type": "string", "enum": COMPUTE_TYPE_LIST, "default": "int8"}),
+                        "chapter_chunk_time": _form_field("chapter_chunk_time", {"type": "integer", "default": 10}),
+                        "allow_higher_quality": _form_field("allow_higher_quality", {"type": "boolean", "default": False}),
+                        "use_captions": _form_field("use_captions", {"type": "boolean", "default": False}),
+                    },
+                }
+            }
+        },
+    }
+}
+
+@router.post("/process_audio", openapi_extra=PROCESS_AUDIO_FORM)
+async def init_process_audio(request: Request):
+    '''The form has either a youtube_url or an upload_file, and optionally audio_quality ("default"), compute_type ("int8"),
+    chapter_chunk_time (10), allow_higher_quality (false) and use_captions (false). The form is read here rather than by
+    FastAPI so that an uploaded file is written to disk once, as it arrives. See AudioFormParser.'''
+    if processing_lock.locked():
+        raise HTTPException(status_code=409, detail="Another process is already running")
+    # Read the form before taking the lock. An upload can take a while to arrive, and the job that is running keeps
+    # the lock and its message queue until then. An uploaded file is saved while it is read.
+    error_message = None
+    try:
+        fields, saved_upload = await read_process_audio_form(request)
+    except UploadValidationException as e:
+        error_message = f"The uploaded audio file was rejected: {e}"
+    except OSError as e:
+        error_message = f"OS error occurred while saving uploaded audio file: {e}"
+    except Exception as e:
+        error_message = f"Unexpected error occurred while saving uploaded audio file: {e}"
     if processing_lock.locked():
         raise HTTPException(status_code=409, detail="Another process is already running")
 
     async with processing_lock:
-        return await init_process_audio(
-            youtube_url=youtube_url,
-            upload_file=upload_file,
-            audio_quality=audio_quality,
-            compute_type=compute_type,
-            chapter_chunk_time=chapter_chunk_time,
-            request = request,
-        )
+        queue_manager = await prepare_message_queue(request)
+        await send_sse_message(queue_manager,"status", "Received audio processing request.")
+        if error_message:
+            await send_sse_message(queue_manager, "server-error", error_message)
+            return {"status": error_message}
+        return await start_from_form(request, queue_manager, fields, saved_upload)
 
-async def init_process_audio(
-    youtube_url: Optional[str],
-    upload_file: UploadFile,
-    audio_quality: str,
-    compute_type: str,
-    chapter_chunk_time: int,
-    request: Request
-):
+async def start_from_form(request: Request, queue_manager: MessageQueueManager, fields: Dict[str, str], saved_upload: Optional[SavedUpload]):
     try:
-        # THIS IS THE STARTUP - PROBABLY QUEUE MAYBE STATE??? MAYBE STATES on app.state????
-        # The message queue needs to be refreshed each time we process a new audio file.
-        request.app.state.message_queue_manager = await initialize_message_queue_manager()
-        queue_manager = request.app.state.message_queue_manager
-        await send_sse_message(queue_manager,"status", "Received audio processing request.")
         # Instantiante and trigger Pydantic class validation.
         audio_input = AudioProcessRequest(
-            youtube_url=youtube_url,
-            audio_filename=upload_file.filename if upload_file else None,
-            audio_quality=audio_quality,
-            compute_type = compute_type,
-            chapter_chunk_time = chapter_chunk_time
+            youtube_url=fields.get("youtube_url") or None,
+            audio_filename=saved_upload.filename if saved_upload else None,
+            audio_quality=fields.get("audio_quality", "default"),
+            compute_type = fields.get("compute_type", "int8"),
+            chapter_chunk_time = fields.get("chapter_chunk_time", 10),
+            allow_higher_quality = fields.get("allow_higher_quality", False),
+            use_captions = fields.get("use_captions", False)
         )
         logger.info(f"Audio input: youtube_url: {audio_input.youtube_url}, audio_filename: {audio_input.audio_filename}, audio_quality: {audio_input.audio_quality}, compute_type: {audio_input.compute_type}, chapter_chunk_time: {audio_input.chapter_chunk_time}")
     except ValueError as e:
         await send_sse_message(queue_manager,"server-error", str(e))
         return {"status": f"Error reading in the audio input. Error: {e}"}
-    if upload_file:
-        # Save the audio file locally to use for transcription processing.
-        try:
-            save_local_audio_file(upload_file)
-        except OSError as e:
-            error_message = f"OS error occurred while saving uploaded audio file: {e}"
-            await send_sse_message(queue_manager,"server-error", error_message)
-            return {"status": error_message}
-        except Exception as e:
-            error_message = f"Unexpected error occurred while saving uploaded audio file: {e}"
-            await send_sse_message(queue_manager, "server-error", error_message)
-            return {"status": error_message}
-    request.app.state.task = asyncio.create_task(process_audio(queue_manager, audio_input))
+    if saved_upload:
+        audio_input.audio_hash = saved_upload.audio_hash
+    start_process_audio(request, queue_manager, audio_input)
     logger.debug("in init_process_audio. returning status.")
-    return {"status": "Transcription process has started."}
+    return started_response(audio_input)
+
+async def read_process_audio_form(request: Request) -> Tuple[Dict[str, str], Optional[SavedUpload]]:
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        return await AudioFormParser(content_type, request.stream()).parse()
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        # No file in this kind of form.
+        form = await request.form()
+        return {name: value for name, value in form.items() if isinstance(value, str)}, None
+    return {}, None
 
-def save_local_audio_file(upload_file: UploadFile):
+async def prepare_message_queue(request: Request) -> MessageQueueManager:
+    # THIS IS THE STARTUP - PROBABLY QUEUE MAYBE STATE??? MAYBE STATES on app.state????
+    # The message queue needs to be refreshed each time we process a new audio file.
+    # The same manager is reused so clients that are already subscribed (e.g. an open SSE connection) follow the new job.
+    queue_manager = getattr(request.app.state, "message_queue_manager", None)
+    if queue_manager is None:
+        queue_manager = await initialize_message_queue_manager()
+        request.app.state.message_queue_manager = queue_manager
+    else:
+        # processing_lock is only held while a job starts. A job that is still running would keep writing into the queue of the new one.
+        await stop_previous_job(request)
+        await queue_manager.initialize()
+    return queue_manager
+
+async def stop_previous_job(request: Request):
+    task = getattr(request.app.state, "task", None)
+    if task is None or task.done():
+        return
+    task.cancel()
     try:
-        audio_directory = get_audio_directory()
-        file_location = os.path.join(audio_directory, upload_file.filename)
-        if not os.path.exists(file_location):
-            with open(file_location, "wb+") as file_object:
-                file_object.write(upload_file.file.read())
-            logger.debug(f"File saved to {file_location}")
-        else:
-            logger.debug(f"File {file_location} already exists.")
-        return file_location
-    except OSError as e:
-        logger.error(f"Failed to save file {upload_file.filename} due to OS error: {e}")
-        raise
+        await task
+    except asyncio.CancelledError:
+        logger.info("Cancelled the job that was running to start a new one.")
     except Exception as e:
-        logger.error(f"An unexpected error occurred while saving file {upload_file.filename}: {e}")
-        raise
+        logger.warning(f"The job that was running ended with an error while it was cancelled: {e}")
+
+def start_process_audio(request: Request, queue_manager: MessageQueueManager, audio_input: AudioProcessRequest):
+    request.app.state.task = asyncio.create_task(process_audio(queue_manager, audio_input))
+
+def started_response(audio_input: AudioProcessRequest) -> Dict[str, str]:
+    response = {"status": "Transcription process has started."}
+    if audio_input.audio_hash:
+        # An upload is stored under the hash of its content, not its name, so the client is told where to find it.
+        response["audio_url"] = "/audio/" + os.path.basename(AudioHandler(audio_input).local_audio_filepath(get_audio_directory()))
+    return response
@@ -1,14 +1,21 @@
 import asyncio
 import json
 import logging
+import os
 
-from fastapi import APIRouter, Depends, Request
-from sse_starlette.sse import EventSourceResponse
+from fastapi import APIRouter, Request
+from sse_starlette.sse import EventSourceResponse, ServerSentEvent
+from starlette.requests import HTTPConnection
 
 import app.logging_config
 from app.routes.cancel_endpoint import cleanup_task
+from app.service.message_queue_manager import QueuedMessage, Subscription
 
 RETRY_TIMEOUT = 3000
+# Seconds between the keep-alive comments sent on an idle connection. Proxies tend to drop connections that are silent for too long.
+HEARTBEAT_INTERVAL = int(os.environ.get("SSE_HEARTBEAT_INTERVAL", 15))
+# An SSE comment line. Clients ignore it. Encoded once and shared by every connection.
+HEARTBEAT_MESSAGE = ServerSentEvent(comment="ping").encode()
 
 router = APIRouter()
 
@@ -18,64 +25,83 @@ logger = logging.getLogger(__name__)
 async def sse_endpoint(
     request: Request
 ):
-    return EventSourceResponse(event_generator(request))
+    # EventSourceResponse sends the heartbeats and watches for the client disconnecting. On a disconnect it
+    # cancels event_generator, so the generator doesn't need to wake up to check.
+    return EventSourceResponse(
+        event_generator(request),
+        ping=HEARTBEAT_INTERVAL,
+        ping_message_factory=lambda: HEARTBEAT_MESSAGE,
+    )
+
+
+def encode_sse(queued_message: QueuedMessage) -> bytes:
+    # Called once per message. Every SSE subscriber sends the same bytes.
+    return ServerSentEvent(
+        data=queued_message.data,
+        event=queued_message.event,
+        id=str(queued_message.seq),
+        retry=RETRY_TIMEOUT,
+    ).encode()
 
 
 async def event_generator(request: Request):
-    queue = request.app.state.message_queue_manager
-    message_id_counter = 0
-    while True:
-        if await request.is_disconnected():
-            break
-        # WAIT FOR MESSAGE
-        try:
-            # The wait for a message might be a long time. In this case, unblock so other pieces of the code can run.
-            message = await asyncio.wait_for(queue.get_message(), timeout=30)
-        except asyncio.TimeoutError:
-            logger.warning("Timeout waiting for message from queue")
-            continue
-        except asyncio.CancelledError:
-            logger.info("Task was cancelled")
-            await cleanup_task(request.app.state.task, request.app.state.message_queue_manager)
-            # Perform any necessary cleanup here
-            break  # Exit the loop on cancellation
-        except Exception as e:
-            logger.error(f"Unexpected error: {e}")
-            break  # Exit the loop on unexpected error
-        # PROCESS MESSAGE
-        try:
-            event = message['event']
-            data = message['data']
-            if event == "server-error" or (event == "data" and data == 'done'):
-                break
+    subscription = None
+    try:
+        # Each connection reads all of the job's messages, so several tabs or devices can watch the same transcription.
+        subscription = request.app.state.message_queue_manager.subscribe()
+        while True:
+            # WAIT FOR MESSAGE
+            try:
+                # An idle connection just waits here. Nothing runs for it until a message is published or the client goes away.
+                queued_message = await subscription.next()
+            except asyncio.CancelledError:
+                logger.info("Task was cancelled")
+                await cancel_job_if_last_subscriber(request, subscription)
+                raise
+            except Exception as e:
+                logger.error(f"Unexpected error: {e}")
+                break  # Exit the loop on unexpected error
+            # PROCESS MESSAGE
+            message = queued_message.message
+            try:
+                event = message['event']
+                data = message['data']
+                if event == "server-error" or (event == "data" and data == 'done'):
+                    break
+
+                # Just in case the message is an empty string or None.
+                if message:
+                    if logger.isEnabledFor(logging.DEBUG):
+                        info = data
+                        if event == "data":
+                        # FOR DEBUGGING START
+                            dict_data = json.loads(data)
+                            key = next(iter(dict_data), None)
+                            if key not in ['num_chapters', 'basename', 'key']:
+                                info = key
+                            if key == 'chapter':
+                                chapter_data = dict_data["chapter"]
+                                info = f"chapter{chapter_data['number']}{chapter_data['text'][:200]}"
+                        logger.debug(f"--> SENDING MESSAGE. Event: {event}, Info: {info}")
+                    # FOR DEBUGGING STOP
+                    yield queued_message.encoded("sse", encode_sse)
+            except asyncio.CancelledError:
+                logger.info("Task was cancelled")
+                await cancel_job_if_last_subscriber(request, subscription)
+                raise
+            except (KeyError, json.JSONDecodeError) as e:
+                logger.error(f"Key Error processing message: {message}", exc_info=e)
+            except Exception as e:
+                logger.error(f"Unexpected error processing message: {message}", exc_info=e)
+    except (AttributeError, ValueError) as e:
+        # There is no message queue (yet) to subscribe to.
+        logger.error(f"Could not subscribe to the message queue: {e}")
+    finally:
+        if subscription is not None:
+            subscription.close()
+
 
-            # Just in case the message is an empty string or None.
-            if message:
-                info = data
-                if event == "data":
-                # FOR DEBUGGING START
-                    dict_data = json.loads(data)
-                    key = next(iter(dict_data), None)
-                    if key not in ['num_chapters', 'basename', 'key']:
-                        info = key
-                    if key == 'chapter':
-                        chapter_data = dict_data["chapter"]
-                        info = f"chapter{chapter_data['number']}{chapter_data['text'][:200]}"
-                logger.debug(f"--> SENDING MESSAGE. Event: {event}, Info: {info}")
-                # FOR DEBUGGING STOP
-                message_id_counter += 1
-                yield {
-                    "event": event,
-                    "id": str(message_id_counter),
-                    "retry": RETRY_TIMEOUT,
-                    "data": data
-                }
-        except asyncio.CancelledError:
-            logger.info("Task was cancelled")
-            await cleanup_task(request.app.state.task, request.app.state.message_queue_manager)
-            # Perform any necessary cleanup here
-            break  # Exit the loop on cancellation
-        except (KeyError, json.JSONDecodeError) as e:
-            logger.error(f"Key Error processing message: {message}", exc_info=e)
-        except Exception as e:
-            logger.error(f"Unexpected error processing message: {message}", exc_info=e)
+async def cancel_job_if_last_subscriber(connection: HTTPConnection, subscription: Subscription):
+    # Other clients (SSE or websocket) may still be watching the job. Only stop it when the last one goes away.
+    if subscription.manager.metrics()['subscribers'] <= 1:
+        await cleanup_task(connection.app.state.task, connection.app.state.message_queue_manager)
@@ -0,0 +1,93 @@
+import logging
+
+from fastapi import APIRouter, HTTPException, Request
+from pydantic import BaseModel
+
+import app.logging_config
+from app.routes.process_audio_endpoint import prepare_message_queue, processing_lock, start_process_audio, started_response
+from app.service.audio_processing_model import AudioProcessRequest
+from app.service.exceptions_code import UploadValidationException
+from app.service.upload_session_code import UploadSession, UploadSessions
+from app.service.utils import send_sse_message
+
+router = APIRouter()
+
+logger = logging.getLogger(__name__)
+
+class CreateUpload(BaseModel):
+    filename: str
+    size: int
+
+class FinalizeUpload(BaseModel):
+    audio_quality: str = "default"
+    compute_type: str = "int8"
+    chapter_chunk_time: int = 10
+    allow_higher_quality: bool = False
+
+def get_upload_sessions(request: Request) -> UploadSessions:
+    if getattr(request.app.state, "upload_sessions", None) is None:
+        request.app.state.upload_sessions = UploadSessions()
+    return request.app.state.upload_sessions
+
+def get_session(request: Request, upload_id: str) -> UploadSession:
+    session = get_upload_sessions(request).get(upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"No upload with id {upload_id}.")
+    return session
+
+@router.post("/uploads")
+async def create_upload(request: Request, create_upload: CreateUpload):
+    '''Starts a resumable upload. The client then PUTs the content in chunks, in any order, and can ask which byte
+    ranges have arrived after a dropped connection.'''
+    try:
+        session = await get_upload_sessions(request).create(create_upload.filename, create_upload.size)
+    except UploadValidationException as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return session.to_dict()
+
+@router.put("/uploads/{upload_id}")
+async def put_upload_chunk(request: Request, upload_id: str, offset: int):
+    '''The body is written at offset. If the connection drops, the bytes that arrived are kept.'''
+    session = get_session(request, upload_id)
+    try:
+        await session.write_chunk(offset, request.stream())
+    except UploadValidationException as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return session.to_dict()
+
+@router.get("/uploads/{upload_id}")
+async def get_upload(request: Request, upload_id: str):
+    return get_session(request, upload_id).to_dict()
+
+@router.delete("/uploads/{upload_id}")
+async def delete_upload(request: Request, upload_id: str):
+    get_session(request, upload_id)
+    get_upload_sessions(request).discard(upload_id)
+    return {"status": f"Upload {upload_id} deleted."}
+
+@router.post("/uploads/{upload_id}/finalize")
+async def finalize_upload(request: Request, upload_id: str, finalize_upload: FinalizeUpload):
+    '''Turns a complete upload into a transcription job, the same as a POST to /process_audio with the file.'''
+    session = get_session(request, upload_id)
+    if not session.is_complete:
+        raise HTTPException(status_code=409, detail={"message": "The upload is incomplete.", **session.to_dict()})
+    if processing_lock.locked():
+        raise HTTPException(status_code=409, detail="Another process is already running")
+    async with processing_lock:
+        queue_manager = await prepare_message_queue(request)
+        await send_sse_message(queue_manager, "status", "Received audio processing request.")
+        try:
+            audio_input = AudioProcessRequest(audio_filename=session.filename, **finalize_upload.model_dump())
+        except ValueError as e:
+            await send_sse_message(queue_manager, "server-error", str(e))
+            return {"status": f"Error reading in the audio input. Error: {e}"}
+        try:
+            _, audio_input.audio_hash = await session.finalize()
+        except UploadValidationException as e:
+            error_message = f"The uploaded audio file was rejected: {e}"
+            await send_sse_message(queue_manager, "server-error", error_message)
+            get_upload_sessions(request).discard(upload_id)
+            return {"status": error_message}
+        get_upload_sessions(request).discard(upload_id)
+        start_process_audio(request, queue_manager, audio_input)
+        return started_response(audio_input)
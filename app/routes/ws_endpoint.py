@@ -0,0 +1,166 @@
+import asyncio
+from collections import OrderedDict
+import json
+import logging
+from typing import Dict, Optional, Union
+
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from starlette.websockets import WebSocketState
+
+import app.logging_config
+from app.routes.cancel_endpoint import cleanup_task
+from app.routes.missing_content_endpoint import resend_missing_content
+from app.routes.sse_endpoint import cancel_job_if_last_subscriber
+from app.service.message_queue_manager import MessageQueueManager, QueuedMessage, Subscription
+from app.service.utils import format_ws
+
+# The number of sent frames kept until the client acks them. The client can ask for these to be resent in-band.
+UNACKED_BUFFER_SIZE = 64
+
+router = APIRouter()
+
+logger = logging.getLogger(__name__)
+
+@router.websocket("/ws")
+async def ws_endpoint(websocket: WebSocket):
+    '''Carries the same events as the /sse endpoint over one websocket. The client sends its commands
+    (ack, cancel, resend) over the same connection instead of calling the /cancel and /missing_content endpoints.'''
+    await websocket.accept()
+    subscription = None
+    pending = set()
+    try:
+        subscription = websocket.app.state.message_queue_manager.subscribe()
+        session = WebSocketSession(websocket, subscription)
+        pending = {asyncio.create_task(session.send_messages()), asyncio.create_task(session.receive_commands())}
+        # Either side ending ends the session (the job finished or failed, the client went away or cancelled).
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if isinstance(task.exception(), WebSocketDisconnect):
+                # The client went away, the same as an SSE client that disconnects.
+                await cancel_job_if_last_subscriber(websocket, subscription)
+            elif task.exception():
+                logger.error("Websocket session ended with an error.", exc_info=task.exception())
+    except (AttributeError, ValueError) as e:
+        # There is no message queue (yet) to subscribe to.
+        logger.error(f"Could not subscribe to the message queue: {e}")
+        await websocket.send_text(format_ws({"event": "server-error", "data": "The service is not ready. Try again."}, None))
+    finally:
+        # Unsubscribed before anything is awaited, which a cancelled session may not get to do.
+        if subscription is not None:
+            subscription.close()
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if websocket.client_state == WebSocketState.CONNECTED:
+            await websocket.close()
+
+
+def encode_ws(queued_message: QueuedMessage) -> Union[str, bytes]:
+    # Called once per message. Every websocket subscriber sends the same frame.
+    return format_ws(queued_message.message, queued_message.seq)
+
+
+class WebSocketSession:
+    def __init__(self, websocket: WebSocket, subscription: Subscription):
+        self.websocket = websocket
+        self.subscription = subscription
+        # message id -> encoded frame, oldest first.
+        self.unacked: Dict[int, Union[str, bytes]] = OrderedDict()
+
+    @property
+    def queue(self) -> MessageQueueManager:
+        return self.subscription.manager
+
+    async def send_messages(self):
+        while True:
+            try:
+                queued_message = await self.subscription.next()
+            except ValueError as e:
+                # The queue was cleaned up (e.g. the task was cancelled).
+                logger.info(f"Message queue is gone. {e}")
+                break
+            await self.send_queued(queued_message)
+            if queued_message.event == "server-error" or (queued_message.event == "data" and queued_message.data == 'done'):
+                break
+
+    async def send_queued(self, queued_message: QueuedMessage):
+        frame = queued_message.encoded("ws", encode_ws)
+        self.unacked[queued_message.seq] = frame
+        if len(self.unacked) > UNACKED_BUFFER_SIZE:
+            self.unacked.popitem(last=False)
+        logger.debug(f"--> SENDING WS MESSAGE. Event: {queued_message.event}, id: {queued_message.seq}")
+        await self._send_frame(frame)
+
+    async def send(self, message: dict):
+        '''Send a reply that is only meant for this client. It doesn't go through the queue, so it has no id.'''
+        await self._send_frame(format_ws(message, None))
+
+    async def receive_commands(self):
+        while True:
+            message = await self.websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+            if message.get("text") is None:
+                # receive_json() would fail on a binary frame and end the session.
+                await self.send({"event": "server-error", "data": "Commands are sent as JSON in text frames, not binary frames."})
+                continue
+            try:
+                command = json.loads(message["text"])
+            except json.JSONDecodeError as e:
+                await self.send({"event": "status", "data": f"Could not parse the command. Error: {e}"})
+                continue
+            if not isinstance(command, dict):
+                await self.send({"event": "status", "data": "A command must be a JSON object."})
+                continue
+            if await self.handle_command(command) is False:
+                break
+
+    async def handle_command(self, command: dict) -> bool:
+        '''Returns False when the session should end.'''
+        name = command.get("command")
+        logger.debug(f"<-- RECEIVED WS COMMAND: {command}")
+        if name == "ack":
+            # The client has everything up to and including this id.
+            acked_id = await self.message_id(command, "id")
+            if acked_id is None:
+                return True
+            while self.unacked and next(iter(self.unacked)) <= acked_id:
+                self.unacked.popitem(last=False)
+        elif name == "cancel":
+            app_state = self.websocket.app.state
+            await cleanup_task(app_state.task, app_state.message_queue_manager)
+            await self.send({"event": "status", "data": "Task cancelled successfully."})
+            return False
+        elif name == "resend":
+            if "missing_contents" in command:
+                # The same as a POST to /missing_content. The content is queued and arrives through send_messages().
+                result = await resend_missing_content(self.queue, command.get("key", ""), command["missing_contents"])
+                logger.debug(f"In-band resend: {result['status']}")
+            else:
+                # Resend the frames that have not been acked since the given id.
+                since_id = await self.message_id(command, "since_id")
+                if since_id is None:
+                    return True
+                for message_id, frame in list(self.unacked.items()):
+                    if message_id > since_id:
+                        await self._send_frame(frame)
+        else:
+            await self.send({"event": "status", "data": f"Unknown command: {name}"})
+        return True
+
+    async def message_id(self, command: dict, name: str) -> Optional[int]:
+        '''The message id in command[name] (0 if it isn't there). A bad id is answered with an error frame, and is None.'''
+        value = command.get(name, 0)
+        # bool is an int, but not an id.
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.strip().isdigit():
+            return int(value)
+        await self.send({"event": "status", "data": f"The {name} of a {command.get('command')} command must be a message id, not {value!r}."})
+        return None
+
+    async def _send_frame(self, frame: Union[str, bytes]):
+        if isinstance(frame, bytes):
+            await self.websocket.send_bytes(frame)
+        else:
+            await self.websocket.send_text(frame)
@@ -0,0 +1,108 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###########################################################################################
+# Author: Margaret Johnson
+# Copyright (c) 2024 Margaret Johnson
+###########################################################################################
+import asyncio
+import logging
+import os
+import tempfile
+from typing import Dict, Optional
+
+import av
+from fastapi.staticfiles import StaticFiles
+from starlette.exceptions import HTTPException
+from starlette.responses import Response
+from starlette.types import Scope
+
+import app.logging_config
+from app.service.audio_processing_model import SUPPORTED_AUDIO_FORMATS
+
+# Create a logger instance for this module
+logger = logging.getLogger(__name__)
+
+# The mp3 made for listening. These are the settings YouTube downloads used to be converted with.
+MP3_SAMPLE_RATE = 44100
+MP3_BIT_RATE = 96000
+# An mp3 can be made from these. yt-dlp saves YouTube's opus audio as .webm.
+SOURCE_AUDIO_FORMATS = (SUPPORTED_AUDIO_FORMATS | {".webm"}) - {".mp3"}
+
+
+def make_mp3(source_path: str, mp3_path: str) -> None:
+    '''Encodes the audio of source_path as a mono mp3. The mp3 is written to a temporary file and renamed, so a partly
+    written mp3 is never served.'''
+    directory = os.path.dirname(mp3_path) or "."
+    fd, temp_location = tempfile.mkstemp(dir=directory, suffix=".mp3.part")
+    os.close(fd)
+    try:
+        with av.open(source_path, mode="r", metadata_errors="ignore") as source, av.open(temp_location, mode="w", format="mp3") as target:
+            stream = target.add_stream("libmp3lame", rate=MP3_SAMPLE_RATE)
+            stream.bit_rate = MP3_BIT_RATE
+            stream.layout = "mono"
+            resampler = av.audio.resampler.AudioResampler(format=stream.format.name, layout="mono", rate=MP3_SAMPLE_RATE)
+            for frame in source.decode(audio=0):
+                frame.pts = None
+                for resampled in resampler.resample(frame):
+                    target.mux(stream.encode(resampled))
+            for resampled in resampler.resample(None):
+                target.mux(stream.encode(resampled))
+            # Flush the encoder.
+            target.mux(stream.encode(None))
+        os.replace(temp_location, mp3_path)
+    except BaseException:
+        if os.path.exists(temp_location):
+            os.remove(temp_location)
+        raise
+
+
+class AudioFiles(StaticFiles):
+    '''The /audio mount. YouTube audio is kept in the format it was downloaded in (opus or m4a), which is what Whisper
+    reads. The first request for <name>.mp3 makes the mp3 from the downloaded file with the same name, and it is served
+    as a static file from then on.'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        try:
+            return await super().get_response(path, scope)
+        except HTTPException as e:
+            if e.status_code != 404 or os.path.splitext(path)[1].lower() != ".mp3":
+                raise
+        mp3_path = os.path.join(self.directory, path)
+        source_path = self.find_source(mp3_path)
+        if source_path is None:
+            raise HTTPException(status_code=404)
+        lock = self._locks.setdefault(mp3_path, asyncio.Lock())
+        async with lock:
+            # Another request may have made it while this one waited.
+            if not os.path.exists(mp3_path):
+                logger.info(f"Making {mp3_path} from {source_path}.")
+                await asyncio.to_thread(make_mp3, source_path, mp3_path)
+        self._locks.pop(mp3_path, None)
+        return await super().get_response(path, scope)
+
+    def find_source(self, mp3_path: str) -> Optional[str]:
+        base = os.path.splitext(mp3_path)[0]
+        # Only a file inside the mount is used.
+        if os.path.commonpath([os.path.realpath(base), os.path.realpath(self.directory)]) != os.path.realpath(self.directory):
+            return None
+        for extension in sorted(SOURCE_AUDIO_FORMATS):
+            if os.path.isfile(base + extension):
+                return base + extension
+        return None
@@ -37,12 +37,21 @@ class AudioHandler():
         self.audio_input = audio_input
 
     async def extract(self, queue: MessageQueueManager, audio_directory: str) -> Tuple[Dict, List, str]:
-        local_audio_filepath = os.path.join(audio_directory, self.audio_input.audio_filename)
+        local_audio_filepath = self.local_audio_filepath(audio_directory)
         logger.info(f"--> Starting extraction of audio attributes from {self.audio_input.audio_filename}")
         audio_info_dict, chapter_dicts = self._build_audio_info_dict_and_chapter_dicts(local_audio_filepath)
+        # The title comes from the name the audio was uploaded with, not the content addressed name it is stored under.
+        audio_info_dict["title"] = os.path.splitext(os.path.basename(self.audio_input.audio_filename))[0]
         logger.info(f"--> Finished extraction of audio attributes.")
         return audio_info_dict, chapter_dicts, local_audio_filepath
 
+    def local_audio_filepath(self, audio_directory: str) -> str:
+        if self.audio_input.audio_hash:
+            # Uploads are saved as <hash><extension>. See AudioUploadWriter.
+            extension = os.path.splitext(self.audio_input.audio_filename)[1].lower()
+            return os.path.join(audio_directory, self.audio_input.audio_hash + extension)
+        return os.path.join(audio_directory, self.audio_input.audio_filename)
+
     def _build_audio_info_dict_and_chapter_dicts(self, audio_filepath: str) -> Tuple[Dict, List]:
         # Using the TinyTag library to extract metadata from the audio file.
         audio_info_dict = None
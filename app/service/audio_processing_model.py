@@ -44,15 +44,39 @@ AUDIO_QUALITY_MAP = {
     "medium": "Systran/faster-distil-whisper-medium.en",
     "large": "Systran/faster-distil-whisper-large-v3"
 }
+# Matches the URL forms YouTube uses for a video: youtu.be/ID, youtube.com/watch?v=ID&t=30, /embed/ID, /v/ID, /shorts/ID, /live/ID
+# with or without www. or m. The video_id group is the 11 character video ID.
+YOUTUBE_URL_REGEX = re.compile(
+    r'^(https?://)?(www\.|m\.)?(youtube|youtu|youtube-nocookie)\.(com|be)/'
+    r'((watch\?v=)|(embed/)|(v/)|(shorts/)|(live/)|(.+[?&]v=))?(?P<video_id>[^&=%\?/]{11})')
+# The AUDIO_QUALITY_MAP models from the lowest to the highest quality.
+QUALITY_LADDER = ["tiny", "small", "medium", "large"]
+
+def quality_rank(audio_quality: str) -> int:
+    '''The position of an audio_quality (a QUALITY_LADDER name or the model it maps to) on the QUALITY_LADDER. -1 if it isn't on it.'''
+    for rank, name in enumerate(QUALITY_LADDER):
+        if audio_quality in (name, AUDIO_QUALITY_MAP[name]):
+            return rank
+    return -1
+
+# Whisper decoding options by profile name. The profile is part of the identity of cached segments, since other options
+# produce other segments.
+DECODING_PROFILES = {
+    "default": {"beam_size": 5},
+}
 # see https://opennmt.net/CTranslate2/quantization.html
 COMPUTE_TYPE_LIST = ["int8", "float16", "float32", "int8_float32", "int8_float16", "int8_bfloat16", "int16", "bfloat16"]
 
 class AudioProcessRequest(BaseModel):
     youtube_url: Optional[str] = Field(None, description="YouTube URL to download audio from. Input requires either a YouTube URL or mp3 file.")
     audio_filename: Optional[str] = Field(None, description="The basename of the audio file sent through upload_file.")
+    audio_hash: Optional[str] = Field(None, description="SHA-256 of the uploaded audio file's content. Identifies the audio in the state cache. The audio_filename is only metadata.")
     audio_quality: str = Field(default="default", description="Audio quality setting for processing.")
     compute_type: str = Field(default="int8", description="Compute type for processing.")
     chapter_chunk_time: int = Field(default=10, description="Time chunk in minutes for dividing audio into chapters.")
+    decoding_profile: str = Field(default="default", description="Name of the Whisper decoding options in DECODING_PROFILES.")
+    allow_higher_quality: bool = Field(default=False, description="Accept a cached transcript made with a model of equal or higher quality (see QUALITY_LADDER) than audio_quality.")
+    use_captions: bool = Field(default=False, description="Make the transcript from the captions the uploader added to the YouTube video, if it has them, instead of transcribing the audio.")
 
 
     @model_validator(mode='before')
@@ -111,9 +135,18 @@ class AudioProcessRequest(BaseModel):
             return compute_type
         return v
 
+    @field_validator('decoding_profile')
+    def is_valid_decoding_profile(cls, v):
+        if v not in DECODING_PROFILES:
+            logger.debug(f"{v} is not a valid decoding profile. Defaulting to default.")
+            return "default"
+        return v
+
     @staticmethod
     def is_valid_youtube_url(url: str) -> bool:
-        youtube_regex = re.compile(
-            r'^(https?://)?(www\.)?(youtube|youtu|youtube-nocookie)\.(com|be)/'
-            r'((watch\?v=)|(embed/)|(v/)|(.+\?v=))?([^&=%\?]{11})')
-        return youtube_regex.match(url) is not None
+        return AudioProcessRequest.youtube_video_id(url) is not None
+
+    @staticmethod
+    def youtube_video_id(url: str) -> Optional[str]:
+        match = YOUTUBE_URL_REGEX.match(url.strip())
+        return match.group('video_id') if match else None
@@ -0,0 +1,86 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###########################################################################################
+# Author: Margaret Johnson
+# Copyright (c) 2024 Margaret Johnson
+###########################################################################################
+import html
+import logging
+import os
+import re
+from typing import Dict, List, NamedTuple, Optional
+
+import app.logging_config
+
+# Create a logger instance for this module
+logger = logging.getLogger(__name__)
+
+# The transcription_model of a transcript made from a video's own captions.
+CAPTIONS_MODEL = "captions"
+# The caption languages to use, most wanted first. "en" also matches en-US, en-GB... The models are English only.
+CAPTION_LANGUAGES = [language.strip() for language in os.environ.get("CAPTION_LANGUAGES", "en").split(",") if language.strip()]
+
+CUE_TIMING_REGEX = re.compile(r'^(?P<start>(\d+:)?\d{2}:\d{2}[.,]\d{3})\s+-->\s+(?P<end>(\d+:)?\d{2}:\d{2}[.,]\d{3})')
+CUE_TAG_REGEX = re.compile(r'<[^>]*>')
+
+
+class Cue(NamedTuple):
+    # The same fields as a TranscriptSegment, so the chapters are made from cues the way they are from Whisper's output.
+    start: float
+    end: float
+    text: str
+
+
+def pick_caption_track(info_dict: Dict, languages: List[str] = CAPTION_LANGUAGES) -> Optional[Dict]:
+    '''The WebVTT track of the captions the uploader added, in the first of the languages there is one for. YouTube's
+    automatic captions ('automatic_captions') are not used. They are no better than Whisper's.'''
+    tracks = info_dict.get('subtitles') or {}
+    for wanted in languages:
+        for language, formats in tracks.items():
+            if language != wanted and not language.startswith(wanted + "-"):
+                continue
+            for caption_format in formats or []:
+                if caption_format.get('ext') == 'vtt' and caption_format.get('url'):
+                    return caption_format
+    return None
+
+
+def parse_timestamp(timestamp: str) -> float:
+    parts = timestamp.replace(',', '.').split(':')
+    seconds = float(parts[-1]) + 60 * int(parts[-2])
+    if len(parts) == 3:
+        seconds += 3600 * int(parts[0])
+    return seconds
+
+
+def parse_vtt(vtt: str) -> List[Cue]:
+    '''The cues of a WebVTT file, with the styling tags taken out of the text. Blocks without a timing line (the header,
+    NOTE and STYLE blocks) are skipped.'''
+    cues = []
+    for block in re.split(r'\n[ \t]*\n', vtt.replace('\r\n', '\n')):
+        lines = block.strip().split('\n')
+        for index, line in enumerate(lines):
+            match = CUE_TIMING_REGEX.match(line.strip())
+            if match is None:
+                continue
+            text = ' '.join(html.unescape(CUE_TAG_REGEX.sub('', text_line)).strip() for text_line in lines[index + 1:])
+            text = ' '.join(text.split())
+            if text:
+                # Whisper's segments start with a space. The chapters are joined from them as they are.
+                cues.append(Cue(parse_timestamp(match.group('start')), parse_timestamp(match.group('end')), ' ' + text))
+            break
+    return cues
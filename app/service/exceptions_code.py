@@ -45,6 +45,11 @@ class LocalFileException(AppException):
     def __init__(self, message="Error during local file operations"):
         super().__init__(message)
 
+class UploadValidationException(LocalFileException):
+    """Exception raised when an upload is too big or isn't audio."""
+    def __init__(self, message="The uploaded file was rejected."):
+        super().__init__(message)
+
 class KeyException(AppException):
     """Exception raised for errors during local file operations."""
     def __init__(self, message="Error creating key for state cache."):
@@ -84,3 +89,8 @@ class MissingContentException(Exception):
         self.message = message
         super().__init__(self.message)
         MissingContentException
+
+class AudioTooLongException(AppException):
+    """Exception raised when the audio is longer than the service transcribes."""
+    def __init__(self, message="The audio is too long to transcribe."):
+        super().__init__(message)
@@ -0,0 +1,124 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###########################################################################################
+# Author: Margaret Johnson
+# Copyright (c) 2024 Margaret Johnson
+###########################################################################################
+from collections import OrderedDict
+import logging
+import threading
+import time
+from typing import Any, Callable, Hashable, List, Optional, Tuple
+
+# Create a logger instance for this module
+logger = logging.getLogger(__name__)
+
+# The default memory budget of an LRUCache.
+LRU_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# What an entry costs besides the text it holds (object headers, numbers, short strings).
+ENTRY_OVERHEAD_BYTES = 1024
+
+
+def estimate_size(value: Any) -> int:
+    '''A cheap estimate of the memory a cached state takes. The transcript text is what makes states big,
+    so that is what is counted.'''
+    size = ENTRY_OVERHEAD_BYTES
+    for chapter in getattr(value, "chapters", None) or []:
+        # A chapter read from the state cache holds its text compressed until the text is read.
+        size += 128 + chapter.text_size + len(chapter.title or "")
+    for segment in getattr(value, "segments", None) or []:
+        size += 96 + len(segment.text)
+    metadata = getattr(value, "metadata", None)
+    if metadata is not None:
+        size += len(metadata.description or "") + len(metadata.tags or "")
+    return size
+
+
+class LRUCache:
+    '''A bounded in-process cache. Once the estimated size of the entries goes over max_bytes, the least
+    recently used entries are evicted. An entry put with an expiry time (time.time() seconds) is dropped once that time
+    has passed. The values are shared with the callers, so treat them as read-only.'''
+    def __init__(self, max_bytes: int = LRU_CACHE_MAX_BYTES, sizeof: Callable[[Any], int] = estimate_size):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        # key -> (value, size, expires_at), least recently used first.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] <= time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, expires_at: Optional[float] = None) -> None:
+        size = self.sizeof(value)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                # Bigger than the whole cache. Caching it would only evict everything else.
+                return
+            self._entries[key] = (value, size, expires_at)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                evicted_key, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+                logger.debug(f"Evicted {evicted_key} ({evicted_size} bytes).")
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._remove(key)
+
+    def items(self) -> List[Tuple[Hashable, Any]]:
+        '''The keys and values, without counting them as used.'''
+        with self._lock:
+            return [(key, entry[0]) for key, entry in self._entries.items()]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def metrics(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, key: Hashable) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[1]
@@ -1,38 +1,255 @@
 import asyncio
-from asyncio import Queue
+from bisect import bisect_left
+from collections import Counter, deque
 import logging
+import os
+from operator import attrgetter
+from typing import Callable, Dict, Optional
 
 logger = logging.getLogger(__name__)
 
+# The number of messages a job's queue holds before the overflow policy of the incoming message applies.
+MESSAGE_QUEUE_MAXSIZE = int(os.environ.get("MESSAGE_QUEUE_MAXSIZE", 256))
+# Seconds a message with the TIMEOUT policy waits for room before it is dropped.
+MESSAGE_QUEUE_OVERFLOW_TIMEOUT = float(os.environ.get("MESSAGE_QUEUE_OVERFLOW_TIMEOUT", 10))
+
+# Overflow policies.
+DROP_OLDEST = "drop-oldest"  # Make room by dropping the oldest message with this policy. Fine for progress updates.
+BLOCK = "block"              # Wait until the client has read a message. Used for content the client can't do without.
+TIMEOUT = "timeout"          # Make room by dropping the oldest DROP_OLDEST message, or wait up to the overflow timeout,
+                             # then drop the message. For news the client should get, sent by a job that must not hang on it.
+
+# What add_message() does when the queue is full, by event type. Events that are not listed block.
+OVERFLOW_POLICIES = {
+    "status": DROP_OLDEST,
+    "data": BLOCK,
+    # Sent when a job fails or is cancelled, often because no client is reading. Blocking would keep the job from ending.
+    "server-error": TIMEOUT,
+}
+
+class QueuedMessage:
+    '''A message in the queue. Every subscriber gets the same instance, so the wire format
+    (SSE bytes, websocket frame) is encoded once no matter how many clients are listening.'''
+    __slots__ = ("seq", "message", "readers_left", "_encoded")
+
+    def __init__(self, seq: int, message: dict, readers_left: int):
+        self.seq = seq
+        self.message = message
+        # The number of subscribers that haven't read the message yet.
+        self.readers_left = readers_left
+        self._encoded = {}
+
+    @property
+    def event(self) -> str:
+        return self.message.get('event')
+
+    @property
+    def data(self):
+        return self.message.get('data')
+
+    def encoded(self, name: str, encoder: Callable[["QueuedMessage"], object]):
+        if name not in self._encoded:
+            self._encoded[name] = encoder(self)
+        return self._encoded[name]
+
+class Subscription:
+    '''A reader of the queue with its own cursor. Each subscriber sees every message.'''
+    __slots__ = ("manager", "cursor")
+
+    def __init__(self, manager: "MessageQueueManager", cursor: int):
+        self.manager = manager
+        self.cursor = cursor  # The seq of the next message to read.
+
+    async def next(self) -> QueuedMessage:
+        return await self.manager._next_for(self)
+
+    def close(self):
+        self.manager.unsubscribe(self)
+
 class MessageQueueManager:
-    def __init__(self):
+    '''Publishes the messages of a job to any number of subscribers (e.g. the SSE connections of two browser tabs).
+
+    Messages stay in the queue until every subscriber has read them. If nobody has subscribed yet, they wait for
+    the first subscriber. The slowest subscriber determines when the queue is full.'''
+    def __init__(self, maxsize: int = MESSAGE_QUEUE_MAXSIZE, overflow_policies: Optional[Dict[str, str]] = None,
+                 overflow_timeout: float = MESSAGE_QUEUE_OVERFLOW_TIMEOUT):
         self.queue = None
+        self.maxsize = maxsize
+        self.overflow_timeout = overflow_timeout
+        self.overflow_policies = overflow_policies if overflow_policies is not None else OVERFLOW_POLICIES
+        self._condition = None
+        self._subscriptions = set()
+        self._default_subscription = None
+        # Sequence numbers keep increasing across jobs so they can be used as SSE ids.
+        self._next_seq = 1
+        self._reset_metrics()
 
     async def initialize(self):
-        self.queue = Queue()
-        logger.info("MessageQueueManager initialized")
-        logger.info("MessageQueueManager initialized")
+        self._close_default_subscription()
+        self.queue = deque()
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        # Subscribers that are already connected follow the new job.
+        for subscription in self._subscriptions:
+            subscription.cursor = self._next_seq
+        self._reset_metrics()
+        logger.info(f"MessageQueueManager initialized. maxsize: {self.maxsize}")
 
     async def cleanup(self):
+        self._close_default_subscription()
         self.queue = None
+        if self._condition is not None:
+            # Wake up producers and consumers that are waiting so they see the queue is gone.
+            async with self._condition:
+                self._condition.notify_all()
         logger.info("MessageQueueManager cleaned up")
 
+    def subscribe(self) -> Subscription:
+        if self.queue is None:
+            raise ValueError("Queue not initialized")
+        # A new subscriber starts with the oldest message still in the queue.
+        cursor = self.queue[0].seq if self.queue else self._next_seq
+        subscription = Subscription(self, cursor)
+        self._subscriptions.add(subscription)
+        for queued_message in self.queue:
+            queued_message.readers_left += 1
+        logger.debug(f"Subscribed. {len(self._subscriptions)} subscriber(s).")
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        if subscription not in self._subscriptions:
+            return
+        self._subscriptions.discard(subscription)
+        if self.queue is not None and self._condition is not None:
+            for queued_message in self.queue:
+                if queued_message.seq >= subscription.cursor:
+                    queued_message.readers_left -= 1
+            # The subscriber may have been the one holding messages in the queue.
+            if self._trim():
+                asyncio.get_event_loop().create_task(self._notify())
+        logger.debug(f"Unsubscribed. {len(self._subscriptions)} subscriber(s).")
+
     async def add_message(self, message):
         if self.queue is None:
             raise ValueError("Queue not initialized")
-        await self.queue.put(message)
+        event = message.get('event')
+        policy = self.overflow_policies.get(event, BLOCK)
+        deadline = None
+        async with self._condition:
+            while len(self.queue) >= self.maxsize:
+                if policy == DROP_OLDEST:
+                    if not self._drop_oldest():
+                        # The queue is full of messages that can't be dropped. The incoming message is the oldest one with the policy.
+                        self._record_drop(event)
+                        return
+                    break
+                if policy == TIMEOUT and self._drop_oldest():
+                    break
+                self.num_blocked += 1
+                if policy == TIMEOUT:
+                    loop = asyncio.get_running_loop()
+                    if deadline is None:
+                        deadline = loop.time() + self.overflow_timeout
+                    if loop.time() >= deadline:
+                        self._record_drop(event)
+                        return
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), deadline - loop.time())
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    await self._condition.wait()
+                if self.queue is None:
+                    raise ValueError("Queue was cleaned up while waiting for room.")
+            self.queue.append(QueuedMessage(self._next_seq, message, len(self._subscriptions)))
+            self._next_seq += 1
+            self.num_enqueued[event] += 1
+            self.max_depth = max(self.max_depth, len(self.queue))
+            self._condition.notify_all()
 
     async def get_message(self):
+        '''Read the next message as a single consumer. The consumer is subscribed until the queue is initialized
+        for the next job or cleaned up.'''
+        if self._default_subscription is None:
+            self._default_subscription = self.subscribe()
+        queued_message = await self._default_subscription.next()
+        return queued_message.message
+
+    def queue_empty(self):
         if self.queue is None:
             raise ValueError("Queue not initialized")
-        return await self.queue.get()
+        return len(self.queue) == 0
 
-    def queue_empty(self):
+    def metrics(self) -> dict:
+        return {
+            "depth": len(self.queue) if self.queue is not None else 0,
+            "maxsize": self.maxsize,
+            "max_depth": self.max_depth,
+            "subscribers": len(self._subscriptions),
+            "enqueued": dict(self.num_enqueued),
+            "dropped": dict(self.num_dropped),
+            "blocked": self.num_blocked,
+        }
+
+    async def _next_for(self, subscription: Subscription) -> QueuedMessage:
         if self.queue is None:
             raise ValueError("Queue not initialized")
-        return self.queue.empty()
+        async with self._condition:
+            while True:
+                if self.queue is None:
+                    raise ValueError("Queue was cleaned up while waiting for a message.")
+                index = bisect_left(self.queue, subscription.cursor, key=attrgetter('seq'))
+                if index < len(self.queue):
+                    break
+                await self._condition.wait()
+            queued_message = self.queue[index]
+            queued_message.readers_left -= 1
+            subscription.cursor = queued_message.seq + 1
+            # Only a subscriber reading the head can be the one holding it in the queue.
+            if index == 0 and self._trim():
+                self._condition.notify_all()
+        return queued_message
+
+    def _close_default_subscription(self):
+        # Otherwise the consumer of get_message() would count as a reader of every message of the next job.
+        if self._default_subscription is not None:
+            self._default_subscription.close()
+            self._default_subscription = None
+
+    def _trim(self) -> bool:
+        '''Remove the messages every subscriber has read. Returns True if room was made.'''
+        # Without subscribers, messages wait for the first one to connect.
+        if not self._subscriptions:
+            return False
+        trimmed = False
+        while self.queue and self.queue[0].readers_left <= 0:
+            self.queue.popleft()
+            trimmed = True
+        return trimmed
+
+    async def _notify(self):
+        async with self._condition:
+            self._condition.notify_all()
+
+    def _drop_oldest(self) -> bool:
+        for index, queued_message in enumerate(self.queue):
+            if self.overflow_policies.get(queued_message.event, BLOCK) == DROP_OLDEST:
+                del self.queue[index]
+                self._record_drop(queued_message.event)
+                return True
+        return False
+
+    def _record_drop(self, event: str):
+        self.num_dropped[event] += 1
+        logger.debug(f"Message queue full ({self.maxsize}). Dropped a {event} message.")
+
+    def _reset_metrics(self):
+        self.max_depth = 0
+        self.num_enqueued = Counter()
+        self.num_dropped = Counter()
+        self.num_blocked = 0
 
-async def initialize_message_queue_manager():
-    queue_manager = MessageQueueManager()
+async def initialize_message_queue_manager(maxsize: int = MESSAGE_QUEUE_MAXSIZE):
+    queue_manager = MessageQueueManager(maxsize=maxsize)
     await queue_manager.initialize()
-    return queue_manager
\ No newline at end of file
+    return queue_manager
@@ -18,13 +18,14 @@
 # Author: Margaret Johnson
 # Copyright (c) 2024 Margaret Johnson
 ###########################################################################################
-import asyncio
 import logging
+from typing import Dict, List, Optional, Tuple
 
 import app.logging_config
 from app.service.exceptions_code import MetadataExtractionException
 from app.service.audio_handler_code import AudioHandler
 from app.service.audio_processing_model import AudioProcessRequest
+from app.service.captions_code import Cue
 from app.service.message_queue_manager import MessageQueueManager
 from app.service.utils import get_audio_directory
 from app.service.youtube_handler_code import YouTubeHandler
@@ -45,6 +46,25 @@ class MetadataExtractor:
             raise MetadataExtractionException("Error extracting metadata") from e
         return metadata, chapters, audio_filename
 
+    async def probe_metadata_and_chapter_dicts(self, audio_input: AudioProcessRequest) -> Tuple[Optional[Dict], Optional[List]]:
+        '''The metadata and chapters of a YouTube video, before its audio is downloaded. (None, None) for an upload,
+        which is already here.'''
+        if not audio_input.youtube_url:
+            return None, None
+        try:
+            return await YouTubeHandler(audio_input).probe_metadata()
+        except Exception as e:
+            raise MetadataExtractionException("Error probing metadata") from e
+
+    async def caption_cues(self, audio_input: AudioProcessRequest, info_dict: Dict) -> Optional[List[Cue]]:
+        '''The cues of the YouTube video's own captions. None if it has none, or they can't be read, in which case the
+        audio is transcribed.'''
+        try:
+            return await YouTubeHandler(audio_input).fetch_captions(info_dict)
+        except Exception as e:
+            logger.warning(f"Couldn't read the captions of {audio_input.youtube_url}: {e}")
+            return None
+
     def get_handler(self, audio_input):
         if audio_input.youtube_url:
             return YouTubeHandler(audio_input)
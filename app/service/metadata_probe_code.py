@@ -0,0 +1,109 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###########################################################################################
+# Author: Margaret Johnson
+# Copyright (c) 2024 Margaret Johnson
+###########################################################################################
+import asyncio
+import copy
+import logging
+import os
+import time
+from typing import Callable, Dict, NamedTuple, Optional
+
+import app.logging_config
+from app.service.audio_processing_model import AudioProcessRequest
+from app.service.exceptions_code import AudioTooLongException
+from app.service.lru_cache_code import LRUCache
+from app.service.utils import format_time
+
+# Create a logger instance for this module
+logger = logging.getLogger(__name__)
+
+# The format URLs in a probe stop working after about 6 hours, and the download uses them, so a probe is kept for less.
+PROBE_CACHE_SECONDS = int(os.environ.get("PROBE_CACHE_SECONDS", 60 * 60))
+PROBE_CACHE_MAX_ENTRIES = int(os.environ.get("PROBE_CACHE_MAX_ENTRIES", 256))
+# Longer YouTube videos are rejected before they are downloaded. 0 is no limit.
+MAX_AUDIO_SECONDS = int(os.environ.get("MAX_AUDIO_SECONDS", 0))
+
+
+class MetadataProbe(NamedTuple):
+    info_dict: Dict
+    probed_at: float
+
+
+def check_duration(info_dict: Dict, max_seconds: Optional[int] = None) -> None:
+    '''Raises AudioTooLongException if the audio is longer than max_seconds (MAX_AUDIO_SECONDS by default).'''
+    if max_seconds is None:
+        max_seconds = MAX_AUDIO_SECONDS
+    duration = info_dict.get('duration') or 0
+    if max_seconds and duration > max_seconds:
+        raise AudioTooLongException(f"{info_dict.get('title', 'The audio')} is {format_time(duration)} long. "
+                                    f"The longest audio transcribed here is {format_time(max_seconds)}.")
+
+
+class MetadataProbes:
+    '''yt-dlp's info for a video (title, duration, chapters and the chosen format), got without downloading the audio.
+
+    The probe comes first. It is enough to reject a video that is too long, and to set up the state, before any audio
+    bytes move. The download is then started from the same info (see YouTubeHandler), so yt-dlp asks YouTube once. The
+    probes are kept per video ID for max_age seconds, so asking for the same video with other settings doesn't probe again.
+    '''
+    def __init__(self, max_age: float = PROBE_CACHE_SECONDS, max_entries: int = PROBE_CACHE_MAX_ENTRIES):
+        self.max_age = max_age
+        # Counted in entries rather than bytes.
+        self._probes = LRUCache(max_bytes=max_entries, sizeof=lambda probe: 1)
+
+    @staticmethod
+    def probe_key(url: str) -> str:
+        # All the URL forms of a video are the same video.
+        return AudioProcessRequest.youtube_video_id(url) or url
+
+    async def probe(self, url: str, extract: Callable[[str], Dict]) -> Dict:
+        '''Returns the info of the video at url, calling extract(url) in a thread if it isn't cached. The caller gets its
+        own copy, which it can change (yt-dlp does when it downloads).'''
+        key = self.probe_key(url)
+        probe = self._probes.get(key)
+        if probe is None or time.time() - probe.probed_at > self.max_age:
+            start = time.perf_counter()
+            probe = MetadataProbe(await asyncio.to_thread(extract, url), time.time())
+            logger.info(f"Probed {url} in {time.perf_counter() - start:.1f} s.")
+            self._probes.put(key, probe)
+        return copy.deepcopy(probe.info_dict)
+
+    def invalidate(self, url: str) -> None:
+        self._probes.invalidate(self.probe_key(url))
+
+    def metrics(self) -> Dict:
+        return self._probes.metrics()
+
+
+class MetadataProbesSingleton:
+    '''One probe cache per process.'''
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            cls._instance = super(MetadataProbesSingleton, cls).__new__(cls, *args, **kwargs)
+            cls._instance.probes = MetadataProbes()
+        return cls._instance
+
+    @classmethod
+    def get_probes(cls) -> MetadataProbes:
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance.probes
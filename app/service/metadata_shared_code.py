@@ -36,7 +36,9 @@ class Metadata(BaseModel):
     upload_date: Optional[str] = Field(default=None, description="upload date")
     uploader_id: Optional[str] = Field(default=None, description="uploader id")
     download_time: Optional[str] = Field(default=None, description="Number of seconds it took to download the YouTube Video.")
+    download_speed: Optional[str] = Field(default=None, description="The throughput of the YouTube download, e.g. 4.2 MB/s.")
     transcription_time: Optional[str] = Field(default=None, description="Number of seconds it took to process the transcription.")
+    transcription_model: Optional[str] = Field(default=None, description="The audio_quality (model) the transcript was made with. With allow_higher_quality it can be a better model than the one asked for.")
 
 
 def build_metadata_instance(info_dict: Dict) -> Metadata:
@@ -0,0 +1,148 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###########################################################################################
+# Author: Margaret Johnson
+# Copyright (c) 2024 Margaret Johnson
+###########################################################################################
+import logging
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Tuple
+
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+import app.logging_config
+from app.service.exceptions_code import UploadValidationException
+from app.service.upload_writer_code import AudioUploadWriter
+
+# Create a logger instance for this module
+logger = logging.getLogger(__name__)
+
+# Form fields are small (a URL, a model name). Anything bigger isn't a field this service reads.
+MAX_FIELD_BYTES = 64 * 1024
+MAX_FIELDS = 32
+
+
+class SavedUpload(NamedTuple):
+    filename: str
+    location: str
+    audio_hash: str
+
+
+class AudioFormParser:
+    '''Parses a multipart/form-data body as it arrives. The bytes of the file part go straight to an AudioUploadWriter,
+    so the upload is written once, to its content-addressed place in the audio directory. Starlette's form parser
+    would spool it to a temporary file first, and it would then be copied from there.'''
+    def __init__(self, content_type: str, stream: AsyncIterator[bytes], audio_directory: Optional[str] = None):
+        self.content_type = content_type
+        self.stream = stream
+        self.audio_directory = audio_directory
+        self.fields: Dict[str, str] = {}
+        self._events: List[Tuple[str, object]] = []
+        self._headers: Dict[bytes, bytes] = {}
+        self._header_name = b""
+        self._header_value = b""
+        self._field_name = None
+        self._field_data = bytearray()
+        self._in_file = False
+        self._writer: Optional[AudioUploadWriter] = None
+        self._saved: Optional[SavedUpload] = None
+
+    async def parse(self) -> Tuple[Dict[str, str], Optional[SavedUpload]]:
+        '''Returns the form fields and the saved upload, if the form had a file.'''
+        _, params = parse_options_header(self.content_type)
+        boundary = params.get(b"boundary")
+        if not boundary:
+            raise UploadValidationException("Missing boundary in multipart form.")
+        parser = MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+        })
+        try:
+            async for chunk in self.stream:
+                parser.write(chunk)
+                # The callbacks can't await. What they found is handled here, before the next chunk is read.
+                await self._handle_events()
+            parser.finalize()
+            await self._handle_events()
+            if self._writer is not None:
+                raise UploadValidationException(f"The form ended before the end of {self._writer.filename}.")
+        finally:
+            if self._writer is not None:
+                # The body ended (or failed) in the middle of the file.
+                await self._writer.abort()
+        return self.fields, self._saved
+
+    async def _handle_events(self) -> None:
+        events, self._events = self._events, []
+        for event, value in events:
+            if event == "file_start":
+                if self._saved is not None or self._writer is not None:
+                    raise UploadValidationException("Only one file can be uploaded at a time.")
+                self._writer = AudioUploadWriter(value, audio_directory=self.audio_directory)
+            elif event == "file_data":
+                await self._writer.write(value)
+            elif event == "file_end":
+                location, audio_hash = await self._writer.finish()
+                self._saved = SavedUpload(self._writer.filename, location, audio_hash)
+                self._writer = None
+
+    def _on_part_begin(self) -> None:
+        self._headers = {}
+        self._field_name = None
+        self._field_data = bytearray()
+        self._in_file = False
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_name += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        self._headers[self._header_name.lower()] = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if b"name" not in options:
+            raise UploadValidationException('The Content-Disposition header field "name" must be provided.')
+        self._field_name = options[b"name"].decode("utf-8", errors="replace")
+        if b"filename" in options:
+            self._in_file = True
+            self._events.append(("file_start", options[b"filename"].decode("utf-8", errors="replace")))
+        elif len(self.fields) >= MAX_FIELDS:
+            raise UploadValidationException(f"Too many form fields. The most is {MAX_FIELDS}.")
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._in_file:
+            # data is the parser's buffer. It is reused for the next chunk, so the slice is a copy.
+            self._events.append(("file_data", data[start:end]))
+        else:
+            self._field_data += data[start:end]
+            if len(self._field_data) > MAX_FIELD_BYTES:
+                raise UploadValidationException(f"The form field {self._field_name} is too long.")
+
+    def _on_part_end(self) -> None:
+        if self._in_file:
+            self._events.append(("file_end", None))
+        else:
+            self.fields[self._field_name] = self._field_data.decode("utf-8", errors="replace")
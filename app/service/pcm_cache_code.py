@@ -0,0 +1,279 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###########################################################################################
+# Author: Margaret Johnson
+# Copyright (c) 2024 Margaret Johnson
+###########################################################################################
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from typing import BinaryIO, Callable, Dict, Iterator, Optional, Union
+
+import av
+import numpy as np
+
+import app.logging_config
+
+# Create a logger instance for this module
+logger = logging.getLogger(__name__)
+
+# Whisper works on 16 kHz mono audio.
+PCM_SAMPLE_RATE = 16000
+# Samples are stored as the float32 Whisper reads, so a cached file is used as is, without a conversion that would copy it.
+PCM_DTYPE = np.float32
+PCM_EXTENSION = ".f32"
+PCM_CACHE_DIRECTORY = os.environ.get("PCM_CACHE_DIRECTORY", "pcm_cache")
+# About 64 KB per second of audio, so the default keeps roughly 18 hours of decoded audio.
+PCM_CACHE_MAX_BYTES = int(os.environ.get("PCM_CACHE_MAX_BYTES", 4 * 1024 ** 3))
+
+
+def decode_to_pcm(audio_path: str) -> np.ndarray:
+    # faster-whisper's decoder (PyAV) resamples to 16 kHz mono float32, the same way model.transcribe() does with a path.
+    from faster_whisper.audio import decode_audio
+    return decode_audio(audio_path, sampling_rate=PCM_SAMPLE_RATE)
+
+
+class PCMStream:
+    '''The samples of an audio file in chunks, as they are decoded or read from the PCM cache. duration is the length of
+    the audio in seconds, if it is known before the chunks are read. on_stop, if set, makes a read that is waiting for
+    audio (e.g. a download that is still going) give up. See stop_reading().'''
+    def __init__(self, chunks: Iterator[np.ndarray], duration: Optional[float] = None):
+        self.chunks = chunks
+        self.duration = duration
+        self.on_stop: Optional[Callable[[], None]] = None
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        return self.chunks
+
+    def stop_reading(self) -> None:
+        '''Called from the event loop when the reader is cancelled while a chunk is being read in another thread.'''
+        if self.on_stop is not None:
+            self.on_stop()
+
+    def close(self) -> None:
+        if hasattr(self.chunks, "close"):
+            self.chunks.close()
+
+
+def open_pcm_stream(audio: Union[str, BinaryIO], duration: Optional[float] = None) -> PCMStream:
+    '''Decodes the audio a frame at a time instead of into one array, so memory doesn't grow with the length of the audio.
+    The audio is a path or a file, e.g. a download that is still being written (see GrowingFileReader).'''
+    if not isinstance(audio, str):
+        # Opening the file reads its header, which may not have arrived yet. It is opened by the first read instead, in
+        # the thread that reads it.
+        return PCMStream(_decode_file(audio), duration)
+    container = av.open(audio, mode="r", metadata_errors="ignore")
+    if container.duration:
+        duration = container.duration / av.time_base
+    return PCMStream(_decode_chunks(container), duration)
+
+
+def _decode_file(file_object: BinaryIO) -> Iterator[np.ndarray]:
+    container = av.open(file_object, mode="r", metadata_errors="ignore")
+    yield from _decode_chunks(container)
+
+
+def _decode_chunks(container) -> Iterator[np.ndarray]:
+    # The same conversion decode_to_pcm() does, one frame at a time.
+    resampler = av.audio.resampler.AudioResampler(format="s16", layout="mono", rate=PCM_SAMPLE_RATE)
+    try:
+        for frame in _decoded_frames(container):
+            for resampled in resampler.resample(frame):
+                yield _to_float(resampled)
+        # Flush what the resampler is holding on to.
+        for resampled in resampler.resample(None):
+            yield _to_float(resampled)
+    finally:
+        container.close()
+
+
+def _decoded_frames(container):
+    frames = container.decode(audio=0)
+    while True:
+        try:
+            frame = next(frames)
+        except StopIteration:
+            break
+        except av.error.InvalidDataError:
+            # A damaged frame. faster-whisper skips them too.
+            continue
+        yield frame
+
+
+def _to_float(frame) -> np.ndarray:
+    return frame.to_ndarray().reshape(-1).astype(PCM_DTYPE) / 32768.0
+
+
+class PCMCache:
+    '''Decoded audio, ready for Whisper, as raw 16 kHz mono float32 files in a directory.
+
+    A cached file is memory-mapped read only, so transcribing the same audio again (another model, decoding profile or
+    chapter_chunk_time) skips ffmpeg, and processes that map the same file share its pages in the OS page cache. The
+    directory is the cache: files are written to a temporary name and renamed, and the time a file was last used is its
+    mtime, so the least recently used files are removed first once the directory is over max_bytes.
+    '''
+    def __init__(self, directory: str = PCM_CACHE_DIRECTORY, max_bytes: int = PCM_CACHE_MAX_BYTES,
+                 decode: Callable[[str], np.ndarray] = decode_to_pcm):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.decode = decode
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def location(self, audio_identity: str) -> str:
+        # The identity can be a filename someone uploaded, so it isn't used in the path as is.
+        name = hashlib.sha256(audio_identity.encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.directory, name + PCM_EXTENSION)
+
+    def get(self, audio_identity: str) -> Optional[np.ndarray]:
+        '''Returns the cached samples memory-mapped, or None.'''
+        location = self.location(audio_identity)
+        try:
+            samples = np.memmap(location, dtype=PCM_DTYPE, mode="r")
+            # Mark it as recently used.
+            os.utime(location)
+        except (FileNotFoundError, ValueError):
+            # ValueError is an empty file, which np.memmap can't map. Nothing worth caching decodes to that.
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return samples
+
+    def load(self, audio_identity: str, audio_path: str) -> np.ndarray:
+        '''Returns the samples of the audio, decoding audio_path and caching the result if it isn't cached.'''
+        samples = self.get(audio_identity)
+        if samples is not None:
+            logger.debug(f"Decoded audio for {audio_identity} found in the PCM cache.")
+            return samples
+        samples = np.ascontiguousarray(self.decode(audio_path), dtype=PCM_DTYPE)
+        self.put(audio_identity, samples)
+        # The decoded array is already in memory, so it's returned instead of mapping the file just written.
+        return samples
+
+    def put(self, audio_identity: str, samples: np.ndarray) -> None:
+        if samples.nbytes == 0 or samples.nbytes > self.max_bytes:
+            return
+        location = self.location(audio_identity)
+        fd, temp_location = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as file_object:
+                samples.astype(PCM_DTYPE, copy=False).tofile(file_object)
+            # A worker that maps the file sees either the old file or the complete new one.
+            os.replace(temp_location, location)
+        except BaseException:
+            if os.path.exists(temp_location):
+                os.remove(temp_location)
+            raise
+        logger.debug(f"Decoded audio for {audio_identity} cached at {location} ({samples.nbytes} bytes).")
+        self._cull()
+
+    def stream(self, audio_identity: str, audio: Union[str, BinaryIO], duration: Optional[float] = None) -> PCMStream:
+        '''Returns the samples of the audio in chunks. A cached file is returned as one memory-mapped chunk, which is only
+        paged in as it is read. Otherwise the audio (a path or a file) is decoded as it is read and written to the cache
+        along the way. duration is the length of the audio, if the audio's header doesn't say.'''
+        samples = self.get(audio_identity)
+        if samples is not None:
+            logger.debug(f"Decoded audio for {audio_identity} found in the PCM cache.")
+            return PCMStream(iter([samples]), len(samples) / PCM_SAMPLE_RATE)
+        source = open_pcm_stream(audio, duration)
+        return PCMStream(self._write_through(audio_identity, source), source.duration)
+
+    def _write_through(self, audio_identity: str, source: PCMStream) -> Iterator[np.ndarray]:
+        fd, temp_location = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        num_bytes = 0
+        complete = False
+        try:
+            with os.fdopen(fd, "wb") as file_object:
+                for chunk in source:
+                    chunk.tofile(file_object)
+                    num_bytes += chunk.nbytes
+                    yield chunk
+            complete = True
+        finally:
+            source.close()
+            # Audio that wasn't read to the end (e.g. the transcription was cancelled) isn't cached.
+            if complete and 0 < num_bytes <= self.max_bytes:
+                os.replace(temp_location, self.location(audio_identity))
+                logger.debug(f"Decoded audio for {audio_identity} cached ({num_bytes} bytes).")
+                self._cull()
+            elif os.path.exists(temp_location):
+                os.remove(temp_location)
+
+    def invalidate(self, audio_identity: str) -> None:
+        location = self.location(audio_identity)
+        if os.path.exists(location):
+            os.remove(location)
+
+    def metrics(self) -> Dict:
+        files = self._cached_files()
+        total = self.hits + self.misses
+        return {"entries": len(files), "bytes": sum(size for _, _, size in files), "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions}
+
+    def _cached_files(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(PCM_EXTENSION):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    # Removed by another worker.
+                    continue
+                files.append((stat.st_mtime, entry.path, stat.st_size))
+        return files
+
+    def _cull(self) -> None:
+        files = self._cached_files()
+        total = sum(size for _, _, size in files)
+        # Least recently used first.
+        for _, path, size in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                # A process that has the file mapped keeps its pages until it unmaps it.
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            with self._lock:
+                self.evictions += 1
+            logger.debug(f"Removed {path} from the PCM cache.")
+
+
+class PCMCacheSingleton:
+    '''One PCM cache per process. Processes share the directory.'''
+    _instance = None
+
+    def __new__(cls, directory: str = PCM_CACHE_DIRECTORY, *args, **kwargs):
+        if not cls._instance:
+            cls._instance = super(PCMCacheSingleton, cls).__new__(cls, *args, **kwargs)
+            cls._instance.cache = PCMCache(directory=directory)
+        return cls._instance
+
+    @classmethod
+    def get_cache(cls) -> PCMCache:
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance.cache
@@ -21,15 +21,19 @@
 import asyncio
 import logging
 import time
-from typing import List
+from typing import Awaitable, Callable, List, Optional, Tuple, Union
 
 import app.logging_config
 from pydantic import BaseModel, field_validator
 from app.service.audio_processing_model import AudioProcessRequest
+from app.service.captions_code import CAPTIONS_MODEL
 from app.service.message_queue_manager import MessageQueueManager
+from app.service.metadata_shared_code import Metadata
+from app.service.pcm_cache_code import PCMCacheSingleton
+from app.service.progressive_download_code import ProgressiveDownload
 from app.service.transcription_code import TranscribeAudio
-from app.service.transcription_state_code import TranscriptionState, TranscriptionStatesSingleton, initialize_transcription_state
-from app.service.exceptions_code import   LocalFileException, MetadataExtractionException, TranscriptionException, SendSSEDataException
+from app.service.transcription_state_code import SegmentBlockWriter, TranscriptionState, TranscriptionStatesSingleton, TranscriptSegment, TranscriptSegments, initialize_transcription_state
+from app.service.exceptions_code import   AudioTooLongException, LocalFileException, MetadataExtractionException, TranscriptionException, SendSSEDataException
 from app.service.utils import send_sse_message, format_time
 
 # Create a logger instance for this module
@@ -59,6 +63,10 @@ async def process_audio(queue: MessageQueueManager, audio_input: AudioProcessReq
         await send_sse_message(queue,"server-error", "Transcription cancelled.")
         return
 
+    except AudioTooLongException as e:
+        await send_sse_message(queue, "server-error", e.message)
+        logger.info(e.message)
+        return
     except MetadataExtractionException as e:
         await send_sse_message(queue, "server-error", "Error extracting metadata.")
         logger.error(f"Error extracting metadata",exc_info=e)
@@ -81,28 +89,49 @@ async def process_audio(queue: MessageQueueManager, audio_input: AudioProcessReq
         return
 
 
-    transcribe_audio_instance = TranscribeAudio(audio_input.audio_quality, audio_input.compute_type, audio_input.chapter_chunk_time)
-
     try:
+        transcribe_audio_instance = TranscribeAudio(audio_input.audio_quality, audio_input.compute_type, audio_input.chapter_chunk_time, audio_input.decoding_profile)
+        states = TranscriptionStatesSingleton().get_states()
         start_time = time.time()
+        # Whisper's segments don't depend on chapter_chunk_time. If this audio has been transcribed with the same model
+        # and settings, only the chapters need to be made.
+        transcript_segments = await states.find_segments_async(audio_input)
+        if transcript_segments is None:
+            segments_key = states.make_segments_key(audio_input)
+            # Making the chapters fills in the chapters of the audio source. Keep them as they are for the segment cache.
+            chapter_dicts = [chapter.model_dump(include={'title', 'start_time', 'end_time'}) for chapter in state.chapters]
+            # The segments are stored a block at a time as the windows are transcribed.
+            block_writer = SegmentBlockWriter(states, segments_key)
+            segments, duration = await transcribe_local_audio(transcribe_audio_instance, queue, states.audio_identity(audio_input),
+                                                              local_audio_filename, state.metadata, block_writer.write)
+            transcript_segments = TranscriptSegments(key=segments_key, basename=state.basename, metadata=state.metadata,
+                                                     chapter_dicts=chapter_dicts, duration=duration, segments=segments)
+            await states.add_segments_async(transcript_segments, block_writer.num_blocks_written)
+        elif isinstance(local_audio_filename, ProgressiveDownload):
+            # The transcript didn't need the audio, but it is downloaded anyway so it can be listened to.
+            await local_audio_filename.wait()
         # The chapters currently have th start/stop metadata but not chapter num and not chapter text.
-        state.chapters = await transcribe_audio_instance.transcribe(queue, local_audio_filename,state.chapters)
+        state.chapters = transcribe_audio_instance.make_chapters(transcript_segments.segments, transcript_segments.duration, state.chapters)
         end_time = time.time()
+        state.metadata.transcription_model = transcript_segments.transcription_model
         state.metadata.transcription_time = format_time(float(end_time - start_time))
     except asyncio.CancelledError as e:
         logger.debug("Transcription cancelled.")
+        cancel_download(local_audio_filename)
         await send_sse_message(queue, "server-error", "Transcription cancelled.")
         if state:
             state = None
         return
 
     except TranscriptionException as e:
+        cancel_download(local_audio_filename)
         await send_sse_message(queue, "server-error", f"Error during transcription {e}")
         logger.error(f"Error during transcription",exc_info=e)
         # Keep the state in case the client wants to try again.
         raise
 
     except Exception as e:
+        cancel_download(local_audio_filename)
         await send_sse_message(queue, "server-error", f"An unexpected error occurred: {e}")
         logger.error(f"An unexpected error occurred",exc_info=e)
         # This is an unexpected error, so not sure the state is valid.
@@ -110,14 +139,52 @@ async def process_audio(queue: MessageQueueManager, audio_input: AudioProcessReq
             state = None
         raise
     # The state is now complete.  Add the transcript text to the cache.
-    states = TranscriptionStatesSingleton().get_states()
-    states.add_state(state)
+    # A transcript made with a better model than asked for isn't cached under this key, so requests that don't
+    # allow_higher_quality still get what they asked for. The segments are cached, so the next one is quick anyway.
+    # A transcript made from captions is, since only requests with use_captions have its key (see make_key()).
+    if state.metadata.transcription_model in (audio_input.audio_quality, CAPTIONS_MODEL):
+        # Each chapter is a record of its own. The meta record goes last, since it is what makes the chapters visible.
+        for index, chapter in enumerate(state.chapters):
+            await states.add_chapter_async(state.key, index, chapter)
+        await states.add_state_async(state, num_chapters_written=len(state.chapters))
     logging.debug(f"Transcription complete.  Transcription time: {state.metadata.transcription_time}.  Final State added to cache.")
 
     await send_sse_message(queue , "status", "Have the content.  Need a few moments to process.  Please hang on.")
     # Ordered the num_chapters early on. This way the client can better keep track of incoming chapters.
     await send_sse_data_messages(queue, state,["key","num_chapters","basename","metadata","chapters"])
 
+def cancel_download(local_audio: Union[str, ProgressiveDownload, None]) -> None:
+    # A YouTube download that is still going when the job fails would otherwise run on with no one to read it.
+    if isinstance(local_audio, ProgressiveDownload):
+        local_audio.cancel()
+
+async def transcribe_local_audio(transcriber: TranscribeAudio, queue: MessageQueueManager, audio_identity: str,
+                                 local_audio: Union[str, ProgressiveDownload], metadata: Metadata,
+                                 on_window: Optional[Callable[[List[TranscriptSegment]], Awaitable[None]]] = None) -> Tuple[List[TranscriptSegment], float]:
+    '''Transcribes the audio file, or a YouTube download while it downloads. on_window is passed to transcribe_segments().'''
+    # The decoded audio is cached by the audio's identity, so transcribing it again with other settings skips ffmpeg.
+    # It is decoded (or read from the cache) a window at a time as it is transcribed.
+    cache = PCMCacheSingleton.get_cache()
+    if not isinstance(local_audio, ProgressiveDownload):
+        return await transcriber.transcribe_segments(queue, cache.stream(audio_identity, local_audio), on_window)
+    # The transcription trails the download. When it catches up, it waits for more audio.
+    reader = local_audio.reader()
+    try:
+        audio = cache.stream(audio_identity, reader, local_audio.duration)
+        # A cancelled transcription stops the download, which wakes up a read that is waiting for more audio.
+        audio.on_stop = local_audio.cancel
+        # transcribe_segments() returns once no thread is reading, so the reader can be closed.
+        result = await transcriber.transcribe_segments(queue, audio, on_window)
+    except BaseException:
+        local_audio.cancel()
+        raise
+    finally:
+        reader.close()
+    await local_audio.wait()
+    metadata.download_time = format_time(local_audio.download_seconds)
+    metadata.download_speed = local_audio.download_speed
+    return result
+
 class ContentTextsModel(BaseModel):
     content_texts: List[str]
 
@@ -0,0 +1,138 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###########################################################################################
+# Author: Margaret Johnson
+# Copyright (c) 2024 Margaret Johnson
+###########################################################################################
+import asyncio
+import logging
+import re
+import threading
+from typing import Callable, Optional
+
+import app.logging_config
+from app.service.message_queue_manager import MessageQueueManager
+from app.service.utils import format_sse
+
+# Create a logger instance for this module
+logger = logging.getLogger(__name__)
+
+# The minimum number of seconds between two progress status messages of the same job.
+PROGRESS_MIN_INTERVAL = 1.0
+
+ANSI_ESCAPE_REGEX = re.compile(r'\x1b\[.*?m')
+WHITESPACE_REGEX = re.compile(r'\s+')
+
+
+def clean_ytdlp_message(message: str) -> str:
+    '''yt-dlp's default progress template contains ANSI color codes and padding. Strip them so the client gets plain text.'''
+    message = ANSI_ESCAPE_REGEX.sub('', message)
+    return WHITESPACE_REGEX.sub(' ', message).strip()
+
+
+class ProgressAggregator:
+    '''Rate limits the progress status messages of a job.
+
+    Progress updates can arrive many times a second (yt-dlp calls the progress hook for every chunk it downloads).
+    Rather than putting each one on the message queue, only the latest pending update is kept. It is sent at most
+    once every min_interval seconds. A formatter (e.g. stripping ANSI codes) is only run on the updates that are sent.
+    '''
+    def __init__(self, queue: MessageQueueManager, loop: Optional[asyncio.AbstractEventLoop] = None,
+                 min_interval: float = PROGRESS_MIN_INTERVAL, formatter: Optional[Callable[[str], str]] = None):
+        self.queue = queue
+        self.loop = loop or asyncio.get_event_loop()
+        self.min_interval = min_interval
+        self.formatter = formatter
+        # update_threadsafe() is called from yt-dlp's download thread.
+        self._lock = threading.Lock()
+        self._pending = None
+        self._scheduled = False
+        self._flush_task = None
+        self._last_sent = None
+        self.num_updates = 0
+        self.num_sent = 0
+
+    def update_threadsafe(self, message: str, final: bool = False) -> None:
+        '''Record the latest progress from a thread other than the event loop's thread.
+        Only the first update after a send wakes up the event loop.'''
+        with self._lock:
+            self._pending = message
+            self.num_updates += 1
+            if self._scheduled and not final:
+                return
+            self._scheduled = True
+        self.loop.call_soon_threadsafe(self._schedule_flush, final)
+
+    async def update(self, message: str, final: bool = False) -> None:
+        '''Record the latest progress from within the event loop.'''
+        with self._lock:
+            self._pending = message
+            self.num_updates += 1
+            if self._scheduled and not final:
+                return
+            self._scheduled = True
+        self._schedule_flush(final)
+        # Callers (e.g. the transcription loop) may not await anything else for a while. Give a due flush a chance to run.
+        await asyncio.sleep(0)
+
+    async def flush(self) -> None:
+        '''Send the pending progress (if any) right away.'''
+        self._cancel_scheduled_flush()
+        await self._send_pending()
+
+    def _schedule_flush(self, final: bool = False) -> None:
+        if final:
+            delay = 0.0
+        elif self._last_sent is None:
+            delay = 0.0
+        else:
+            delay = max(0.0, self._last_sent + self.min_interval - self.loop.time())
+        if self._flush_task is not None:
+            if not final:
+                return
+            self._cancel_scheduled_flush()
+        self._flush_task = self.loop.create_task(self._flush_after(delay))
+
+    def _cancel_scheduled_flush(self) -> None:
+        # _flush_task is only set while the flush is waiting, so cancelling never interrupts a send.
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+    async def _flush_after(self, delay: float) -> None:
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._flush_task = None
+        await self._send_pending()
+
+    async def _send_pending(self) -> None:
+        with self._lock:
+            message = self._pending
+            self._pending = None
+            self._scheduled = False
+        if message is None:
+            return
+        if self.formatter:
+            message = self.formatter(message)
+        self._last_sent = self.loop.time()
+        self.num_sent += 1
+        logger.debug(f"--> progress: {message}")
+        try:
+            await self.queue.add_message(format_sse("status", message))
+        except ValueError as e:
+            # The queue has been cleaned up (e.g. the job was cancelled). Nothing to send the progress to.
+            logger.debug(f"Progress not sent. {e}")
@@ -0,0 +1,164 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###########################################################################################
+# Author: Margaret Johnson
+# Copyright (c) 2024 Margaret Johnson
+###########################################################################################
+import asyncio
+import io
+import logging
+import os
+import threading
+from typing import Optional
+
+import yt_dlp
+
+import app.logging_config
+from app.service.exceptions_code import YouTubeDownloadException
+
+# Create a logger instance for this module
+logger = logging.getLogger(__name__)
+
+# Transcribe YouTube audio while it downloads. Otherwise the transcription starts once the download is done.
+PROGRESSIVE_TRANSCRIPTION = os.environ.get("PROGRESSIVE_TRANSCRIPTION", "true").lower() == "true"
+# How often a reader that has caught up with the download looks for more bytes, in seconds.
+POLL_INTERVAL = 0.05
+
+
+class ProgressiveDownload:
+    '''A YouTube download that is read while yt-dlp writes it.
+
+    path is where the audio will be once the download is done. yt-dlp writes to a .part file until then. Its name is
+    known from the first progress report (see progress_hook()). reader() returns a file that reads the .part file and
+    waits for more bytes when it gets to the end of what has been written.
+    '''
+    def __init__(self, path: str, duration: Optional[float] = None):
+        self.path = path
+        self.duration = duration
+        self.partial_path: Optional[str] = None
+        self.error: Optional[BaseException] = None
+        self.download_seconds: Optional[float] = None
+        self.download_speed: Optional[str] = None
+        # The task that downloads the audio and moves it to path. Set by YouTubeHandler.
+        self.task: Optional[asyncio.Task] = None
+        self._finished = threading.Event()
+        self._cancelled = threading.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self._finished.is_set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def progress_hook(self, info_dict: dict) -> None:
+        # Called from yt-dlp's download thread.
+        if self._cancelled.is_set():
+            raise yt_dlp.utils.DownloadCancelled("The transcription was cancelled.")
+        if info_dict["status"] == "downloading" and self.partial_path is None:
+            self.partial_path = info_dict.get("tmpfilename") or info_dict.get("filename")
+
+    def finish(self, path: Optional[str] = None, error: Optional[BaseException] = None) -> None:
+        if path is not None:
+            self.path = path
+        self.error = error
+        self._finished.set()
+
+    def cancel(self) -> None:
+        '''Stops the download at its next progress report, and a reader that is waiting for more bytes. Can be called from
+        any thread, and after the download has finished.'''
+        self._cancelled.set()
+
+    def reader(self) -> "GrowingFileReader":
+        return GrowingFileReader(self)
+
+    async def wait(self) -> str:
+        '''Waits for the download to finish. Returns where the audio is.'''
+        if self.task is not None:
+            await self.task
+        if self.error is not None:
+            raise self.error
+        return self.path
+
+    def wait_for_more(self) -> None:
+        self._finished.wait(POLL_INTERVAL)
+
+
+class GrowingFileReader(io.RawIOBase):
+    '''Reads a file that is still being written. A read at the end of what has been written waits for more, until the
+    download has finished. The reads happen in the thread that decodes the audio, never on the event loop.'''
+    def __init__(self, download: ProgressiveDownload):
+        super().__init__()
+        self.download = download
+        self._file = None
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        # A demuxer that can seek looks for the end of the file first, which isn't there until the download is done.
+        # YouTube's webm and m4a audio can be read front to back.
+        return False
+
+    def readinto(self, buffer) -> int:
+        self._open()
+        while True:
+            num_read = self._file.readinto(buffer)
+            if num_read:
+                return num_read
+            if self.download.cancelled:
+                raise YouTubeDownloadException(f"The download of {self.download.path} was cancelled.")
+            if self.download.finished:
+                # The last bytes may have been written after the read above.
+                num_read = self._file.readinto(buffer)
+                if num_read or self.download.error is None:
+                    return num_read
+                raise YouTubeDownloadException(f"The download of {self.download.path} failed: {self.download.error}")
+            self.download.wait_for_more()
+
+    def tell(self) -> int:
+        self._open()
+        return self._file.tell()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        super().close()
+
+    def _open(self) -> None:
+        if self._file is not None:
+            return
+        while True:
+            # After the download, yt-dlp renames the .part file, and then YouTubeHandler moves it to path. A file that is
+            # open keeps being read after it is renamed.
+            path = self.download.path if self.download.finished else self.download.partial_path
+            if path is not None:
+                try:
+                    self._file = open(path, "rb")
+                    return
+                except FileNotFoundError:
+                    if self.download.finished and self.download.error is not None:
+                        raise YouTubeDownloadException(f"The download of {self.download.path} failed: {self.download.error}")
+                    if self.download.finished:
+                        raise
+            elif self.download.finished:
+                raise YouTubeDownloadException(f"The download of {self.download.path} failed: {self.download.error}")
+            if self.download.cancelled:
+                raise YouTubeDownloadException(f"The download of {self.download.path} was cancelled.")
+            self.download.wait_for_more()
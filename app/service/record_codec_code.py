@@ -0,0 +1,129 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###########################################################################################
+# Author: Margaret Johnson
+# Copyright (c) 2024 Margaret Johnson
+###########################################################################################
+'''The format the state cache stores its records in.
+
+A record is a small JSON header (plain fields such as the key and the metadata), columns of numbers (e.g. the start
+and end times of the segments) and the texts (e.g. the transcript of each chapter). Everything is deflate compressed.
+The texts are compressed in blocks, and a block is only decompressed when one of its texts is read.
+
+    MAGIC | version (1 byte) | header length (4 bytes) | compressed header | columns | text blocks
+'''
+from array import array
+import json
+import struct
+import sys
+import zlib
+from typing import Dict, List, Optional, Sequence
+
+MAGIC = b"OTS"
+FORMAT_VERSION = 1
+PREFIX = struct.Struct("<3sBI")
+COMPRESSION_LEVEL = 6
+
+
+class RecordFormatException(ValueError):
+    '''The bytes are not a record this version of the code can read.'''
+
+
+def _column_bytes(values: Sequence[float]) -> bytes:
+    column = array('d', values)
+    if sys.byteorder == 'big':
+        column.byteswap()
+    # Times are mostly whole or short decimals, so their doubles compress well.
+    return zlib.compress(column.tobytes(), COMPRESSION_LEVEL)
+
+
+def pack_record(kind: str, fields: Dict, columns: Optional[Dict[str, Sequence[float]]] = None,
+                texts: Sequence[Optional[str]] = (), texts_per_block: int = 1) -> bytes:
+    '''Packs the parts of a record into bytes. fields must be JSON serializable.'''
+    payload = bytearray()
+    column_index = {}
+    for name, values in (columns or {}).items():
+        data = _column_bytes(values)
+        column_index[name] = [len(payload), len(data)]
+        payload += data
+    blocks = []
+    for start in range(0, len(texts), texts_per_block):
+        block_texts = list(texts[start:start + texts_per_block])
+        data = zlib.compress(json.dumps(block_texts, ensure_ascii=False).encode('utf-8'), COMPRESSION_LEVEL)
+        blocks.append([len(payload), len(data), len(block_texts)])
+        payload += data
+    header = {"kind": kind, "fields": fields, "columns": column_index, "blocks": blocks}
+    header_bytes = zlib.compress(json.dumps(header, ensure_ascii=False).encode('utf-8'), COMPRESSION_LEVEL)
+    return PREFIX.pack(MAGIC, FORMAT_VERSION, len(header_bytes)) + header_bytes + bytes(payload)
+
+
+def is_record(data) -> bool:
+    return isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:len(MAGIC)]) == MAGIC
+
+
+class PackedRecord:
+    '''Reads a record made by pack_record(). Only the header is decoded up front.'''
+    def __init__(self, data: bytes):
+        if not is_record(data) or len(data) < PREFIX.size:
+            raise RecordFormatException("Not a state cache record.")
+        _, version, header_length = PREFIX.unpack_from(data)
+        if version != FORMAT_VERSION:
+            raise RecordFormatException(f"Record format version {version} is not supported (expected {FORMAT_VERSION}).")
+        header_end = PREFIX.size + header_length
+        header = json.loads(zlib.decompress(data[PREFIX.size:header_end]))
+        self._data = data
+        self._payload = memoryview(data)[header_end:]
+        self.kind: str = header["kind"]
+        self.fields: Dict = header["fields"]
+        self._columns = header["columns"]
+        self._blocks = header["blocks"]
+        self._decoded_blocks = {}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def num_texts(self) -> int:
+        return sum(block[2] for block in self._blocks)
+
+    def column(self, name: str) -> List[float]:
+        offset, length = self._columns[name]
+        column = array('d')
+        column.frombytes(zlib.decompress(self._payload[offset:offset + length]))
+        if sys.byteorder == 'big':
+            column.byteswap()
+        return column.tolist()
+
+    def text(self, index: int) -> Optional[str]:
+        '''Decompresses only the block the text is in.'''
+        for block_index, (_, _, num_texts) in enumerate(self._blocks):
+            if index < num_texts:
+                return self._block(block_index)[index]
+            index -= num_texts
+        raise IndexError("Text index out of range.")
+
+    def texts(self) -> List[Optional[str]]:
+        texts = []
+        for block_index in range(len(self._blocks)):
+            texts.extend(self._block(block_index))
+        return texts
+
+    def _block(self, block_index: int) -> List[Optional[str]]:
+        if block_index not in self._decoded_blocks:
+            offset, length, _ = self._blocks[block_index]
+            self._decoded_blocks[block_index] = json.loads(zlib.decompress(self._payload[offset:offset + length]))
+        return self._decoded_blocks[block_index]
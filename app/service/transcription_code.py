@@ -18,59 +18,220 @@
 # Author: Margaret Johnson
 # Copyright (c) 2024 Margaret Johnson
 ###########################################################################################
+import asyncio
 import logging
+import os
+from typing import Awaitable, Callable, Iterable, Iterator, List, Optional, Tuple, Union
 
 import ctranslate2
+import numpy as np
 from faster_whisper import WhisperModel
 
 
 import app.logging_config
-from app.service.audio_processing_model import AudioProcessRequest
+from app.service.audio_processing_model import DECODING_PROFILES
 from app.service.exceptions_code import TranscriberException
 from app.service.message_queue_manager import MessageQueueManager
-from app.service.transcription_state_code import Chapter
+from app.service.pcm_cache_code import PCM_DTYPE, PCM_SAMPLE_RATE, PCMStream, open_pcm_stream
+from app.service.progress_aggregator_code import ProgressAggregator
+from app.service.transcription_state_code import Chapter, TranscriptSegment
 from app.service.utils import send_sse_message
 
 # Create a logger instance for this module
 logger = logging.getLogger(__name__)
 
+# The audio is given to Whisper this many seconds at a time (about 38 MB of samples for 10 minutes), so memory doesn't
+# grow with the length of the audio. 0 gives Whisper the whole file at once.
+TRANSCRIBE_WINDOW_SECONDS = int(os.environ.get("TRANSCRIBE_WINDOW_SECONDS", 600))
+# A window ends at the quietest moment of its last few seconds, so that a word isn't cut in two.
+WINDOW_SPLIT_SEARCH_SECONDS = 5
+WINDOW_SPLIT_FRAME = PCM_SAMPLE_RATE // 10
+
+
+def audio_windows(chunks: Iterable[np.ndarray], window_samples: int, search_samples: int) -> Iterator[Tuple[float, np.ndarray]]:
+    '''Groups chunks of 16 kHz samples into windows of at most window_samples. Yields the offset of each window in
+    seconds and its samples. What comes after a window's split point starts the next window.'''
+    search_samples = min(search_samples, window_samples // 2)
+    buffer = np.empty(window_samples, dtype=PCM_DTYPE)
+    filled = 0
+    # The number of samples before the buffer.
+    offset = 0
+    try:
+        for chunk in chunks:
+            position = 0
+            while position < len(chunk):
+                take = min(window_samples - filled, len(chunk) - position)
+                buffer[filled:filled + take] = chunk[position:position + take]
+                filled += take
+                position += take
+                if filled == window_samples:
+                    split = _quiet_split(buffer, search_samples)
+                    # The window that is yielded keeps its buffer. A new one is started with the rest.
+                    next_buffer = np.empty(window_samples, dtype=PCM_DTYPE)
+                    filled = window_samples - split
+                    next_buffer[:filled] = buffer[split:]
+                    yield offset / PCM_SAMPLE_RATE, buffer[:split]
+                    offset += split
+                    buffer = next_buffer
+        if filled:
+            yield offset / PCM_SAMPLE_RATE, buffer[:filled]
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def _quiet_split(window: np.ndarray, search_samples: int) -> int:
+    # The middle of the 100 ms frame with the least energy in the last search_samples of the window.
+    num_frames = search_samples // WINDOW_SPLIT_FRAME
+    if num_frames == 0:
+        return len(window)
+    search_start = len(window) - num_frames * WINDOW_SPLIT_FRAME
+    frames = window[search_start:].reshape(num_frames, WINDOW_SPLIT_FRAME)
+    quietest = int(np.argmin(np.square(frames).mean(axis=1)))
+    return search_start + quietest * WINDOW_SPLIT_FRAME + WINDOW_SPLIT_FRAME // 2
+
+
+async def _wait_for_read(read: asyncio.Future, audio) -> None:
+    # The generator that is being read can't be closed ("generator already executing") until the read returns.
+    if isinstance(audio, PCMStream):
+        audio.stop_reading()
+    while not read.done():
+        try:
+            await asyncio.shield(read)
+        except asyncio.CancelledError:
+            # Cancelled again while waiting. The read still has to finish.
+            continue
+        except Exception:
+            # The exception that stopped the transcription is the one raised.
+            break
+
+
 class TranscribeAudio:
-    def __init__(self, audio_quality:str="default", compute_type:str="int8", chapter_chunk_time:int=10):
+    def __init__(self, audio_quality:str="default", compute_type:str="int8", chapter_chunk_time:int=10, decoding_profile:str="default",
+                 window_seconds: int = TRANSCRIBE_WINDOW_SECONDS):
+        self.audio_quality = audio_quality
+        self.compute_type = compute_type
         self.chapter_chunk_time = chapter_chunk_time
-        # Load the model
+        self.window_seconds = window_seconds
+        self.decoding_options = DECODING_PROFILES[decoding_profile]
+        self._model = None
+
+    @property
+    def model(self) -> WhisperModel:
+        # The model is loaded the first time there is audio to transcribe. Chapters can be made from cached segments without it.
+        if self._model is None:
+            self._model = self._load_model()
+        return self._model
+
+    def _load_model(self) -> WhisperModel:
         try:
             # Check CUDA availability first
             cuda_available = ctranslate2.get_cuda_device_count() > 0
             device = "cuda" if cuda_available else "cpu"
 
             # Create the model with the correct device string
-            self.model = WhisperModel(audio_quality, device=device, compute_type=compute_type)
+            model = WhisperModel(self.audio_quality, device=device, compute_type=self.compute_type)
             logger.debug(f"Model loaded successfully on {device}")
+            return model
         except Exception as e:
             logger.error(f"Error loading model. {e}")
             raise TranscriberException(f"Error loading model. {e}")
 
-    async def transcribe(self, queue: MessageQueueManager, audio: str, state_chapters: list[Chapter] = None) -> str:
+    async def transcribe(self, queue: MessageQueueManager, audio: Union[str, np.ndarray, PCMStream], state_chapters: list[Chapter] = None) -> List[Chapter]:
+        segments, total_duration = await self.transcribe_segments(queue, audio)
+        return self.make_chapters(segments, total_duration, state_chapters)
+
+    async def transcribe_segments(self, queue: MessageQueueManager, audio: Union[str, np.ndarray, PCMStream],
+                                  on_window: Optional[Callable[[List[TranscriptSegment]], Awaitable[None]]] = None) -> Tuple[List[TranscriptSegment], float]:
+        '''Runs Whisper over the audio. Returns the segments and the duration of the audio after VAD. The audio is a
+        path, 16 kHz mono samples or a PCMStream (see PCMCache.stream()). With window_seconds set, it is read and
+        transcribed a window at a time. on_window(segments) is awaited with the segments so far each time a window is done.'''
         # whisper is not thread safe.  It does not like to reuse a loaded model.
-        logging.info(f"--->Start Transcription for {audio}")
+        if isinstance(audio, str):
+            audio_name = audio
+        elif isinstance(audio, np.ndarray):
+            audio_name = f"{len(audio) / PCM_SAMPLE_RATE:.1f} seconds of decoded audio"
+        else:
+            audio_name = "streamed audio"
+        logging.info(f"--->Start Transcription for {audio_name}")
 
-        # Returns a generator
-        segments, info = self.model.transcribe(audio, beam_size=5)
-        total_duration = info.duration_after_vad
-        await send_sse_message(queue, "status", f"Content length:  {total_duration:.1f} seconds.")
+        if self.window_seconds:
+            if isinstance(audio, str):
+                audio = open_pcm_stream(audio)
+            elif isinstance(audio, np.ndarray):
+                audio = PCMStream(iter([audio]), len(audio) / PCM_SAMPLE_RATE)
+            expected_duration = audio.duration
+            windows = audio_windows(audio, self.window_seconds * PCM_SAMPLE_RATE, WINDOW_SPLIT_SEARCH_SECONDS * PCM_SAMPLE_RATE)
+        else:
+            if isinstance(audio, PCMStream):
+                audio = np.concatenate(list(audio))
+            expected_duration = None
+            windows = iter([(0.0, audio)])
+        if expected_duration:
+            await send_sse_message(queue, "status", f"Content length:  {expected_duration:.1f} seconds.")
+        # The percent transcribed is reported through the aggregator so the client gets a steady trickle of updates.
+        progress = ProgressAggregator(queue)
+        results = []
+        total_duration = 0.0
+        read = None
+        try:
+            while True:
+                # Reading the next window decodes it, off the event loop. The read is shielded: a thread can't be stopped,
+                # so a cancel waits for it below instead of leaving it running on the generator.
+                read = asyncio.ensure_future(asyncio.to_thread(next, windows, None))
+                window = await asyncio.shield(read)
+                read = None
+                if window is None:
+                    break
+                offset, samples = window
+                # Returns a generator
+                segments, info = self.model.transcribe(samples, **self._window_options(results))
+                total_duration += info.duration_after_vad
+                if not expected_duration:
+                    expected_duration = info.duration
+                    await send_sse_message(queue, "status", f"Content length:  {expected_duration:.1f} seconds.")
+                for segment in segments:
+                    start, end = segment.start + offset, segment.end + offset
+                    logger.debug("[%.2fs -> %.2fs] %s" % (start, end, segment.text))
+                    results.append(TranscriptSegment(start=start, end=end, text=segment.text))
+                    if expected_duration:
+                        await progress.update(f"Transcribed {min(100, round((end / expected_duration) * 100))}%")
+                if on_window:
+                    await on_window(results)
+        finally:
+            if read is not None:
+                await _wait_for_read(read, audio)
+            if hasattr(windows, "close"):
+                windows.close()
+        await progress.flush()
         logger.debug(f"total_duration: {total_duration:.1f} seconds")
-        chapters = await self.break_audio_into_chapters(queue, segments, total_duration, state_chapters)
-        logger.info(f"<---Done transcribing {audio}. Duration: {total_duration:.1f} seconds.  {len(chapters)} chapters.")
+        logger.info(f"<---Done transcribing {audio_name}. Duration: {total_duration:.1f} seconds.  {len(results)} segments.")
+        return results, total_duration
+
+    def _window_options(self, results: List[TranscriptSegment]) -> dict:
+        options = dict(self.decoding_options)
+        if results and "initial_prompt" not in options:
+            # Whisper conditions each 30 seconds on the text before it. A new window starts without that text, so the end
+            # of the previous window is given as the prompt. faster-whisper trims it to the length the model takes.
+            options["initial_prompt"] = " ".join(segment.text.strip() for segment in results[-3:])
+        return options
+
+    def make_chapters(self, segments: List[TranscriptSegment], total_duration: float, state_chapters: list[Chapter]) -> List[Chapter]:
+        '''Groups the segments into chapters. Only the grouping depends on chapter_chunk_time, so chapters can be
+        made again from cached segments without running Whisper.'''
+        # The chapter methods consume the segments as a stream, the way they come out of Whisper.
+        chapters = self.break_audio_into_chapters(iter(segments), total_duration, state_chapters)
+        logger.info(f"{len(segments)} segments grouped into {len(chapters)} chapters.")
         return chapters
 
-    async def break_audio_into_chapters(self, queue, segments, total_duration, state_chapters):
+    def break_audio_into_chapters(self, segments, total_duration, state_chapters):
         chapter_duration = self.chapter_chunk_time * 60   # in seconds
         if self._is_short_audio(state_chapters, total_duration, chapter_duration):
             return self._create_single_chapter(segments)
         if self._is_broken_into_chapters(state_chapters):
-            return await self._create_chapters_from_metadata(queue, segments, state_chapters, total_duration)
+            return self._create_chapters_from_metadata(segments, state_chapters, total_duration)
         else:
-            return await self._create_time_based_chapters(queue, segments, chapter_duration, total_duration)
+            return self._create_time_based_chapters(segments, chapter_duration, total_duration)
 
     def _is_short_audio(self, state_chapters, total_duration, chapter_duration):
         if self._is_broken_into_chapters(state_chapters) or total_duration > chapter_duration:
@@ -89,7 +250,7 @@ class TranscribeAudio:
         chapter = Chapter(start_time=round(results[0].start, 2), end_time=round(results[-1].end, 2), text=text, number=1)
         return [chapter]
 
-    async def _create_time_based_chapters(self, queue, segments, chapter_duration, total_duration):
+    def _create_time_based_chapters(self, segments, chapter_duration, total_duration):
         # Start a new chapter
         chapters = []
         new_end_time = chapter_duration
@@ -97,7 +258,6 @@ class TranscribeAudio:
         chapter_number = 1
         # Go through the generator
         for segment in segments:
-            logger.debug("[%.2fs -> %.2fs] %s" % (segment.start, segment.end, segment.text))
             if segment.start >= new_end_time:
                 # We've reached the end of a timed chapter. Append it to the list.
                 chapters.append(current_chapter)
@@ -106,8 +266,6 @@ class TranscribeAudio:
                 chapter_number += 1
                 current_chapter = Chapter(start_time=segment.start, end_time=0.0, text='', number=chapter_number)
                 new_end_time = segment.end + chapter_duration
-                percent_complete = round((segment.end / total_duration) * 100)
-                await send_sse_message(queue, "status", f"Transcribed {percent_complete}%")
 
             else:
                 # Add the text to the current chapter
@@ -121,7 +279,7 @@ class TranscribeAudio:
 
         return chapters
 
-    async def _create_chapters_from_metadata(self, queue, segments, state_chapters, total_duration):
+    def _create_chapters_from_metadata(self, segments, state_chapters, total_duration):
         for index, chapter in enumerate(state_chapters):
             logger.debug(f"Chapter {index}: {chapter.start_time} -> {chapter.end_time}")
             chapter_segments = []
@@ -136,8 +294,6 @@ class TranscribeAudio:
                     # We need to set the start of the next chapter to the end of the segment.
                     if index+1 < len(state_chapters):
                         state_chapters[index+1].start_time = end_time
-                    percent_complete = round((segment.end / total_duration) * 100)
-                    await send_sse_message(queue,"status", f"Transcribed {percent_complete}%")
                     break
                 # If the start time of the segment is within the start and end times of a chapter, add the segments to the
                 # chapter_segments list.
@@ -18,57 +18,124 @@
 # Author: Margaret Johnson
 # Copyright (c) 2024 Margaret Johnson
 ###########################################################################################
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import logging
 import os
+import threading
 import time
-from typing import Optional, List, Tuple, Dict
+from typing import Callable, NamedTuple, Optional, List, Set, Tuple, Dict
 
 # Using the diskcache library to cache transcription results in case
 # multiple requests are made for the same content.
-from diskcache import Cache
-from pydantic import BaseModel, Field, field_validator, ConfigDict
+from diskcache import EVICTION_POLICY, Cache, FanoutCache
+from pydantic import BaseModel, Field, PrivateAttr, computed_field, field_validator, model_validator, ConfigDict
 # logging_config is used to configure the logging for the application.
 import app.logging_config
-from app.service.exceptions_code import KeyException, MetadataExtractionException
+from app.service.exceptions_code import KeyException
+from app.service.lru_cache_code import LRU_CACHE_MAX_BYTES, LRUCache
 from app.service.metadata_extractor_code import MetadataExtractor
+from app.service.metadata_probe_code import check_duration
 from app.service.metadata_shared_code import Metadata, build_metadata_instance
 from app.service.message_queue_manager import MessageQueueManager
-from app.service.audio_processing_model import AudioProcessRequest
+from app.service.progressive_download_code import ProgressiveDownload
+from app.service.youtube_handler_code import sanitize_title
+from app.service.record_codec_code import PackedRecord, RecordFormatException, is_record, pack_record
+from app.service.captions_code import CAPTIONS_MODEL
+from app.service.audio_processing_model import AUDIO_QUALITY_MAP, QUALITY_LADDER, AudioProcessRequest, quality_rank
 from app.service.utils import send_sse_message, format_time
 
 
 # Create a logger instance for this module
 logger = logging.getLogger(__name__)
 
-from typing import Dict,List, Optional
-import time
-from typing import Optional, List, Tuple, Dict
-
-# Using the diskcache library to cache transcription results in case
-# multiple requests are made for the same content.
-from diskcache import Cache
-from pydantic import BaseModel, Field, field_validator, ConfigDict
-# logging_config is used to configure the logging for the application.
-import app.logging_config
-from app.service.exceptions_code import KeyException, MetadataExtractionException
-from app.service.metadata_extractor_code import MetadataExtractor
-from app.service.metadata_shared_code import Metadata, build_metadata_instance
-from app.service.audio_processing_model import AudioProcessRequest
-from app.service.utils import send_sse_message, format_time
-
-
-# Create a logger instance for this module
-logger = logging.getLogger(__name__)
-
-from typing import Dict,List, Optional
-from pydantic import BaseModel, Field
+# The version of the keys make_key() creates. Version 2 keys YouTube content by video ID instead of by URL.
+# Version 3 stores the entries packed by record_codec_code instead of as pickled models. Version 4 splits each entry
+# into the records made by encode_records().
+KEY_VERSION = 4
+# Where the cache records the version of its keys.
+KEY_VERSION_KEY = "__key_version__"
+YOUTUBE_KEY_PREFIX = "youtube:"
+SEGMENTS_KEY_PREFIX = "segments:"
+# Record kinds of the state cache.
+STATE_META_RECORD = "state-meta"
+CHAPTER_RECORD = "chapter"
+SEGMENTS_META_RECORD = "segments-meta"
+SEGMENT_BLOCK_RECORD = "segment-block"
+# A whole state or all the segments in one record (key version 3). Still read, no longer written.
+STATE_RECORD = "state"
+SEGMENTS_RECORD = "segments"
+# Separates the key of a state from the suffix of its chapter and segment block records.
+SUB_RECORD_SEPARATOR = "#"
+# Segment texts are short. Compressing them in blocks compresses better than one at a time.
+SEGMENTS_PER_BLOCK = 256
+# The number of SQLite databases the state cache is spread over. A key always goes to the same shard (by the hash of the
+# key), so changing this orphans the cached entries.
+STATE_CACHE_SHARDS = 8
+# Seconds a shard waits for another process's write before it gives up and retries.
+STATE_CACHE_TIMEOUT = 1.0
+# How big the diskcache may get (in bytes) before entries are evicted, and which ones are evicted first: one of
+# least-recently-stored (the diskcache default), least-recently-used, least-frequently-used or none.
+STATE_CACHE_SIZE_LIMIT = int(os.environ.get("STATE_CACHE_SIZE_LIMIT", 2 ** 30))
+STATE_CACHE_EVICTION_POLICY = os.environ.get("STATE_CACHE_EVICTION_POLICY", "least-recently-stored")
+# Seconds an entry is kept after it was written. Unset keeps entries until they are evicted.
+STATE_CACHE_TTL = float(os.environ["STATE_CACHE_TTL"]) if os.environ.get("STATE_CACHE_TTL") else None
+# The number of records written between culls of the diskcache. A cull queries every shard, so it isn't done on each write.
+STATE_CACHE_CULL_EVERY = int(os.environ.get("STATE_CACHE_CULL_EVERY", 32))
+# The memory budget of the in-memory tier in front of the diskcache.
+STATE_MEMORY_CACHE_BYTES = int(os.environ.get("STATE_MEMORY_CACHE_BYTES", LRU_CACHE_MAX_BYTES))
+# The threads the async methods of TranscriptionStates read and write the diskcache on.
+STATE_IO_WORKERS = 4
 
 class Chapter(BaseModel):
     title: Optional[str] = Field(default='', description="Title of the chapter.")
     start_time: float = Field(..., description="Start time of the chapter in seconds.")
     end_time: float = Field(..., description="End time of the chapter in seconds.")
-    text: Optional[str] = Field(default=None, description="Transcription of the chapter.")
     number: Optional[int] = Field(default=None, description="Chapter number.")
+    # The text is kept outside the fields. A chapter read from the state cache holds its packed chapter record instead,
+    # and the text is only decompressed when it is first read, so e.g. checking that a cached state is complete, or
+    # resending its metadata, doesn't decompress the whole transcript.
+    _text: Optional[str] = PrivateAttr(default=None)
+    _packed_text: Optional[bytes] = PrivateAttr(default=None)
+
+    @model_validator(mode="wrap")
+    @classmethod
+    def _take_text(cls, data, handler):
+        text = data.get("text") if isinstance(data, dict) else None
+        chapter = handler(data)
+        if text is not None:
+            chapter._text = text
+        return chapter
+
+    @computed_field(description="Transcription of the chapter.")
+    @property
+    def text(self) -> Optional[str]:
+        packed_text = self._packed_text
+        if packed_text is not None:
+            # The text is set before the record is let go, so another thread reading the text sees one or the other.
+            self._text = PackedRecord(packed_text).text(0)
+            self._packed_text = None
+        return self._text
+
+    @text.setter
+    def text(self, text: Optional[str]) -> None:
+        self._text = text
+        self._packed_text = None
+
+    def set_packed_text(self, data: bytes) -> None:
+        '''The text is the first text of the chapter record data, decompressed when it is first read.'''
+        self._packed_text = data
+
+    def has_text(self) -> bool:
+        '''Whether the chapter has text, without decompressing it.'''
+        return self._packed_text is not None or bool(self._text)
+
+    @property
+    def text_size(self) -> int:
+        '''What the text takes in memory. Until it is read, that is the compressed record.'''
+        packed_text = self._packed_text
+        return len(packed_text) if packed_text is not None else len(self._text or "")
 
     def to_dict_with_start_end_strings(self) -> dict:
         '''Used to return a dictionary with straing formated start and end times.'''
@@ -80,6 +147,28 @@ class Chapter(BaseModel):
             "number": self.number
         }
 
+class TranscriptSegment(NamedTuple):
+    # The part of a faster-whisper Segment the chapters are made from.
+    start: float
+    end: float
+    text: str
+
+class TranscriptSegments(BaseModel):
+    '''The Whisper output for a piece of audio, before it is grouped into chapters. Cached so that a request that only
+    differs in chapter_chunk_time can build its chapters without downloading or transcribing the audio again. A YouTube
+    video's own captions are kept the same way, one cue per segment (see make_captions_key()).'''
+    key: str = Field(..., description="The key made by make_segments_key() or make_captions_key().")
+    basename: str = Field(..., description="The basename of the state the segments were transcribed for.")
+    metadata: Metadata = Field(..., description="The metadata of the audio at the time it was transcribed.")
+    chapter_dicts: List[Dict] = Field(default_factory=list, description="The chapters of the audio source (e.g. YouTube chapters) before transcription.")
+    duration: float = Field(..., description="Duration of the audio after VAD, as reported by Whisper.")
+    segments: List[TranscriptSegment] = Field(default_factory=list, description="The transcribed segments in order.")
+
+    @property
+    def transcription_model(self) -> str:
+        '''The model the segments were transcribed with, or CAPTIONS_MODEL for captions.'''
+        return self.metadata.transcription_model or self.metadata.audio_input.audio_quality
+
 def build_chapters(chapter_dicts: List[Dict]) -> List[Chapter]:
     chapters = []
     try:
@@ -136,7 +225,7 @@ class TranscriptionState(BaseModel):
             return False
         # Additionally, check that each chapter has transcription_text filled out
         for chapter in self.chapters:
-            if not chapter.text:
+            if not chapter.has_text():
                 return False
         return True
 
@@ -150,40 +239,552 @@ class TranscriptionState(BaseModel):
         self.transcript_done = False
 
 
+def chapter_record_key(key: str, index: int) -> str:
+    return f"{key}{SUB_RECORD_SEPARATOR}chapter:{index}"
+
+def segment_block_key(key: str, index: int) -> str:
+    return f"{key}{SUB_RECORD_SEPARATOR}block:{index}"
+
+def is_sub_record_key(key: str) -> bool:
+    return SUB_RECORD_SEPARATOR in key
+
+def _encode_metadata(metadata: Optional[Metadata]) -> Optional[Dict]:
+    return metadata.model_dump(mode="json") if metadata else None
+
+def encode_state_meta(state: TranscriptionState) -> bytes:
+    fields = {"key": state.key, "basename": state.basename, "metadata": _encode_metadata(state.metadata),
+              "chapters": [{"title": chapter.title, "number": chapter.number} for chapter in state.chapters]}
+    columns = {"start_time": [chapter.start_time for chapter in state.chapters],
+               "end_time": [chapter.end_time for chapter in state.chapters]}
+    return pack_record(STATE_META_RECORD, fields, columns)
+
+def encode_chapter(chapter: Chapter) -> bytes:
+    return pack_record(CHAPTER_RECORD, {}, texts=[chapter.text])
+
+def encode_segments_meta(transcript_segments: TranscriptSegments) -> bytes:
+    fields = {"key": transcript_segments.key, "basename": transcript_segments.basename,
+              "metadata": _encode_metadata(transcript_segments.metadata), "chapter_dicts": transcript_segments.chapter_dicts,
+              "duration": transcript_segments.duration, "num_blocks": num_segment_blocks(len(transcript_segments.segments))}
+    return pack_record(SEGMENTS_META_RECORD, fields)
+
+def encode_segment_block(segments: List[TranscriptSegment]) -> bytes:
+    columns = {"start": [segment.start for segment in segments], "end": [segment.end for segment in segments]}
+    return pack_record(SEGMENT_BLOCK_RECORD, {}, columns, [segment.text for segment in segments], texts_per_block=SEGMENTS_PER_BLOCK)
+
+def num_segment_blocks(num_segments: int) -> int:
+    return -(-num_segments // SEGMENTS_PER_BLOCK)
+
+def encode_records(value: BaseModel) -> Dict[str, bytes]:
+    '''Packs a TranscriptionState or TranscriptSegments into the records the state cache stores, by key. Only plain
+    values are stored (no pickled classes), so renaming or moving the models doesn't invalidate the cache.
+
+    The metadata and the chapter boundaries are one record, and the text of each chapter (or each block of
+    SEGMENTS_PER_BLOCK segments) is another, so a part can be written without rewriting the rest. The meta record
+    is returned last. Written last, it is what makes the other records visible.'''
+    records = {}
+    if isinstance(value, TranscriptionState):
+        for index, chapter in enumerate(value.chapters):
+            # A chapter without text (e.g. the state before transcription) has nothing to store.
+            if chapter.has_text():
+                records[chapter_record_key(value.key, index)] = encode_chapter(chapter)
+        records[value.key] = encode_state_meta(value)
+    elif isinstance(value, TranscriptSegments):
+        for index in range(num_segment_blocks(len(value.segments))):
+            block = value.segments[index * SEGMENTS_PER_BLOCK:(index + 1) * SEGMENTS_PER_BLOCK]
+            records[segment_block_key(value.key, index)] = encode_segment_block(block)
+        records[value.key] = encode_segments_meta(value)
+    else:
+        raise ValueError(f"Can't encode a {type(value).__name__} for the state cache.")
+    return records
+
+def record_keys(value: BaseModel) -> List[str]:
+    '''The keys of the records encode_records() stores for value, without packing them.'''
+    if isinstance(value, TranscriptionState):
+        keys = [chapter_record_key(value.key, index) for index, chapter in enumerate(value.chapters) if chapter.has_text()]
+    else:
+        keys = [segment_block_key(value.key, index) for index in range(num_segment_blocks(len(value.segments)))]
+    return keys + [value.key]
+
+def _decode_metadata(metadata: Optional[Dict]) -> Optional[Metadata]:
+    if metadata is None:
+        return None
+    audio_input = metadata.get("audio_input")
+    if audio_input is not None:
+        # The request was validated when it came in. Validating it again would e.g. turn an audio_quality of "default"
+        # into the model name, and the keys made from it would change.
+        audio_input = AudioProcessRequest.model_construct(**audio_input)
+    return Metadata(**{**metadata, "audio_input": audio_input})
+
+def decode_records(data: bytes, read: Callable[[str], Optional[bytes]]) -> Optional[BaseModel]:
+    '''Unpacks the meta record data and the records it refers to, which are fetched with read(key). Returns None if
+    segment blocks are missing (e.g. evicted). Missing chapter text leaves the state incomplete. The text of a chapter
+    is decompressed when it is first read.'''
+    record = PackedRecord(data)
+    fields = record.fields
+    metadata = _decode_metadata(fields["metadata"])
+    if record.kind == STATE_META_RECORD:
+        state = _build_state(fields, metadata, record.column("start_time"), record.column("end_time"), [None] * len(fields["chapters"]))
+        for index, chapter in enumerate(state.chapters):
+            chapter_data = read(chapter_record_key(fields["key"], index))
+            if chapter_data is not None:
+                # The header is checked now, so a record that can't be read is a cache miss rather than an error later.
+                PackedRecord(chapter_data)
+                chapter.set_packed_text(chapter_data)
+        return state
+    if record.kind == SEGMENTS_META_RECORD:
+        segments = []
+        for index in range(fields["num_blocks"]):
+            block_data = read(segment_block_key(fields["key"], index))
+            if block_data is None:
+                return None
+            block = PackedRecord(block_data)
+            segments.extend(TranscriptSegment(start, end, text) for start, end, text in zip(block.column("start"), block.column("end"), block.texts()))
+        return _build_segments(fields, metadata, segments)
+    if record.kind == STATE_RECORD:
+        # A whole state in one record, as written before the records were split. migrate_keys() splits them.
+        return _build_state(fields, metadata, record.column("start_time"), record.column("end_time"), record.texts())
+    if record.kind == SEGMENTS_RECORD:
+        segments = [TranscriptSegment(start, end, text) for start, end, text in zip(record.column("start"), record.column("end"), record.texts())]
+        return _build_segments(fields, metadata, segments)
+    raise RecordFormatException(f"Unknown record kind: {record.kind}")
+
+def upgrade_pickled(value: BaseModel) -> BaseModel:
+    '''Entries written before the record format are pickled models. Unpickling doesn't validate, so a model pickled by
+    an older version only has the fields it had then (e.g. no audio_hash or use_captions). Builds it again from those,
+    with the defaults of the fields added since.'''
+    if isinstance(value, TranscriptionState):
+        fields = _pickled_fields(value)
+        chapters = [Chapter(**chapter) for chapter in fields.get("chapters") or []]
+        return TranscriptionState(key=fields["key"], basename=fields["basename"], metadata=_decode_metadata(fields.get("metadata")), chapters=chapters)
+    if isinstance(value, TranscriptSegments):
+        fields = _pickled_fields(value)
+        return _build_segments(fields, _decode_metadata(fields.get("metadata")), fields.get("segments") or [])
+    return value
+
+def _pickled_fields(value):
+    # What was pickled, as plain values. The attributes of the models are read from __dict__, which is all unpickling sets.
+    if isinstance(value, BaseModel):
+        fields = {name: _pickled_fields(field) for name, field in value.__dict__.items()}
+        if isinstance(value, Chapter) and "text" not in fields and value.__pydantic_private__:
+            # Since the text left the fields of Chapter, it is a private attribute.
+            fields["text"] = value.text
+        return fields
+    if isinstance(value, list):
+        return [_pickled_fields(item) for item in value]
+    return value
+
+def _build_state(fields: Dict, metadata: Optional[Metadata], start_times: List[float], end_times: List[float], texts: List[Optional[str]]) -> TranscriptionState:
+    chapters = [Chapter(title=chapter["title"], number=chapter["number"], start_time=start_time, end_time=end_time, text=text)
+                for chapter, start_time, end_time, text in zip(fields["chapters"], start_times, end_times, texts)]
+    return TranscriptionState(key=fields["key"], basename=fields["basename"], metadata=metadata, chapters=chapters)
+
+def _build_segments(fields: Dict, metadata: Optional[Metadata], segments: List[TranscriptSegment]) -> TranscriptSegments:
+    # The segments were validated when they were cached. Validating thousands of them again is most of the decode time.
+    return TranscriptSegments.model_construct(key=fields["key"], basename=fields["basename"], metadata=metadata,
+                                              chapter_dicts=fields["chapter_dicts"], duration=fields["duration"], segments=segments)
+
 class TranscriptionStates:
     # Manages a collection of multiple TranscriptionState instances.
-    def __init__(self, cache_dir: str = 'state_cache'):
-        # Default eviction policy is LRU
-        # Default max size is 1 GB
-        # (see https://github.com/grantjenks/python-diskcache/blob/ebfa37cd99d7ef716ec452ad8af4b4276a8e2233/diskcache/core.py#L48)
+    def __init__(self, cache_dir: str = 'state_cache', size_limit: int = STATE_CACHE_SIZE_LIMIT,
+                 eviction_policy: str = STATE_CACHE_EVICTION_POLICY, ttl: Optional[float] = STATE_CACHE_TTL,
+                 memory_max_bytes: int = STATE_MEMORY_CACHE_BYTES, cull_every: int = STATE_CACHE_CULL_EVERY):
+        # The eviction policies are described at https://grantjenks.com/docs/diskcache/tutorial.html#eviction-policies
+        if eviction_policy not in EVICTION_POLICY:
+            raise ValueError(f"Unknown eviction policy {eviction_policy}. Use one of: {', '.join(EVICTION_POLICY)}.")
         # The directory where the cache will be stored is passed in.
-        self.cache = Cache(cache_dir)
-
-    def add_state(self, transcription_state: TranscriptionState):
+        # Each shard is its own SQLite database with its own write lock, so jobs finishing at the same time in different
+        # processes don't wait on each other unless their keys land in the same shard.
+        # diskcache culls a few entries on each write without saying how many. With cull_limit=0 the culling is done
+        # by cull(), every cull_every writes, which counts the expired and the evicted entries.
+        self.cache_dir = cache_dir
+        self.size_limit = size_limit
+        self.eviction_policy = eviction_policy
+        self.ttl = ttl
+        self.cull_every = cull_every
+        self.cache = FanoutCache(cache_dir, shards=STATE_CACHE_SHARDS, timeout=STATE_CACHE_TIMEOUT, size_limit=size_limit,
+                                 eviction_policy=eviction_policy, cull_limit=0)
+        # The counters are changed by the threads of _executor.
+        self._lock = threading.Lock()
+        self.disk_hits = 0
+        self.disk_misses = 0
+        self.disk_expirations = 0
+        self.disk_evictions = 0
+        self._writes_since_cull = 0
+        # Hot states and segments, already unpickled. Every read from diskcache unpickles the whole transcript.
+        # Writes go to both, and an entry leaves memory when it expires or is evicted from disk, so the two never disagree.
+        self.memory = LRUCache(max_bytes=memory_max_bytes)
+        # SQLite calls, packing and unpacking take long enough with big transcripts to hold up the event loop
+        # (e.g. the delivery of SSE messages to other clients). The async methods run them here.
+        self._executor = ThreadPoolExecutor(max_workers=STATE_IO_WORKERS, thread_name_prefix="state-cache")
+
+    def add_state(self, transcription_state: TranscriptionState, num_chapters_written: int = 0):
+        '''Stores the state. The text of the first num_chapters_written chapters is skipped; it was stored with add_chapter().'''
         if not isinstance(transcription_state, TranscriptionState):
             raise ValueError("transcription_state must be an instance of TranscriptionState.")
-        self.cache[transcription_state.key] = transcription_state
+        skip = {chapter_record_key(transcription_state.key, index) for index in range(num_chapters_written)}
+        self._put(transcription_state.key, transcription_state, skip)
 
     def delete_state(self, key: str):
-        if key in self.cache:
-            del self.cache[key]
+        self.memory.invalidate(key)
+        if self._delete_records(key):
             logger.info(f"Deleted state with key: {key}")
         else:
             logger.warning(f"Key not found: {key}")
 
+    def add_chapter(self, key: str, index: int, chapter: Chapter):
+        '''Stores the text of one chapter of a state that has been added. Only the chapter is written.'''
+        self.memory.invalidate(key)
+        if not chapter.has_text():
+            # Nothing to store, the same as for add_state().
+            return
+        self._write(chapter_record_key(key, index), encode_chapter(chapter))
+
     def get_state(self, key: str) -> Optional[TranscriptionState]:
-        return self.cache.get(key)
+        return self._get(key)
+
+    def add_segments(self, transcript_segments: TranscriptSegments, num_blocks_written: int = 0):
+        '''Stores the segments. The first num_blocks_written blocks are skipped; they were stored with add_segment_block().'''
+        skip = {segment_block_key(transcript_segments.key, index) for index in range(num_blocks_written)}
+        self._put(transcript_segments.key, transcript_segments, skip)
+
+    def add_segment_block(self, key: str, index: int, segments: List[TranscriptSegment]):
+        '''Stores SEGMENTS_PER_BLOCK segments while the rest are still being transcribed. The segments can't be read
+        until add_segments() stores their meta record.'''
+        self._write(segment_block_key(key, index), encode_segment_block(segments))
+
+    def get_segments(self, key: str) -> Optional[TranscriptSegments]:
+        return self._get(key)
+
+    def metrics(self) -> dict:
+        '''Counters kept by this process. Cheap enough for the health endpoint.'''
+        with self._lock:
+            lookups = self.disk_hits + self.disk_misses
+            disk = {
+                "hits": self.disk_hits,
+                "misses": self.disk_misses,
+                "hit_rate": self.disk_hits / lookups if lookups else 0.0,
+                "expirations": self.disk_expirations,
+                "evictions": self.disk_evictions,
+            }
+        return {"memory": self.memory.metrics(), "disk": disk}
+
+    def stats(self) -> dict:
+        '''metrics() plus the fill level of the diskcache, which takes a query per shard.'''
+        metrics = self.metrics()
+        volume = self.cache.volume()
+        metrics["disk"].update({
+            "entries": len(self.cache),
+            "volume": volume,
+            "size_limit": self.size_limit,
+            "fill": volume / self.size_limit if self.size_limit else 0.0,
+            "eviction_policy": self.eviction_policy,
+            "ttl": self.ttl,
+        })
+        return metrics
+
+    # The async versions are the ones to call from coroutines.
+    async def get_state_async(self, key: str) -> Optional[TranscriptionState]:
+        return await self._get_async(key)
+
+    async def add_state_async(self, transcription_state: TranscriptionState, num_chapters_written: int = 0):
+        await self._run(self.add_state, transcription_state, num_chapters_written)
+
+    async def add_chapter_async(self, key: str, index: int, chapter: Chapter):
+        await self._run(self.add_chapter, key, index, chapter)
+
+    async def delete_state_async(self, key: str):
+        await self._run(self.delete_state, key)
+
+    async def get_segments_async(self, key: str) -> Optional[TranscriptSegments]:
+        return await self._get_async(key)
+
+    async def add_segments_async(self, transcript_segments: TranscriptSegments, num_blocks_written: int = 0):
+        await self._run(self.add_segments, transcript_segments, num_blocks_written)
+
+    async def add_segment_block_async(self, key: str, index: int, segments: List[TranscriptSegment]):
+        await self._run(self.add_segment_block, key, index, segments)
+
+    async def find_segments_async(self, audio_input: AudioProcessRequest) -> Optional[TranscriptSegments]:
+        return await self._run(self.find_segments, audio_input)
+
+    async def stats_async(self) -> dict:
+        return await self._run(self.stats)
+
+    async def migrate_keys_async(self) -> int:
+        return await self._run(self.migrate_keys)
+
+    async def _run(self, func: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(func, *args))
+
+    async def _get_async(self, key: str) -> Optional[BaseModel]:
+        # A hit in memory doesn't need a thread.
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        return await self._run(self._load_and_remember, key)
+
+    def _put(self, key: str, value: BaseModel, skip: Set[str] = frozenset()):
+        # Taken before the records are written, so the copy in memory expires no later than they do.
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        self._store(value, skip)
+        if skip and expires_at is not None:
+            # The skipped records were written earlier and expire earlier. The next read takes their expiry from disk.
+            self.memory.invalidate(key)
+            return
+        # The caller keeps changing the instance it passed in (e.g. filling in the chapter text), so the memory tier
+        # gets its own copy. What is handed out by _get() is shared and must not be changed.
+        self.memory.put(key, value.model_copy(deep=True), expires_at)
+
+    def _get(self, key: str) -> Optional[BaseModel]:
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        return self._load_and_remember(key)
+
+    def _load_and_remember(self, key: str) -> Optional[BaseModel]:
+        value, expires_at = self._load_with_expiry(key)
+        if value is not None:
+            self.memory.put(key, value, expires_at)
+        return value
+
+    def _store(self, value: BaseModel, skip: Set[str] = frozenset()):
+        for key, data in encode_records(value).items():
+            if key not in skip:
+                self._write(key, data)
+
+    def _write(self, key: str, data: bytes):
+        self.cache.set(key, data, expire=self.ttl, retry=True)
+        with self._lock:
+            self._writes_since_cull += 1
+            cull_now = self._writes_since_cull >= self.cull_every
+            if cull_now:
+                self._writes_since_cull = 0
+        if cull_now:
+            self.cull()
+
+    def cull(self) -> Tuple[int, int]:
+        '''Removes the expired entries, then evicts by the eviction policy until the diskcache is under its size limit.
+        Returns the number of entries that expired and the number that were evicted. Called every cull_every writes.'''
+        num_expired = self.cache.expire(retry=True)
+        # cull() removes the expired entries first as well. There are next to none left by now.
+        num_evicted = self.cache.cull(retry=True)
+        with self._lock:
+            self.disk_expirations += num_expired
+            self.disk_evictions += num_evicted
+        if num_evicted:
+            self._forget_evicted()
+            logger.info(f"Evicted {num_evicted} entries from the state cache.")
+        return num_expired, num_evicted
+
+    def _forget_evicted(self):
+        # diskcache doesn't say which entries it evicted. A value in memory whose records aren't all on disk any more
+        # would be served from memory but not from disk.
+        for key, value in self.memory.items():
+            if any(record_key not in self.cache for record_key in record_keys(value)):
+                self.memory.invalidate(key)
+
+    def _read(self, key: str) -> Optional[bytes]:
+        # Without retry, FanoutCache returns None when a shard is busy, which would look like a miss.
+        return self.cache.get(key, retry=True)
+
+    def _load(self, key: str) -> Optional[BaseModel]:
+        return self._load_with_expiry(key)[0]
+
+    def _load_with_expiry(self, key: str) -> Tuple[Optional[BaseModel], Optional[float]]:
+        '''The value of key, and when the first of its records expires (None if they don't).'''
+        expire_times = []
+        def read(record_key: str) -> Optional[bytes]:
+            # Without retry, FanoutCache returns None when a shard is busy, which would look like a miss.
+            data, expire_time = self.cache.get(record_key, expire_time=True, retry=True)
+            if expire_time is not None:
+                expire_times.append(expire_time)
+            return data
+        data = read(key)
+        with self._lock:
+            if data is None:
+                self.disk_misses += 1
+            else:
+                self.disk_hits += 1
+        if data is None:
+            value = None
+        elif not is_record(data):
+            # Entries written before the record format are pickled models.
+            value = upgrade_pickled(data)
+        else:
+            try:
+                value = decode_records(data, read)
+            except (RecordFormatException, ValueError) as e:
+                # E.g. written by a newer version of the format. Treat it as not cached; it is overwritten when the content is made again.
+                logger.warning(f"Could not read the cached record {key}. {e}")
+                value = None
+        return value, min(expire_times, default=None)
+
+    def _delete_records(self, key: str) -> bool:
+        '''Deletes the meta record of key and the chapter or segment block records it refers to.'''
+        data = self._read(key)
+        if data is None:
+            return False
+        if is_record(data):
+            try:
+                record = PackedRecord(data)
+                if record.kind == STATE_META_RECORD:
+                    sub_keys = [chapter_record_key(key, index) for index in range(len(record.fields["chapters"]))]
+                elif record.kind == SEGMENTS_META_RECORD:
+                    sub_keys = [segment_block_key(key, index) for index in range(record.fields["num_blocks"])]
+                else:
+                    sub_keys = []
+            except RecordFormatException:
+                sub_keys = []
+            for sub_key in sub_keys:
+                self.cache.delete(sub_key, retry=True)
+        return self.cache.delete(key, retry=True)
+
+    def find_segments(self, audio_input: AudioProcessRequest) -> Optional[TranscriptSegments]:
+        '''Returns the cached segments for the audio_input. With allow_higher_quality, segments made by a model higher
+        on the QUALITY_LADDER are used as well, the highest one first. With use_captions, the video's captions come first.'''
+        if audio_input.use_captions:
+            transcript_segments = self.get_segments(self.make_captions_key(audio_input))
+            if transcript_segments:
+                return transcript_segments
+        transcript_segments = self.get_segments(self.make_segments_key(audio_input))
+        if transcript_segments or not audio_input.allow_higher_quality:
+            return transcript_segments
+        requested_rank = quality_rank(audio_input.audio_quality)
+        if requested_rank < 0:
+            return None
+        for name in reversed(QUALITY_LADDER[requested_rank:]):
+            # A model can be asked for by its QUALITY_LADDER name or, through "default", by its model name.
+            for audio_quality in dict.fromkeys([name, AUDIO_QUALITY_MAP[name]]):
+                if audio_quality == audio_input.audio_quality:
+                    continue
+                candidate_input = audio_input.model_copy(update={"audio_quality": audio_quality})
+                transcript_segments = self.get_segments(self.make_segments_key(candidate_input))
+                if transcript_segments:
+                    logger.info(f"Using segments transcribed with {audio_quality} for a {audio_input.audio_quality} request.")
+                    return transcript_segments
+        return None
 
     def make_key(self, audio_input: AudioProcessRequest) -> str:
+        key = self.audio_identity(audio_input) + "_" + audio_input.audio_quality + "_" + audio_input.compute_type + "_" + str(audio_input.chapter_chunk_time)
+        if audio_input.use_captions:
+            # Only requests that asked for captions get a transcript made from them.
+            key += "_" + CAPTIONS_MODEL
+        logger.info(f"key is: {key}")
+        return key
+
+    def make_segments_key(self, audio_input: AudioProcessRequest) -> str:
+        # Everything that changes what Whisper outputs, but not chapter_chunk_time, which only changes how the output is grouped.
+        key = SEGMENTS_KEY_PREFIX + self.audio_identity(audio_input) + "_" + audio_input.audio_quality + "_" + audio_input.compute_type + "_" + audio_input.decoding_profile
+        logger.debug(f"segments key is: {key}")
+        return key
+
+    def make_captions_key(self, audio_input: AudioProcessRequest) -> str:
+        # The captions don't depend on the model or its settings.
+        return SEGMENTS_KEY_PREFIX + self.audio_identity(audio_input) + "_" + CAPTIONS_MODEL
+
+    def audio_identity(self, audio_input: AudioProcessRequest) -> str:
         if audio_input.youtube_url:
-            name_part = audio_input.youtube_url
+            # All the URL forms of a video (youtu.be, watch?v=...&t=30, embed, www.) are the same content.
+            name_part = YOUTUBE_KEY_PREFIX + AudioProcessRequest.youtube_video_id(audio_input.youtube_url)
+        elif audio_input.audio_hash:
+            # Uploads are identified by their content. The same recording under another name is the same audio, and
+            # two different recordings that share a name (e.g. memo.mp3) are not.
+            name_part = audio_input.audio_hash
         elif audio_input.audio_filename:
             name_part = audio_input.audio_filename
         else: # Given both the youtube URL are None and the audio_file is None, the code doesn't have an audio file to transcribe.
             raise KeyException("No youtube url or audio file to transcribe.")
-        key = name_part + "_" + audio_input.audio_quality + "_" + audio_input.compute_type + "_" + str(audio_input.chapter_chunk_time)
-        logger.info(f"key is: {key}")
-        return key
+        return name_part
+
+    def migrate_keys(self) -> int:
+        '''Re-keys states cached with an older make_key(), e.g. YouTube states keyed by the raw URL, and repacks entries
+        that are still pickled. Returns the number of states that were moved. Runs once per cache; the version of the keys
+        is kept in the cache.'''
+        self._move_unsharded_entries()
+        if self.cache.get(KEY_VERSION_KEY, 1, retry=True) >= KEY_VERSION:
+            return 0
+        num_migrated = 0
+        for key in list(self.cache):
+            if key == KEY_VERSION_KEY or is_sub_record_key(key):
+                continue
+            try:
+                if self._migrate_entry(key):
+                    num_migrated += 1
+            except Exception as e:
+                # One entry that can't be read (e.g. pickled from a class that is gone) mustn't keep the service from
+                # starting. It stays where it is and is overwritten when the content is made again.
+                logger.warning(f"Could not migrate the state cache entry {key}. {e}")
+        self.cache[KEY_VERSION_KEY] = KEY_VERSION
+        self.memory.clear()
+        logger.info(f"Migrated {num_migrated} state cache keys to version {KEY_VERSION}.")
+        return num_migrated
+
+    def _migrate_entry(self, key: str) -> bool:
+        '''Moves the state of key to the key make_key() makes for it now, and repacks it. Returns whether it was moved.'''
+        data = self._read(key)
+        if data is None:
+            return False
+        # Pickled models and whole entries in one record are written again as the records of encode_records().
+        repack = not is_record(data) or PackedRecord(data).kind in (STATE_RECORD, SEGMENTS_RECORD)
+        value = self._load(key)
+        if key.startswith(SEGMENTS_KEY_PREFIX):
+            if repack and isinstance(value, TranscriptSegments):
+                self._store(value)
+            return False
+        state = value
+        if not isinstance(state, TranscriptionState) or not state.metadata or not state.metadata.audio_input:
+            return False
+        try:
+            new_key = self.make_key(state.metadata.audio_input)
+        except KeyException as e:
+            logger.warning(f"Could not make a new key for {key}. {e}")
+            return False
+        if new_key == key:
+            if repack:
+                self._store(state)
+            return False
+        # Several old keys can map to the same video. Keep the first complete state.
+        existing_state = self._load(new_key)
+        if existing_state is None or (not existing_state.is_complete() and state.is_complete()):
+            state.key = new_key
+            self._store(state)
+        self._delete_records(key)
+        return True
+
+    def _move_unsharded_entries(self) -> int:
+        '''Moves the entries of a cache made before the state cache was sharded into the shards.'''
+        unsharded_db = os.path.join(self.cache_dir, "cache.db")
+        if not os.path.exists(unsharded_db):
+            return 0
+        num_moved = 0
+        with Cache(self.cache_dir) as unsharded:
+            for key in list(unsharded):
+                value = unsharded.get(key)
+                if value is not None:
+                    self.cache[key] = value
+                    num_moved += 1
+            unsharded.clear()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(unsharded_db + suffix):
+                os.remove(unsharded_db + suffix)
+        logger.info(f"Moved {num_moved} entries of the unsharded state cache into {STATE_CACHE_SHARDS} shards.")
+        return num_moved
+
+class SegmentBlockWriter:
+    '''Stores the segments of a transcription a block at a time while Whisper is still running, so the write at the
+    end is the last block and the meta record. The blocks of a transcription that doesn't finish are never made
+    visible; they are overwritten by the next one or culled.'''
+    def __init__(self, states: TranscriptionStates, key: str):
+        self.states = states
+        self.key = key
+        self.num_blocks_written = 0
+
+    async def write(self, segments: List[TranscriptSegment]):
+        '''segments are all the segments so far. Stores the blocks that are full and haven't been stored.'''
+        while (self.num_blocks_written + 1) * SEGMENTS_PER_BLOCK <= len(segments):
+            start = self.num_blocks_written * SEGMENTS_PER_BLOCK
+            await self.states.add_segment_block_async(self.key, self.num_blocks_written, segments[start:start + SEGMENTS_PER_BLOCK])
+            self.num_blocks_written += 1
 
 class TranscriptionStatesSingleton:
     '''To maintain the states across requests.'''
@@ -201,6 +802,49 @@ class TranscriptionStatesSingleton:
             cls._instance = cls()
         return cls._instance.states
 
+def state_from_segments(key: str, audio_input: AudioProcessRequest, transcript_segments: TranscriptSegments) -> TranscriptionState:
+    '''A state for audio_input whose chapters will be made from cached segments, so there is nothing to download.'''
+    metadata = transcript_segments.metadata.model_copy(update={"audio_input": audio_input, "transcription_model": transcript_segments.transcription_model})
+    chapters = build_chapters(transcript_segments.chapter_dicts)
+    return TranscriptionState(key=key, basename=transcript_segments.basename, metadata=metadata, chapters=chapters)
+
+async def add_caption_segments(states: TranscriptionStates, extractor: MetadataExtractor, audio_input: AudioProcessRequest,
+                               info_dict: Dict, chapter_dicts: List[Dict]) -> Optional[TranscriptSegments]:
+    '''Caches the captions of the YouTube video as its segments. None if it has no captions.'''
+    cues = await extractor.caption_cues(audio_input, info_dict)
+    if not cues:
+        return None
+    metadata = build_metadata_instance(dict(info_dict))
+    metadata.audio_input = audio_input
+    metadata.transcription_model = CAPTIONS_MODEL
+    segments = [TranscriptSegment(*cue) for cue in cues]
+    transcript_segments = TranscriptSegments(key=states.make_captions_key(audio_input), basename=sanitize_title(info_dict['title']),
+                                             metadata=metadata, chapter_dicts=chapter_dicts,
+                                             duration=float(info_dict.get('duration') or segments[-1].end), segments=segments)
+    await states.add_segments_async(transcript_segments)
+    logger.info(f"{len(segments)} caption cues cached for {audio_input.youtube_url}.")
+    return transcript_segments
+
+async def add_new_state(queue: MessageQueueManager, states: TranscriptionStates, key: str, audio_input: AudioProcessRequest,
+                        info_dict: Dict, chapter_dicts: List[Dict], basename: str, download_time: Optional[str] = None,
+                        store: bool = True) -> TranscriptionState:
+    '''Makes a state that has everything except the transcript text of the chapters, and caches it unless store is False.'''
+    try:
+        metadata = build_metadata_instance(info_dict)
+        metadata.download_time = download_time
+        metadata.audio_input = audio_input
+        chapters = build_chapters(chapter_dicts)
+        state = TranscriptionState(key=key, basename=basename, hf_model=audio_input.audio_quality,  metadata=metadata, chapters=chapters)
+        # The transcribed text is not in the state yet. That will come later.
+        if store:
+            await states.add_state_async(state)
+            logger.debug("State metadata added to the cache.")
+    except Exception as e:
+        logger.error(f"Error building state",exc_info=e)
+        await send_sse_message(queue, event="server-error", data=f"Error building state: {e}")
+        raise e
+    return state
+
 async def initialize_transcription_state(queue: MessageQueueManager, audio_input: AudioProcessRequest) -> Tuple[TranscriptionState, str]:
     logger.debug(f"audio_input: {audio_input}")
     try:
@@ -213,7 +857,7 @@ async def initialize_transcription_state(queue: MessageQueueManager, audio_input
             state = None
         return
 
-    state = states.get_state(key)
+    state = await states.get_state_async(key)
     # END COMMENTING OUT FOR TESTS.
     # maintain the key for the client in case content is missing.
 
@@ -225,43 +869,55 @@ async def initialize_transcription_state(queue: MessageQueueManager, audio_input
     if state and not state.is_complete():
         # The state is not complete. Delete the state and start over.
         logger.debug("State is not complete. Deleting the state and starting over.")
-        states.delete_state(key)
+        await states.delete_state_async(key)
         state = None
     if state:
         logger.debug("state is in the cache.")
         await send_sse_message(queue, "status", "Sheer happiness! We already have the content.")
         return state, None # The local_audio_filename is not needed since the state is already in the cache.
+    transcript_segments = await states.find_segments_async(audio_input)
+    if transcript_segments:
+        # The audio has been transcribed with other chapter settings. The chapters are made from the cached segments,
+        # so there is nothing to download.
+        logger.debug("segments are in the cache.")
+        await send_sse_message(queue, "status", "We've transcribed this before. Putting the chapters together.")
+        return state_from_segments(key, audio_input, transcript_segments), None
     else:
         await send_sse_message(queue, event="status", data="Setting up stuff, back shortly!")
         logger.debug("state is not in the cache. Retrieving content.")
         extractor = MetadataExtractor()
-        try:
-            start_time = time.time()
-            info_dict, chapter_dicts, local_audio_filename = await extractor.extract_metadata_and_chapter_dicts(queue, audio_input)
-            end_time = time.time()
-        except MetadataExtractionException as e:
-            raise e
-        except Exception as e:
-            raise
-
+        start_time = time.time()
+        # A YouTube video's metadata is probed before its audio is downloaded. A video that is too long is turned away
+        # here, and the state is set up before any audio bytes move.
+        info_dict, chapter_dicts = await extractor.probe_metadata_and_chapter_dicts(audio_input)
+        probed = info_dict is not None
+        if probed:
+            check_duration(info_dict)
+            if audio_input.use_captions:
+                transcript_segments = await add_caption_segments(states, extractor, audio_input, info_dict, chapter_dicts)
+                if transcript_segments:
+                    await send_sse_message(queue, event="status", data="Using the video's captions. Putting the chapters together.")
+                    return state_from_segments(key, audio_input, transcript_segments), None
+                await send_sse_message(queue, event="status", data="The video has no captions. Transcribing the audio.")
+            await send_sse_message(queue, event="status", data=f"Found {info_dict.get('title')} ({format_time(info_dict.get('duration') or 0)}). Getting the audio.")
+            await add_new_state(queue, states, key, audio_input, dict(info_dict), chapter_dicts, sanitize_title(info_dict['title']))
+        info_dict, chapter_dicts, local_audio_filename = await extractor.extract_metadata_and_chapter_dicts(queue, audio_input)
+        end_time = time.time()
 
     # At this point, we have everything except the transcript_text of the chapters.
     try:
-        metadata = build_metadata_instance(info_dict)
-        metadata.download_time = format_time(float(end_time - start_time))
-        metadata.audio_input = audio_input
-
-        chapters = build_chapters(chapter_dicts)
-        filename_no_extension = os.path.splitext(os.path.basename(local_audio_filename))[0]
-        state = TranscriptionState(key=key, basename=filename_no_extension, hf_model=audio_input.audio_quality,  metadata=metadata, chapters=chapters)
-        # Since we are here, add the first process of audio prep prior to transcription to the cache.
-        # The transcribed text is not in the state yet. That will come later.
-        states.add_state(state)
-        logger.debug("State metadata added to the cache.")
+        # Uploaded audio is stored under its content hash. The name the client knows it by is the audio_filename.
+        # A YouTube download that is still going knows the path it will have.
+        local_audio_path = local_audio_filename.path if isinstance(local_audio_filename, ProgressiveDownload) else local_audio_filename
+        filename_no_extension = os.path.splitext(os.path.basename(audio_input.audio_filename or local_audio_path))[0]
+        # A probed video's state was cached before the download. It is cached again, with the transcript, when the job is done.
+        state = await add_new_state(queue, states, key, audio_input, info_dict, chapter_dicts, filename_no_extension,
+                                    download_time=format_time(float(end_time - start_time)), store=not probed)
         await send_sse_message(queue, event="status", data="Content has been prepped. All systems go for transcription.")
-    except Exception as e:
-        logger.error(f"Error building state",exc_info=e)
-        await send_sse_message(queue, event="server-error", data=f"Error building state: {e}")
-        raise e
+    except BaseException:
+        # No one will read a download that is still going.
+        if isinstance(local_audio_filename, ProgressiveDownload):
+            local_audio_filename.cancel()
+        raise
     state.key = key
     return state, local_audio_filename
@@ -0,0 +1,215 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###########################################################################################
+# Author: Margaret Johnson
+# Copyright (c) 2024 Margaret Johnson
+###########################################################################################
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import uuid
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import app.logging_config
+from app.service.audio_processing_model import SUPPORTED_AUDIO_FORMATS
+from app.service.exceptions_code import UploadValidationException
+from app.service.upload_writer_code import MAX_UPLOAD_BYTES, SNIFF_BYTES, UPLOAD_CHUNK_SIZE, sniff_audio_format
+from app.service.utils import get_audio_directory
+
+# Create a logger instance for this module
+logger = logging.getLogger(__name__)
+
+# Where the chunks of an upload are put together, under the audio directory.
+UPLOAD_SESSION_DIRECTORY = "uploads"
+# Seconds an upload session is kept after its last chunk. Sessions are only kept in memory, so a restart ends them too.
+UPLOAD_SESSION_TTL = 24 * 60 * 60
+# Seconds between the clean-ups of expired sessions and of the files of sessions that ended with a restart.
+UPLOAD_SESSION_CLEANUP_INTERVAL = 60 * 60
+PART_FILE_EXTENSION = ".part"
+
+
+class UploadSession:
+    '''A resumable upload. The chunks can arrive in any order and be sent again. Each one is written in place into a file
+    of the final size, so finishing the upload is a rename, not a copy.'''
+    def __init__(self, filename: str, size: int, audio_directory: str):
+        self.upload_id = uuid.uuid4().hex
+        self.filename = filename
+        self.extension = os.path.splitext(filename)[1].lower()
+        self.size = size
+        self.audio_directory = audio_directory
+        self.part_location = os.path.join(audio_directory, UPLOAD_SESSION_DIRECTORY, self.upload_id + PART_FILE_EXTENSION)
+        # Received byte ranges as [start, end), sorted and merged.
+        self.ranges: List[List[int]] = []
+        self.last_activity = time.monotonic()
+        # The content is hashed while it arrives in order. Chunks that arrive out of order are hashed at finalize().
+        self._hasher = hashlib.sha256()
+        self._hashed_offset = 0
+        self._lock = asyncio.Lock()
+
+    @property
+    def num_received(self) -> int:
+        return sum(end - start for start, end in self.ranges)
+
+    @property
+    def is_complete(self) -> bool:
+        return self.ranges == [[0, self.size]] or self.size == 0
+
+    def to_dict(self) -> dict:
+        return {"upload_id": self.upload_id, "filename": self.filename, "size": self.size,
+                "received": self.num_received, "ranges": self.ranges, "complete": self.is_complete}
+
+    def create_file(self) -> None:
+        os.makedirs(os.path.dirname(self.part_location), exist_ok=True)
+        with open(self.part_location, "wb") as file_object:
+            # A sparse file of the final size. Chunks are written at their offset.
+            file_object.truncate(self.size)
+
+    async def write_chunk(self, offset: int, chunks: AsyncIterator[bytes]) -> int:
+        '''Writes the body of a PUT at offset. Returns the number of bytes written.'''
+        if offset < 0 or offset > self.size:
+            raise UploadValidationException(f"Offset {offset} is outside the upload of {self.size} bytes.")
+        async with self._lock:
+            file_object = await asyncio.to_thread(open, self.part_location, "r+b")
+            position = offset
+            try:
+                await asyncio.to_thread(file_object.seek, offset)
+                async for chunk in chunks:
+                    if position + len(chunk) > self.size:
+                        raise UploadValidationException(f"The chunk at {offset} goes past the end of the upload ({self.size} bytes).")
+                    await asyncio.to_thread(self._write_and_hash, file_object, position, chunk)
+                    position += len(chunk)
+            finally:
+                await asyncio.to_thread(file_object.close)
+                # Whatever was written before a dropped connection counts. The client resumes after it.
+                self._add_range(offset, position)
+                self.last_activity = time.monotonic()
+        return position - offset
+
+    async def finalize(self) -> Tuple[str, str]:
+        '''Moves the complete upload to the audio directory under the SHA-256 of its content. Returns the location and hash.'''
+        async with self._lock:
+            if not self.is_complete:
+                raise UploadValidationException(f"The upload is incomplete. Received {self.num_received} of {self.size} bytes.")
+            return await asyncio.to_thread(self._finalize)
+
+    def remove(self) -> None:
+        if os.path.exists(self.part_location):
+            os.remove(self.part_location)
+
+    def _write_and_hash(self, file_object, position: int, chunk: bytes) -> None:
+        file_object.write(chunk)
+        if position < self._hashed_offset:
+            # A chunk sent again over bytes that were hashed. They may differ, and a hash can't be taken back, so
+            # the hash starts over. What isn't hashed in order from here is read back at finalize().
+            self._hasher = hashlib.sha256()
+            self._hashed_offset = 0
+        if position == self._hashed_offset:
+            self._hasher.update(chunk)
+            self._hashed_offset += len(chunk)
+
+    def _add_range(self, start: int, end: int) -> None:
+        if end <= start:
+            return
+        merged = []
+        for range_start, range_end in sorted(self.ranges + [[start, end]]):
+            if merged and range_start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], range_end)
+            else:
+                merged.append([range_start, range_end])
+        self.ranges = merged
+
+    def _finalize(self) -> Tuple[str, str]:
+        with open(self.part_location, "rb") as file_object:
+            audio_format = sniff_audio_format(file_object.read(SNIFF_BYTES))
+            if audio_format is None:
+                raise UploadValidationException(f"{self.filename} does not look like an audio file.")
+            # Only the part that didn't arrive in order is read back.
+            file_object.seek(self._hashed_offset)
+            while chunk := file_object.read(UPLOAD_CHUNK_SIZE):
+                self._hasher.update(chunk)
+        audio_hash = self._hasher.hexdigest()
+        file_location = os.path.join(self.audio_directory, audio_hash + self.extension)
+        if not os.path.exists(file_location):
+            os.replace(self.part_location, file_location)
+        else:
+            self.remove()
+        logger.debug(f"Upload {self.upload_id} ({self.filename}) finalized as {file_location}.")
+        return file_location, audio_hash
+
+
+class UploadSessions:
+    '''The upload sessions in progress.'''
+    def __init__(self, audio_directory: Optional[str] = None, ttl: float = UPLOAD_SESSION_TTL):
+        self.audio_directory = audio_directory
+        self.ttl = ttl
+        self._sessions: Dict[str, UploadSession] = {}
+
+    async def create(self, filename: str, size: int) -> UploadSession:
+        extension = os.path.splitext(filename or "")[1].lower()
+        if extension not in SUPPORTED_AUDIO_FORMATS:
+            raise UploadValidationException(f"Unsupported audio format {extension or filename}. Supported formats: {', '.join(sorted(SUPPORTED_AUDIO_FORMATS))}.")
+        if size < 0 or size > MAX_UPLOAD_BYTES:
+            raise UploadValidationException(f"An upload must be between 0 and {MAX_UPLOAD_BYTES} bytes.")
+        await asyncio.to_thread(self.remove_expired)
+        session = UploadSession(filename, size, self.audio_directory or get_audio_directory())
+        await asyncio.to_thread(session.create_file)
+        self._sessions[session.upload_id] = session
+        logger.info(f"Upload session {session.upload_id} created for {filename} ({size} bytes).")
+        return session
+
+    def get(self, upload_id: str) -> Optional[UploadSession]:
+        return self._sessions.get(upload_id)
+
+    def discard(self, upload_id: str) -> None:
+        session = self._sessions.pop(upload_id, None)
+        if session is not None:
+            session.remove()
+
+    def remove_expired(self) -> None:
+        '''Discards the sessions that have had no chunk for ttl seconds, and the files of sessions that ended with
+        a restart. Another process may have sessions in the same directory, so a file is only removed once it is as
+        old as an expired session.'''
+        now = time.monotonic()
+        for upload_id, session in list(self._sessions.items()):
+            if now - session.last_activity > self.ttl:
+                logger.info(f"Upload session {upload_id} expired.")
+                self.discard(upload_id)
+        session_directory = os.path.join(self.audio_directory or get_audio_directory(), UPLOAD_SESSION_DIRECTORY)
+        if not os.path.isdir(session_directory):
+            return
+        for name in os.listdir(session_directory):
+            upload_id, extension = os.path.splitext(name)
+            path = os.path.join(session_directory, name)
+            if extension != PART_FILE_EXTENSION or upload_id in self._sessions:
+                continue
+            try:
+                if time.time() - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+                    logger.info(f"Removed {path}, left by an upload session that has ended.")
+            except FileNotFoundError:
+                pass
+
+    async def remove_expired_periodically(self, interval: float = UPLOAD_SESSION_CLEANUP_INTERVAL) -> None:
+        '''Runs remove_expired() every interval seconds, so sessions expire when no new ones are created.'''
+        while True:
+            try:
+                await asyncio.to_thread(self.remove_expired)
+            except OSError as e:
+                logger.error(f"Error cleaning up upload sessions: {e}")
+            await asyncio.sleep(interval)
@@ -0,0 +1,145 @@
+#
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+###########################################################################################
+# Author: Margaret Johnson
+# Copyright (c) 2024 Margaret Johnson
+###########################################################################################
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+from typing import Optional, Tuple
+
+import app.logging_config
+from app.service.audio_processing_model import SUPPORTED_AUDIO_FORMATS
+from app.service.exceptions_code import UploadValidationException
+from app.service.utils import get_audio_directory
+
+# Create a logger instance for this module
+logger = logging.getLogger(__name__)
+
+# Uploads are read, hashed and written this many bytes at a time.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# The largest upload accepted, in bytes.
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 2 * 1024 ** 3))
+# The number of bytes sniff_audio_format() looks at.
+SNIFF_BYTES = 12
+
+
+def sniff_audio_format(header: bytes) -> Optional[str]:
+    '''Returns the container the first bytes of a file belong to, or None if they don't look like audio.'''
+    if header.startswith(b"ID3"):
+        return "mp3"
+    if len(header) >= 2 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0:
+        # An MPEG audio or ADTS (aac) frame without a tag in front of it.
+        return "mpeg"
+    if header.startswith(b"RIFF") and header[8:12] == b"WAVE":
+        return "wav"
+    if header.startswith(b"fLaC"):
+        return "flac"
+    if header.startswith(b"OggS"):
+        return "ogg"
+    if header[4:8] == b"ftyp":
+        return "mp4"
+    if header.startswith(b"ADIF"):
+        return "aac"
+    return None
+
+
+class AudioUploadWriter:
+    '''Writes an upload to the audio directory as it arrives and stores it under the SHA-256 of its content.
+
+    The upload is never held in memory: each chunk is hashed and written, off the event loop, before the next one is
+    read. The size limit and the format are checked along the way, so a bad upload is rejected as soon as it shows.
+
+        async with AudioUploadWriter(filename) as writer:
+            while chunk := await upload_file.read(UPLOAD_CHUNK_SIZE):
+                await writer.write(chunk)
+            file_location, audio_hash = await writer.finish()
+    '''
+    def __init__(self, filename: str, audio_directory: Optional[str] = None, max_bytes: int = MAX_UPLOAD_BYTES):
+        self.filename = filename
+        self.extension = os.path.splitext(filename or "")[1].lower()
+        if self.extension not in SUPPORTED_AUDIO_FORMATS:
+            raise UploadValidationException(f"Unsupported audio format {self.extension or filename}. Supported formats: {', '.join(sorted(SUPPORTED_AUDIO_FORMATS))}.")
+        self.audio_directory = audio_directory or get_audio_directory()
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.audio_format = None
+        self._hasher = hashlib.sha256()
+        self._header = b""
+        # Write to a temporary file in the same directory. The name is only known once all of the content has been hashed.
+        fd, self.temp_location = tempfile.mkstemp(dir=self.audio_directory, suffix=".part")
+        self._file = os.fdopen(fd, "wb")
+
+    async def __aenter__(self) -> "AudioUploadWriter":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is not None or self._file is not None:
+            await self.abort()
+
+    async def write(self, chunk: bytes) -> None:
+        self.num_bytes += len(chunk)
+        if self.num_bytes > self.max_bytes:
+            raise UploadValidationException(f"{self.filename} is larger than the {self.max_bytes} bytes an upload may be.")
+        if self.audio_format is None:
+            self._check_format(chunk)
+        await asyncio.to_thread(self._hash_and_write, chunk)
+
+    async def finish(self) -> Tuple[str, str]:
+        '''Returns where the upload was stored and its hash.'''
+        if self.audio_format is None:
+            self._check_format(b"", final=True)
+        return await asyncio.to_thread(self._finish)
+
+    async def abort(self) -> None:
+        await asyncio.to_thread(self._remove_temp_file)
+
+    def _check_format(self, chunk: bytes, final: bool = False) -> None:
+        self._header = (self._header + chunk)[:SNIFF_BYTES]
+        if len(self._header) < SNIFF_BYTES and not final:
+            return
+        self.audio_format = sniff_audio_format(self._header)
+        if self.audio_format is None:
+            raise UploadValidationException(f"{self.filename} does not look like an audio file.")
+
+    def _hash_and_write(self, chunk: bytes) -> None:
+        # hashlib and file writes release the GIL, so this doesn't slow down the event loop's thread either.
+        self._hasher.update(chunk)
+        self._file.write(chunk)
+
+    def _finish(self) -> Tuple[str, str]:
+        self._file.close()
+        self._file = None
+        audio_hash = self._hasher.hexdigest()
+        file_location = os.path.join(self.audio_directory, audio_hash + self.extension)
+        if not os.path.exists(file_location):
+            os.replace(self.temp_location, file_location)
+            logger.debug(f"File {self.filename} saved to {file_location}")
+        else:
+            os.remove(self.temp_location)
+            logger.debug(f"File {self.filename} has the same content as {file_location}.")
+        return file_location, audio_hash
+
+    def _remove_temp_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if os.path.exists(self.temp_location):
+            os.remove(self.temp_location)
@@ -2,7 +2,8 @@ import asyncio
 import json
 import logging
 import os
-from typing import Dict
+from typing import Dict, Optional, Union
+import zlib
 
 import app.logging_config
 
@@ -41,9 +42,26 @@ def format_sse(event: str, data: object) -> Dict:
     message = {}
     message["event"] = event
     message["data"] = data_str
+    if isinstance(data, dict) and len(data) == 1:
+        # What the data is (e.g. "chapter" or "metadata"), so it can be told apart without parsing data_str again.
+        message["kind"] = next(iter(data))
     return message
 
 
+def format_ws(message: Dict, message_id: Optional[int]) -> Union[str, bytes]:
+    """
+    Format a queued message as a websocket frame.
+
+    The frame carries the same event, id and data as the SSE message. Chapter payloads (the "kind" format_sse() gives
+    them) are sent as zlib compressed binary frames since they hold the transcript text. Everything else is sent as a
+    JSON text frame.
+    """
+    envelope = json.dumps({"event": message["event"], "id": message_id, "data": message["data"]})
+    if message.get("kind") == "chapter":
+        return zlib.compress(envelope.encode("utf-8"))
+    return envelope
+
+
 async def send_sse_message(queue: MessageQueueManager, event: str, data: dict):
     message = format_sse(event, data)
     await queue.add_message(message)
@@ -23,32 +23,46 @@ from functools import partial
 import logging
 import os
 import re
+import time
 import yt_dlp
-from typing import List, Tuple
+from typing import List, Optional, Tuple, Union
 
 import app.logging_config
+from app.service.captions_code import Cue, parse_vtt, pick_caption_track
 from app.service.exceptions_code import ProgressHookException, YouTubeDownloadException, YouTubePostProcessingException
 from app.service.metadata_shared_code import Metadata
 from app.service.message_queue_manager import MessageQueueManager
-from app.service.utils import format_sse
+from app.service.metadata_probe_code import MetadataProbesSingleton
+from app.service.progress_aggregator_code import ProgressAggregator, clean_ytdlp_message
+from app.service.progressive_download_code import PROGRESSIVE_TRANSCRIPTION, ProgressiveDownload
+from app.service.utils import get_audio_directory
 
 # Create a logger instance for this module
 logger = logging.getLogger(__name__)
 
-def progress_hook(info_dict, queue, loop):
+# YouTube serves audio either as DASH fragments or as one file. yt-dlp fetches fragments one at a time by default. Each
+# fragment is a request with its own round trip, so they are fetched this many at a time.
+YTDLP_CONCURRENT_FRAGMENTS = int(os.environ.get("YTDLP_CONCURRENT_FRAGMENTS", 4))
+# A single file is fetched in ranges of this many bytes. YouTube slows down connections that ask for the whole file at once.
+YTDLP_HTTP_CHUNK_SIZE = int(os.environ.get("YTDLP_HTTP_CHUNK_SIZE", 10 * 1024 * 1024))
+YTDLP_RETRIES = int(os.environ.get("YTDLP_RETRIES", 10))
+
+def sanitize_title(title: str) -> str:
+    sanitized_filename = re.sub(r'[:]', '-', title)  # Replace colon with hyphen
+    return re.sub(r'[\<\>\"/|?*]', '', sanitized_filename)  # Remove other problematic
+
+def download_speed(num_bytes: int, seconds: float) -> str:
+    '''The throughput of a download, e.g. "4.2 MB/s".'''
+    if seconds <= 0:
+        return "unknown"
+    return f"{num_bytes / seconds / 1_000_000:.1f} MB/s"
+
+def progress_hook(info_dict, progress):
+    # yt-dlp calls the hook from its download thread for every chunk. Hand the raw message to the job's
+    # ProgressAggregator, which decides when (and if) a status message is sent to the client.
     if info_dict['status'] in ['finished', 'downloading']:
         try:
-            default_message = info_dict['_default_template']
-            # Remove ANSI escape sequences from the message
-            message = re.sub(r'\x1b\[.*?m', '', default_message)
-            # Remove multiple spaces and leading/trailing spaces
-            message = re.sub(r'\s+', ' ', message).strip()
-            # Format a status message to send to the client in the form of an SSE message.
-            message = format_sse("status", message)
-            logger.debug(f"--> progress_hook: {message}")
-            # Submit the queue.add_message() coroutine to the main thread's event loop
-            # so that event_generator can send the sse message.
-            asyncio.run_coroutine_threadsafe(queue.add_message(message), loop)
+            progress.update_threadsafe(info_dict['_default_template'], final=info_dict['status'] == 'finished')
         except ProgressHookException as e:
             logger.error(f'Error: {e}')
             raise e
@@ -57,31 +71,38 @@ class YouTubeHandler():
     def __init__(self, audio_input):
         self.audio_input = audio_input
 
-    async def extract(self,queue:MessageQueueManager, audio_directory:str) -> Tuple[dict, List, str]:
+    async def extract(self,queue:MessageQueueManager, audio_directory:str) -> Tuple[dict, List, Union[str, ProgressiveDownload]]:
         """
-        Extracts metadata and audio from a YouTube video synchronously.
+        Extracts metadata and audio from a YouTube video. With PROGRESSIVE_TRANSCRIPTION, returns once the metadata is in,
+        with a ProgressiveDownload in place of the audio file, so that the audio can be transcribed while it downloads.
         """
         try:
             loop = asyncio.get_event_loop()
+            if PROGRESSIVE_TRANSCRIPTION:
+                logger.info(f"--->Starting progressive YouTube download of {self.audio_input.youtube_url}")
+                return await self.start_progressive_download(self.audio_input.youtube_url, audio_directory, queue, loop)
             logger.info(f"--->Starting YouTube download of {self.audio_input.youtube_url}")
             download_task = asyncio.create_task(self.download_video(self.audio_input.youtube_url, audio_directory,queue, loop))
             # The transcription can't start until the download is complete. So... wait for it.
-            metadata_dict, chapter_dicts, mp3_filepath = await download_task
+            metadata_dict, chapter_dicts, audio_filepath = await download_task
             logger.info(f"<---Done downloading {self.audio_input.youtube_url}")
         except YouTubeDownloadException as e:
             logger.error(f"Failed to download video for {self.audio_input.youtube_url}",exc_info=e)
             raise
 
-        return metadata_dict, chapter_dicts, mp3_filepath
+        return metadata_dict, chapter_dicts, audio_filepath
 
     async def download_video(self, url: str, audio_directory:str, queue: MessageQueueManager, loop: asyncio.AbstractEventLoop) -> Tuple[Metadata, List, str]:
-        ydl_opts = self.get_ydl_opts(audio_directory, queue,  loop)
+        progress = ProgressAggregator(queue, loop, formatter=clean_ytdlp_message)
+        ydl_opts = self.get_ydl_opts(audio_directory, progress)
         try:
+            # The info that can be extracted is listed at https://github.com/yt-dlp/yt-dlp?tab=readme-ov-file#output-template
+            info_dict = await self.probe(url, ydl_opts)
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
                 try:
-                    # The info that can be extracted is listed at https://github.com/yt-dlp/yt-dlp?tab=readme-ov-file#output-template
-                    # Using the YouTube transcript so don't download the video/audio.
-                    info_dict = await loop.run_in_executor(None, ydl.extract_info, url, True)
+                    download_start = time.perf_counter()
+                    info_dict = await loop.run_in_executor(None, ydl.process_ie_result, info_dict, True)
+                    download_seconds = time.perf_counter() - download_start
                 except yt_dlp.utils.DownloadError as e:
                     logger.error(f"Failed to download video for {url}: {e}")
                     raise YouTubeDownloadException(f"Failed to download video for {url}: {e}")
@@ -90,32 +111,115 @@ class YouTubeHandler():
                     raise YouTubePostProcessingException(f"Failed to post-process video for {url}: {e}")
                 except Exception as e:
                     logger.error(f"An error occurred: {e}")
-                # Go through the tags list in info_dict and replace spaces within each tag with underscores.
-                if 'tags' in info_dict: # tags are a list.
-                    tags_list = [re.sub(r'\s+', '_', tag) for tag in info_dict['tags']]
-                    info_dict['tags'] = ', '.join(tags_list)
-                # Add in the YouTube url
-                info_dict['youtube_url'] = url
-                potential_problems_filepath = info_dict['requested_downloads'][0]['filepath']
-                logger.debug(f"The file: {potential_problems_filepath} exists: {os.path.exists(potential_problems_filepath)}")
-                sanitized_filename = re.sub(r'[:]', '-', info_dict['title'])  # Replace colon with hyphen
-                sanitized_filename = re.sub(r'[\<\>\"/|?*]', '', sanitized_filename)  # Remove other problematic
-                mp3_filepath = audio_directory + '/' + sanitized_filename + '.mp3'
-                if not os.path.exists(mp3_filepath):
-                    os.rename(potential_problems_filepath, mp3_filepath)
-                # add in the audio quality.
-                info_dict['audio_quality'] = self.audio_input.audio_quality
-                chapter_dicts = info_dict.get('chapters', [])
-                if not chapter_dicts:
-                    chapter_dicts = [{'title': info_dict.get('title',''), 'start_time': 0.0, 'end_time': 0.0}]
+                chapter_dicts = self._prepare_info_dict(info_dict, url)
+                audio_filepath = self._move_download(info_dict, audio_directory)
+                info_dict['download_speed'] = download_speed(os.path.getsize(audio_filepath), download_seconds)
+                logger.info(f"Downloaded {url} at {info_dict['download_speed']}.")
         except YouTubeDownloadException as e:
             logger.error(f"Failed to download video for {url}: {e}")
             raise e
+        finally:
+            await progress.flush()
+            logger.debug(f"{progress.num_updates} download progress updates, {progress.num_sent} sent.")
         # Lose the properties yt-dlp adds that we don't need by converting to a Metadata object.
 
-        return info_dict, chapter_dicts, mp3_filepath
+        return info_dict, chapter_dicts, audio_filepath
+
+    async def start_progressive_download(self, url: str, audio_directory: str, queue: MessageQueueManager, loop: asyncio.AbstractEventLoop) -> Tuple[dict, List, Union[str, ProgressiveDownload]]:
+        '''Gets the metadata, then starts the download in the background. Returns the metadata, the chapters and the
+        ProgressiveDownload to read the audio from.'''
+        progress = ProgressAggregator(queue, loop, formatter=clean_ytdlp_message)
+        ydl_opts = self.get_ydl_opts(audio_directory, progress)
+        info_dict = await self.probe(url, ydl_opts)
+        if info_dict.get('requested_formats') or info_dict.get('is_live'):
+            # Separate streams that are merged after they download, or a live stream, can't be read as they arrive.
+            logger.info(f"{url} can't be transcribed while it downloads. Downloading it first.")
+            return await self.download_video(url, audio_directory, queue, loop)
+        download = ProgressiveDownload(os.path.join(audio_directory, sanitize_title(info_dict['title']) + '.' + info_dict['ext']),
+                                       duration=info_dict.get('duration'))
+        ydl_opts['progress_hooks'] = ydl_opts['progress_hooks'] + [download.progress_hook]
+        download.task = asyncio.create_task(self._finish_progressive_download(download, ydl_opts, dict(info_dict), url, audio_directory, progress, loop))
+        chapter_dicts = self._prepare_info_dict(info_dict, url)
+        return info_dict, chapter_dicts, download
+
+    async def _finish_progressive_download(self, download: ProgressiveDownload, ydl_opts: dict, info_dict: dict, url: str,
+                                           audio_directory: str, progress: ProgressAggregator, loop: asyncio.AbstractEventLoop) -> None:
+        download_start = time.perf_counter()
+        try:
+            info_dict = await loop.run_in_executor(None, self._download_info, ydl_opts, info_dict)
+            download.download_seconds = time.perf_counter() - download_start
+            audio_filepath = self._move_download(info_dict, audio_directory)
+            download.download_speed = download_speed(os.path.getsize(audio_filepath), download.download_seconds)
+            logger.info(f"<---Done downloading {url} at {download.download_speed}.")
+            download.finish(audio_filepath)
+        except Exception as e:
+            logger.error(f"Failed to download video for {url}: {e}")
+            download.finish(error=YouTubeDownloadException(f"Failed to download video for {url}: {e}"))
+        finally:
+            await progress.flush()
+
+    async def probe_metadata(self) -> Tuple[dict, List]:
+        '''The metadata and chapter dicts of the video, from a probe. Nothing is downloaded.'''
+        info_dict = await self.probe(self.audio_input.youtube_url)
+        chapter_dicts = self._prepare_info_dict(info_dict, self.audio_input.youtube_url)
+        return info_dict, chapter_dicts
+
+    async def fetch_captions(self, info_dict: dict) -> Optional[List[Cue]]:
+        '''The cues of the captions the uploader added to the video, or None if there aren't any. See pick_caption_track().'''
+        track = pick_caption_track(info_dict)
+        if track is None:
+            return None
+        ydl_opts = self.get_ydl_opts(get_audio_directory(), progress=None)
+        def fetch() -> str:
+            # Through yt-dlp, so the request has the headers and cookies YouTube expects.
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                return ydl.urlopen(track['url']).read().decode('utf-8')
+        return parse_vtt(await asyncio.to_thread(fetch))
+
+    async def probe(self, url: str, ydl_opts: dict = None) -> dict:
+        '''The info of the video, without downloading it. See MetadataProbes.'''
+        if ydl_opts is None:
+            ydl_opts = self.get_ydl_opts(get_audio_directory(), progress=None)
+        try:
+            return await MetadataProbesSingleton.get_probes().probe(url, partial(self._extract_info_only, ydl_opts))
+        except yt_dlp.utils.DownloadError as e:
+            logger.error(f"Failed to get the info of {url}: {e}")
+            raise YouTubeDownloadException(f"Failed to get the info of {url}: {e}")
+
+    def _extract_info_only(self, ydl_opts: dict, url: str) -> dict:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            return ydl.extract_info(url, download=False)
+
+    def _download_info(self, ydl_opts: dict, info_dict: dict) -> dict:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            return ydl.process_ie_result(info_dict, download=True)
+
+    def _prepare_info_dict(self, info_dict: dict, url: str) -> List[dict]:
+        '''Fills in the fields the metadata is made from. Returns the chapter dicts.'''
+        # Go through the tags list in info_dict and replace spaces within each tag with underscores.
+        if 'tags' in info_dict and isinstance(info_dict['tags'], list): # tags are a list.
+            tags_list = [re.sub(r'\s+', '_', tag) for tag in info_dict['tags']]
+            info_dict['tags'] = ', '.join(tags_list)
+        # Add in the YouTube url
+        info_dict['youtube_url'] = url
+        # add in the audio quality.
+        info_dict['audio_quality'] = self.audio_input.audio_quality
+        chapter_dicts = info_dict.get('chapters') or []
+        if not chapter_dicts:
+            chapter_dicts = [{'title': info_dict.get('title',''), 'start_time': 0.0, 'end_time': 0.0}]
+        return chapter_dicts
+
+    def _move_download(self, info_dict: dict, audio_directory: str) -> str:
+        potential_problems_filepath = info_dict['requested_downloads'][0]['filepath']
+        logger.debug(f"The file: {potential_problems_filepath} exists: {os.path.exists(potential_problems_filepath)}")
+        # The audio is kept in the format YouTube sent it in (see get_ydl_opts()).
+        extension = os.path.splitext(potential_problems_filepath)[1]
+        audio_filepath = audio_directory + '/' + sanitize_title(info_dict['title']) + extension
+        if not os.path.exists(audio_filepath):
+            os.rename(potential_problems_filepath, audio_filepath)
+        return audio_filepath
 
-    def get_ydl_opts(self, audio_directory: str, queue: MessageQueueManager, loop: asyncio.AbstractEventLoop) -> dict:
+    def get_ydl_opts(self, audio_directory: str, progress: ProgressAggregator) -> dict:
         ydl_opts = {
             'logger': logger,
             'verbose': True, # Enable verbose logging for debugging.
@@ -127,15 +231,15 @@ class YouTubeHandler():
             'restrict-filenames': True,
             'outtmpl': os.path.join(audio_directory, '%(title)s.%(ext)s'),
             'quiet': True,
-            'progress_hooks': [partial(progress_hook, queue=queue, loop=loop)],
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '96',
-            }],
-            'postprocessor_args': [
-                '-ac', '1',
-                '-ar', '44100'
-            ],
+            'progress_hooks': [partial(progress_hook, progress=progress)],
+            'concurrent_fragment_downloads': YTDLP_CONCURRENT_FRAGMENTS,
+            'http_chunk_size': YTDLP_HTTP_CHUNK_SIZE,
+            'retries': YTDLP_RETRIES,
+            'fragment_retries': YTDLP_RETRIES,
+            # The fragments and chunks of a download go through the YoutubeDL instance's requests session, which keeps
+            # its connections open between requests. No 'noresizebuffer', so the read size grows with the connection.
+            # No FFmpegExtractAudio postprocessor. Converting to mp3 decoded and re-encoded every download before Whisper
+            # decoded it again, and lost quality doing it. The bestaudio stream (opus or m4a) is decoded straight to 16 kHz
+            # mono for Whisper (see PCMCache.stream()). An mp3 is only made if /audio/<title>.mp3 is asked for (see AudioFiles).
         }
         return ydl_opts
@@ -0,0 +1,55 @@
+import wave
+
+import av
+import numpy as np
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.service.audio_files_code import AudioFiles
+from app.service.audio_processing_model import AudioProcessRequest
+from app.service.youtube_handler_code import YouTubeHandler
+
+
+@pytest.fixture
+def audio_directory(tmp_path):
+    with wave.open(str(tmp_path / "talk.wav"), "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(16000)
+        wav_file.writeframes((np.sin(np.linspace(0, 2 * np.pi * 440, 16000)) * 10000).astype(np.int16).tobytes())
+    return tmp_path
+
+
+@pytest.fixture
+def client(audio_directory):
+    app = FastAPI()
+    app.mount("/audio", AudioFiles(directory=str(audio_directory)), name="audio")
+    return TestClient(app)
+
+
+def test_mp3_is_made_on_first_request(client, audio_directory):
+    response = client.get("/audio/talk.mp3")
+    assert response.status_code == 200
+    assert (audio_directory / "talk.mp3").exists()
+    with av.open(str(audio_directory / "talk.mp3")) as container:
+        stream = container.streams.audio[0]
+        assert container.format.name == "mp3"
+        assert stream.rate == 44100
+        assert stream.channels == 1
+    # From then on it's a static file.
+    assert client.get("/audio/talk.mp3").content == response.content
+    assert sorted(path.name for path in audio_directory.iterdir()) == ["talk.mp3", "talk.wav"]
+
+
+def test_other_files_are_served_as_they_are(client):
+    assert client.get("/audio/talk.wav").status_code == 200
+    assert client.get("/audio/missing.mp3").status_code == 404
+    assert client.get("/audio/missing.wav").status_code == 404
+
+
+def test_youtube_audio_is_not_reencoded(tmp_path):
+    handler = YouTubeHandler(AudioProcessRequest(youtube_url="https://www.youtube.com/watch?v=dQw4w9WgXcQ"))
+    ydl_opts = handler.get_ydl_opts(str(tmp_path), progress=None)
+    assert "postprocessors" not in ydl_opts
+    assert ydl_opts["format"] == "bestaudio/best"
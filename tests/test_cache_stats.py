@@ -0,0 +1,74 @@
+import os
+
+from fastapi.testclient import TestClient
+import pytest
+
+from app.service.metadata_shared_code import Metadata
+from app.service.transcription_state_code import Chapter, TranscriptionState, TranscriptionStates, TranscriptionStatesSingleton
+
+
+def make_state(key: str, text: str) -> TranscriptionState:
+    return TranscriptionState(key=key, basename="basename", metadata=Metadata(title="title"),
+                              chapters=[Chapter(start_time=0.0, end_time=0.0, text=text)])
+
+
+def test_size_limit_evicts(tmp_path):
+    # Each shard gets an eighth of the size limit.
+    states = TranscriptionStates(cache_dir=str(tmp_path / "state_cache"), size_limit=8 * 64 * 1024)
+    for index in range(200):
+        # Random text doesn't compress, so every record takes about 4 KiB.
+        states.add_state(make_state(f"key{index}", text=os.urandom(2048).hex()))
+    # The writes since the last cull can still be over the limit.
+    states.cull()
+    stats = states.stats()["disk"]
+    assert stats["evictions"] > 0
+    assert stats["volume"] <= stats["size_limit"]
+    # A metadata record and a chapter record per state.
+    assert stats["entries"] == 2 * 200 - stats["evictions"]
+
+
+def test_ttl_expires_entries(tmp_path):
+    states = TranscriptionStates(cache_dir=str(tmp_path / "state_cache"), ttl=-1)
+    states.add_state(make_state("key", "words"))
+    assert states.get_state("key") is None
+    assert states.metrics()["disk"]["misses"] == 1
+    assert states.cull() == (2, 0)
+    assert states.metrics()["disk"]["expirations"] == 2
+
+
+def test_memory_forgets_entries_evicted_from_disk(tmp_path):
+    states = TranscriptionStates(cache_dir=str(tmp_path / "state_cache"), size_limit=8 * 64 * 1024, cull_every=10_000)
+    states.add_state(make_state("first", text=os.urandom(2048).hex()))
+    for index in range(200):
+        states.add_state(make_state(f"key{index}", text=os.urandom(2048).hex()))
+    assert states.get_state("first") is not None
+    states.cull()
+    # The first state stored is the first one evicted.
+    assert states.get_state("first") is None
+
+
+def test_culls_every_few_writes(tmp_path):
+    states = TranscriptionStates(cache_dir=str(tmp_path / "state_cache"), size_limit=8 * 64 * 1024, cull_every=20)
+    for index in range(200):
+        states.add_state(make_state(f"key{index}", text=os.urandom(2048).hex()))
+    disk = states.stats()["disk"]
+    assert disk["evictions"] > 0 and disk["expirations"] == 0
+    # At most cull_every records (about 4 KiB each) are written after the last cull.
+    assert disk["volume"] <= disk["size_limit"] + 20 * 5 * 1024
+
+
+def test_unknown_eviction_policy(tmp_path):
+    with pytest.raises(ValueError):
+        TranscriptionStates(cache_dir=str(tmp_path / "state_cache"), eviction_policy="most-recently-used")
+
+
+def test_cache_stats_endpoint(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(TranscriptionStatesSingleton, "_instance", None)
+    from app.main import app
+    TranscriptionStatesSingleton.get_states().add_state(make_state("key", "words"))
+    with TestClient(app) as client:
+        stats = client.get("/api/v1/admin/cache_stats").json()
+    assert stats["disk"]["entries"] >= 1
+    assert stats["disk"]["eviction_policy"] == "least-recently-stored"
+    assert set(stats["memory"]) >= {"hits", "misses", "evictions"}
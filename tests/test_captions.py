@@ -0,0 +1,133 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.service.audio_processing_model import AudioProcessRequest
+from app.service.captions_code import CAPTIONS_MODEL, parse_vtt, pick_caption_track
+from app.service.exceptions_code import MetadataExtractionException
+from app.service.message_queue_manager import initialize_message_queue_manager
+from app.service.metadata_extractor_code import MetadataExtractor
+from app.service.metadata_probe_code import MetadataProbesSingleton
+from app.service.process_audio import process_audio
+from app.service.transcription_code import TranscribeAudio
+from app.service.transcription_state_code import TranscriptionStatesSingleton
+from app.service.youtube_handler_code import YouTubeHandler
+
+VTT = """WEBVTT
+Kind: captions
+Language: en
+
+NOTE made by the uploader
+
+00:00:01.000 --> 00:00:04.500 align:start position:0%
+<c.colorE5E5E5>Welcome to</c> the talk.
+
+00:00:30.000 --> 00:00:33.000
+Tom &amp; Jerry
+chase each other.
+
+00:01:05.000 --> 00:01:09.000
+Second chapter.
+
+01:00:00.000 --> 01:00:01.000
+An hour in.
+"""
+
+
+def test_cues_are_read_from_webvtt():
+    cues = parse_vtt(VTT)
+    assert [cue.text for cue in cues] == [" Welcome to the talk.", " Tom & Jerry chase each other.", " Second chapter.", " An hour in."]
+    assert (cues[0].start, cues[0].end) == (1.0, 4.5)
+    assert (cues[-1].start, cues[-1].end) == (3600.0, 3601.0)
+
+
+def test_only_the_uploaders_captions_are_used():
+    info_dict = {"automatic_captions": {"en": [{"ext": "vtt", "url": "https://example.com/auto.vtt"}]},
+                 "subtitles": {"live_chat": [{"ext": "json", "url": "https://example.com/chat"}],
+                               "de": [{"ext": "vtt", "url": "https://example.com/de.vtt"}],
+                               "en-US": [{"ext": "json3", "url": "https://example.com/en.json3"},
+                                         {"ext": "vtt", "url": "https://example.com/en.vtt"}]}}
+    assert pick_caption_track(info_dict, ["en"])["url"] == "https://example.com/en.vtt"
+    assert pick_caption_track(info_dict, ["fr"]) is None
+    assert pick_caption_track({"automatic_captions": info_dict["automatic_captions"]}, ["en"]) is None
+
+
+class Captions(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        body = VTT.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/vtt")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def states(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(TranscriptionStatesSingleton, "_instance", None)
+    monkeypatch.setattr(MetadataProbesSingleton, "_instance", None)
+    return TranscriptionStatesSingleton.get_states()
+
+
+@pytest.fixture
+def caption_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Captions)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/en.vtt"
+    server.shutdown()
+
+
+def probe_with(subtitles):
+    def extract_info_only(self, ydl_opts, url):
+        return {"id": "bckD_GK80oY", "title": "A talk", "duration": 3602, "ext": "webm", "subtitles": subtitles,
+                "chapters": [{"title": "One", "start_time": 0.0, "end_time": 60.0},
+                             {"title": "Two", "start_time": 60.0, "end_time": 3602.0}]}
+    return extract_info_only
+
+
+@pytest.mark.asyncio
+async def test_captions_are_used_without_downloading_or_transcribing(states, caption_url, monkeypatch):
+    monkeypatch.setattr(YouTubeHandler, "_extract_info_only", probe_with({"en": [{"ext": "vtt", "url": caption_url}]}))
+    async def download(self, queue, audio_input):
+        raise AssertionError("The audio was downloaded.")
+    monkeypatch.setattr(MetadataExtractor, "extract_metadata_and_chapter_dicts", download)
+    async def transcribe(self, queue, audio):
+        raise AssertionError("The audio was transcribed.")
+    monkeypatch.setattr(TranscribeAudio, "transcribe_segments", transcribe)
+    sent = []
+    async def send_sse_data_messages(queue, state, content_texts):
+        # The chapters are paced out to the client 2 seconds apart. The time measured is until they are ready.
+        sent.append(time.perf_counter())
+    monkeypatch.setattr("app.service.process_audio.send_sse_data_messages", send_sse_data_messages)
+    audio_input = AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY", use_captions=True)
+    queue = await initialize_message_queue_manager()
+    start = time.perf_counter()
+    await process_audio(queue, audio_input)
+    assert sent[0] - start < 1
+    state = states.get_state(states.make_key(audio_input))
+    assert state.is_complete()
+    assert state.metadata.transcription_model == CAPTIONS_MODEL
+    # The video's chapters are kept, filled in with the captions.
+    assert [chapter.title for chapter in state.chapters] == ["One", "Two"]
+    assert "Tom & Jerry" in state.chapters[0].text and "An hour in." in state.chapters[1].text
+    # The same video without use_captions doesn't get the captions.
+    assert states.make_key(audio_input.model_copy(update={"use_captions": False})) != state.key
+
+
+@pytest.mark.asyncio
+async def test_a_video_without_captions_is_transcribed(states, monkeypatch):
+    monkeypatch.setattr(YouTubeHandler, "_extract_info_only", probe_with({}))
+    downloads = []
+    async def download(self, queue, audio_input):
+        downloads.append(audio_input)
+        raise MetadataExtractionException("No network in this test.")
+    monkeypatch.setattr(MetadataExtractor, "extract_metadata_and_chapter_dicts", download)
+    queue = await initialize_message_queue_manager()
+    await process_audio(queue, AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY", use_captions=True))
+    assert len(downloads) == 1
@@ -0,0 +1,77 @@
+import time
+
+import pytest
+
+from app.service.lru_cache_code import LRUCache
+from app.service.metadata_shared_code import Metadata
+from app.service.transcription_state_code import Chapter, TranscriptionState, TranscriptionStatesSingleton
+
+
+def make_state(key: str, text: str = "Some words.") -> TranscriptionState:
+    return TranscriptionState(key=key, basename="basename", metadata=Metadata(title="title"),
+                              chapters=[Chapter(start_time=0.0, end_time=0.0, text=text)])
+
+
+@pytest.fixture
+def states(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(TranscriptionStatesSingleton, "_instance", None)
+    return TranscriptionStatesSingleton.get_states()
+
+
+def test_evicts_least_recently_used_by_size():
+    cache = LRUCache(max_bytes=30, sizeof=len)
+    cache.put("a", "x" * 10)
+    cache.put("b", "x" * 10)
+    cache.put("c", "x" * 10)
+    assert cache.get("a") is not None  # a is now the most recently used.
+    cache.put("d", "x" * 10)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None and cache.get("d") is not None
+    metrics = cache.metrics()
+    assert metrics["bytes"] == 30
+    assert metrics["evictions"] == 1
+    assert metrics["misses"] == 1
+
+
+def test_does_not_cache_values_bigger_than_the_cache():
+    cache = LRUCache(max_bytes=10, sizeof=len)
+    cache.put("a", "x" * 5)
+    cache.put("big", "x" * 11)
+    assert cache.get("big") is None
+    assert cache.get("a") == "x" * 5
+
+
+def test_expired_entries_are_not_returned():
+    cache = LRUCache(max_bytes=30, sizeof=len)
+    cache.put("old", "x", expires_at=time.time() - 1)
+    cache.put("new", "x", expires_at=time.time() + 60)
+    assert cache.get("old") is None
+    assert cache.get("new") == "x"
+    assert cache.metrics()["entries"] == 1
+
+
+def test_get_state_is_served_from_memory(states):
+    states.add_state(make_state("key"))
+    first = states.get_state("key")
+    assert states.get_state("key") is first
+    assert states.metrics()["memory"]["hits"] == 2
+
+
+def test_writes_go_through_to_memory(states):
+    state = make_state("key", text="")
+    states.add_state(state)
+    # Filling in the state after it was added doesn't change what is cached until it is added again.
+    state.chapters[0].text = "Transcribed."
+    assert not states.get_state("key").is_complete()
+    states.add_state(state)
+    assert states.get_state("key").is_complete()
+    states.delete_state("key")
+    assert states.get_state("key") is None
+
+
+def test_reads_from_disk_fill_the_memory_tier(states):
+    states.add_state(make_state("key"))
+    states.memory.clear()
+    assert states.get_state("key").is_complete()
+    assert states.metrics()["memory"]["entries"] == 1
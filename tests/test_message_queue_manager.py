@@ -0,0 +1,140 @@
+import asyncio
+
+import pytest
+import pytest_asyncio
+
+from app.service.message_queue_manager import MessageQueueManager
+from app.service.utils import format_sse
+
+
+@pytest_asyncio.fixture
+async def queue():
+    queue = MessageQueueManager(maxsize=3)
+    await queue.initialize()
+    return queue
+
+
+@pytest.mark.asyncio
+async def test_status_messages_drop_oldest(queue):
+    for percent in range(5):
+        await queue.add_message(format_sse("status", f"{percent}%"))
+    messages = [await queue.get_message() for _ in range(3)]
+    assert [m['data'] for m in messages] == ["2%", "3%", "4%"]
+    assert queue.metrics()['dropped'] == {"status": 2}
+
+
+@pytest.mark.asyncio
+async def test_status_message_dropped_when_full_of_data(queue):
+    for number in range(3):
+        await queue.add_message(format_sse("data", {"chapter": number}))
+    await queue.add_message(format_sse("status", "lost"))
+    assert queue.metrics()['depth'] == 3
+    assert queue.metrics()['dropped'] == {"status": 1}
+
+
+@pytest.mark.asyncio
+async def test_data_messages_block_until_read(queue):
+    for number in range(3):
+        await queue.add_message(format_sse("data", {"chapter": number}))
+    producer = asyncio.create_task(queue.add_message(format_sse("data", {"chapter": 3})))
+    await asyncio.sleep(0.01)
+    assert not producer.done()
+    assert (await queue.get_message())['data'] == '{"chapter": 0}'
+    await asyncio.wait_for(producer, timeout=1)
+    metrics = queue.metrics()
+    assert metrics['blocked'] == 1
+    assert metrics['depth'] == 3
+    assert metrics['dropped'] == {}
+
+
+@pytest.mark.asyncio
+async def test_cleanup_releases_blocked_producer(queue):
+    for number in range(3):
+        await queue.add_message(format_sse("data", {"chapter": number}))
+    producer = asyncio.create_task(queue.add_message(format_sse("data", {"chapter": 3})))
+    await asyncio.sleep(0.01)
+    await queue.cleanup()
+    with pytest.raises(ValueError):
+        await asyncio.wait_for(producer, timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_every_subscriber_gets_every_message(queue):
+    first = queue.subscribe()
+    second = queue.subscribe()
+    await queue.add_message(format_sse("status", "one"))
+    await queue.add_message(format_sse("data", {"chapter": 1}))
+    first_messages = [await first.next() for _ in range(2)]
+    second_messages = [await second.next() for _ in range(2)]
+    assert [m.data for m in first_messages] == ["one", '{"chapter": 1}']
+    # Both subscribers get the same instances, so the encoding is shared.
+    assert first_messages == second_messages
+    encodings = []
+    for message in first_messages + second_messages:
+        message.encoded("test", lambda m: encodings.append(m.seq) or m.seq)
+    assert encodings == [first_messages[0].seq, first_messages[1].seq]
+    # Everyone has read everything.
+    assert queue.metrics()['depth'] == 0
+
+
+@pytest.mark.asyncio
+async def test_slowest_subscriber_holds_back_data(queue):
+    fast = queue.subscribe()
+    slow = queue.subscribe()
+    for number in range(3):
+        await queue.add_message(format_sse("data", {"chapter": number}))
+    for _ in range(3):
+        await fast.next()
+    producer = asyncio.create_task(queue.add_message(format_sse("data", {"chapter": 3})))
+    await asyncio.sleep(0.01)
+    assert not producer.done()
+    await slow.next()
+    await asyncio.wait_for(producer, timeout=1)
+    assert (await fast.next()).data == '{"chapter": 3}'
+
+
+@pytest.mark.asyncio
+async def test_unsubscribe_releases_queue(queue):
+    reader = queue.subscribe()
+    gone = queue.subscribe()
+    for number in range(3):
+        await queue.add_message(format_sse("data", {"chapter": number}))
+    for _ in range(3):
+        await reader.next()
+    producer = asyncio.create_task(queue.add_message(format_sse("data", {"chapter": 3})))
+    await asyncio.sleep(0.01)
+    assert not producer.done()
+    # A subscriber that disconnects without reading must not stall the job.
+    gone.close()
+    await asyncio.wait_for(producer, timeout=1)
+    assert queue.metrics()['subscribers'] == 1
+
+
+@pytest.mark.asyncio
+async def test_get_message_reader_ends_with_the_job(queue):
+    await queue.add_message(format_sse("data", {"chapter": 0}))
+    await queue.get_message()
+    assert queue.metrics()['subscribers'] == 1
+    await queue.initialize()
+    # The next job's messages aren't held for a reader that has gone.
+    assert queue.metrics()['subscribers'] == 0
+
+
+@pytest.mark.asyncio
+async def test_server_error_takes_the_place_of_a_status_message(queue):
+    await queue.add_message(format_sse("status", "Downloading"))
+    for number in range(2):
+        await queue.add_message(format_sse("data", {"chapter": number}))
+    await queue.add_message(format_sse("server-error", "Transcription cancelled."))
+    assert [(await queue.get_message())['event'] for _ in range(3)] == ["data", "data", "server-error"]
+
+
+@pytest.mark.asyncio
+async def test_server_error_gives_up_when_no_one_reads():
+    queue = MessageQueueManager(maxsize=2, overflow_timeout=0.05)
+    await queue.initialize()
+    for number in range(2):
+        await queue.add_message(format_sse("data", {"chapter": number}))
+    # A job that fails while no client is reading still ends.
+    await asyncio.wait_for(queue.add_message(format_sse("server-error", "Transcription cancelled.")), timeout=1)
+    assert queue.metrics()['dropped'] == {"server-error": 1}
@@ -0,0 +1,94 @@
+import pytest
+
+from app.service.audio_processing_model import AudioProcessRequest
+from app.service.exceptions_code import AudioTooLongException
+from app.service.message_queue_manager import initialize_message_queue_manager
+from app.service.metadata_extractor_code import MetadataExtractor
+from app.service.metadata_probe_code import MetadataProbes, MetadataProbesSingleton, check_duration
+from app.service.process_audio import process_audio
+from app.service.transcription_state_code import TranscriptionStatesSingleton, initialize_transcription_state
+from app.service.youtube_handler_code import YouTubeHandler
+
+
+def info_for(url, duration=600):
+    return {"id": "bckD_GK80oY", "title": "A talk: part 1", "duration": duration, "ext": "webm",
+            "tags": ["machine learning"], "chapters": [{"title": "Intro", "start_time": 0.0, "end_time": 60.0}]}
+
+
+@pytest.fixture
+def states(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(TranscriptionStatesSingleton, "_instance", None)
+    monkeypatch.setattr(MetadataProbesSingleton, "_instance", None)
+    return TranscriptionStatesSingleton.get_states()
+
+
+@pytest.mark.asyncio
+async def test_a_video_is_probed_once_whatever_the_url():
+    probes = MetadataProbes()
+    probed = []
+    def extract(url):
+        probed.append(url)
+        return info_for(url)
+    first = await probes.probe("https://youtu.be/bckD_GK80oY", extract)
+    first["title"] = "changed by the caller"
+    second = await probes.probe("https://www.youtube.com/watch?v=bckD_GK80oY&t=30", extract)
+    assert len(probed) == 1
+    assert second["title"] == "A talk: part 1"
+    assert probes.metrics()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_an_old_probe_is_probed_again():
+    probes = MetadataProbes(max_age=0)
+    probed = []
+    def extract(url):
+        probed.append(url)
+        return info_for(url)
+    await probes.probe("https://youtu.be/bckD_GK80oY", extract)
+    await probes.probe("https://youtu.be/bckD_GK80oY", extract)
+    assert len(probed) == 2
+
+
+def test_check_duration():
+    check_duration({"duration": 3600}, max_seconds=0)
+    check_duration({"duration": 3600}, max_seconds=3600)
+    with pytest.raises(AudioTooLongException):
+        check_duration({"title": "Long", "duration": 3601}, max_seconds=3600)
+
+
+@pytest.mark.asyncio
+async def test_the_state_is_set_up_before_the_download(states, monkeypatch):
+    monkeypatch.setattr(YouTubeHandler, "_extract_info_only", lambda self, ydl_opts, url: info_for(url))
+    audio_input = AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY")
+    key = states.make_key(audio_input)
+    async def download(self, queue, audio_input):
+        state = states.get_state(key)
+        assert state.basename == "A talk- part 1"
+        assert state.metadata.duration == "00:10:00"
+        assert [chapter.title for chapter in state.chapters] == ["Intro"]
+        info_dict, chapter_dicts = await YouTubeHandler(audio_input).probe_metadata()
+        return info_dict, chapter_dicts, "audio/A talk- part 1.webm"
+    monkeypatch.setattr(MetadataExtractor, "extract_metadata_and_chapter_dicts", download)
+    queue = await initialize_message_queue_manager()
+    state, local_audio_filename = await initialize_transcription_state(queue, audio_input)
+    assert local_audio_filename == "audio/A talk- part 1.webm"
+    assert state.metadata.tags == "machine_learning"
+    assert MetadataProbesSingleton.get_probes().metrics()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_a_video_that_is_too_long_is_not_downloaded(states, monkeypatch):
+    monkeypatch.setattr("app.service.metadata_probe_code.MAX_AUDIO_SECONDS", 3600)
+    monkeypatch.setattr(YouTubeHandler, "_extract_info_only", lambda self, ydl_opts, url: info_for(url, duration=7200))
+    async def download(self, queue, audio_input):
+        raise AssertionError("The audio was downloaded.")
+    monkeypatch.setattr(MetadataExtractor, "extract_metadata_and_chapter_dicts", download)
+    errors = []
+    async def send_sse_message(queue, event, data):
+        if event == "server-error":
+            errors.append(data)
+    monkeypatch.setattr("app.service.process_audio.send_sse_message", send_sse_message)
+    queue = await initialize_message_queue_manager()
+    await process_audio(queue, AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY"))
+    assert len(errors) == 1 and "02:00:00 long" in errors[0]
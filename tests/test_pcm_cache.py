@@ -0,0 +1,73 @@
+import os
+import wave
+
+import numpy as np
+import pytest
+
+from app.service.pcm_cache_code import PCM_SAMPLE_RATE, PCMCache
+
+
+class CountingDecoder:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, audio_path):
+        self.calls.append(audio_path)
+        # One second of a 440 Hz tone.
+        return np.sin(np.linspace(0, 2 * np.pi * 440, PCM_SAMPLE_RATE)).astype(np.float32)
+
+
+@pytest.fixture
+def decoder():
+    return CountingDecoder()
+
+
+def test_second_load_is_mapped_not_decoded(tmp_path, decoder):
+    cache = PCMCache(directory=str(tmp_path), decode=decoder)
+    first = cache.load("youtube_abc", "a.mp3")
+    second = cache.load("youtube_abc", "a.mp3")
+    assert decoder.calls == ["a.mp3"]
+    assert isinstance(second, np.memmap)
+    assert second.dtype == np.float32
+    np.testing.assert_array_equal(first, second)
+    # The mapping is read only, so a worker can't change what other workers read.
+    with pytest.raises(ValueError):
+        second[0] = 1.0
+    assert cache.metrics()["hits"] == 1 and cache.metrics()["misses"] == 1
+
+
+def test_least_recently_used_is_evicted(tmp_path, decoder):
+    one_second = PCM_SAMPLE_RATE * 4
+    cache = PCMCache(directory=str(tmp_path), max_bytes=2 * one_second, decode=decoder)
+    cache.load("first", "first.mp3")
+    cache.load("second", "second.mp3")
+    # Files written in the same instant can share an mtime, so "second" is made the older one, then "first" is used again.
+    os.utime(cache.location("second"), (1, 1))
+    cache.load("first", "first.mp3")
+    cache.load("third", "third.mp3")
+    assert os.path.exists(cache.location("first"))
+    assert not os.path.exists(cache.location("second"))
+    assert os.path.exists(cache.location("third"))
+    assert cache.metrics()["evictions"] == 1
+    assert cache.metrics()["bytes"] == 2 * one_second
+
+
+def test_identity_is_not_used_as_a_path(tmp_path, decoder):
+    cache = PCMCache(directory=str(tmp_path), decode=decoder)
+    cache.load("../../memo.mp3", "memo.mp3")
+    assert os.path.dirname(cache.location("../../memo.mp3")) == str(tmp_path)
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_real_audio_is_resampled_to_16_khz_mono(tmp_path):
+    audio_path = str(tmp_path / "tone.wav")
+    tone = (np.sin(np.linspace(0, 2 * np.pi * 440, 44100)) * 10000).astype(np.int16)
+    with wave.open(audio_path, "wb") as wav_file:
+        wav_file.setnchannels(2)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(44100)
+        wav_file.writeframes(np.repeat(tone, 2).tobytes())
+    cache = PCMCache(directory=str(tmp_path / "pcm"))
+    cache.load("tone", audio_path)
+    samples = cache.get("tone")
+    assert abs(len(samples) - PCM_SAMPLE_RATE) < 200
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+
+import pytest
+
+from app.service.progress_aggregator_code import ProgressAggregator, clean_ytdlp_message
+
+
+class FakeQueue:
+    def __init__(self):
+        self.messages = []
+
+    async def add_message(self, message):
+        self.messages.append(message)
+
+
+@pytest.mark.asyncio
+async def test_updates_are_coalesced():
+    queue = FakeQueue()
+    progress = ProgressAggregator(queue, min_interval=0.2)
+    for percent in range(100):
+        await progress.update(f"Transcribed {percent}%")
+    await asyncio.sleep(0.3)
+    await progress.flush()
+    # The first update goes out right away, the rest collapse into the latest one.
+    assert [m['data'] for m in queue.messages] == ["Transcribed 0%", "Transcribed 99%"]
+    assert progress.num_updates == 100
+
+
+@pytest.mark.asyncio
+async def test_final_update_is_sent_immediately():
+    queue = FakeQueue()
+    progress = ProgressAggregator(queue, min_interval=10)
+    await progress.update("Transcribed 10%")
+    await asyncio.sleep(0)
+    await progress.update("Transcribed 20%")
+    await progress.update("Transcribed 100%", final=True)
+    await asyncio.sleep(0.01)
+    assert [m['data'] for m in queue.messages] == ["Transcribed 10%", "Transcribed 100%"]
+
+
+@pytest.mark.asyncio
+async def test_threadsafe_updates_from_download_thread():
+    queue = FakeQueue()
+    loop = asyncio.get_running_loop()
+    progress = ProgressAggregator(queue, loop, min_interval=0.1, formatter=clean_ytdlp_message)
+
+    def download():
+        for i in range(1000):
+            progress.update_threadsafe(f"\x1b[0;94m {i}%\x1b[0m   of  10MiB")
+        progress.update_threadsafe("\x1b[0;94m100%\x1b[0m of 10MiB", final=True)
+
+    thread = threading.Thread(target=download)
+    thread.start()
+    await loop.run_in_executor(None, thread.join)
+    await asyncio.sleep(0.05)
+    await progress.flush()
+    assert len(queue.messages) < 10
+    assert queue.messages[-1] == {"event": "status", "data": "100% of 10MiB"}
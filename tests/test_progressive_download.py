@@ -0,0 +1,210 @@
+import asyncio
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import av
+import numpy as np
+import pytest
+
+from app.service.audio_processing_model import AudioProcessRequest
+from app.service.exceptions_code import YouTubeDownloadException
+from app.service.message_queue_manager import initialize_message_queue_manager
+from app.service.metadata_extractor_code import MetadataExtractor
+from app.service.metadata_shared_code import Metadata
+from app.service.pcm_cache_code import PCM_SAMPLE_RATE, PCMCache, PCMCacheSingleton
+from app.service.process_audio import transcribe_local_audio
+from app.service.progressive_download_code import ProgressiveDownload
+from app.service.transcription_code import TranscribeAudio
+from app.service.transcription_state_code import TranscriptionStatesSingleton, initialize_transcription_state
+from app.service.youtube_handler_code import YouTubeHandler
+
+
+def make_webm(path, seconds):
+    '''Opus in webm, the way YouTube sends audio.'''
+    with av.open(path, mode="w", format="webm") as container:
+        stream = container.add_stream("libopus", rate=48000)
+        stream.layout = "mono"
+        samples_per_frame = 960
+        t = np.arange(seconds * 48000) / 48000
+        audio = (np.sin(2 * np.pi * 220 * t) * 8000).astype(np.int16)
+        for start in range(0, len(audio), samples_per_frame):
+            frame = av.AudioFrame.from_ndarray(audio[start:start + samples_per_frame].reshape(1, -1), format="s16", layout="mono")
+            frame.rate = 48000
+            frame.pts = start
+            container.mux(stream.encode(frame))
+        container.mux(stream.encode(None))
+
+
+def write_slowly(content, partial_path, path, download, block_size=4096, pause=0.002):
+    with open(partial_path, "wb") as file_object:
+        for start in range(0, len(content), block_size):
+            file_object.write(content[start:start + block_size])
+            file_object.flush()
+            time.sleep(pause)
+    os.rename(partial_path, path)
+    download.finish(path)
+
+
+def test_reader_waits_for_bytes_that_have_not_arrived(tmp_path):
+    download = ProgressiveDownload(str(tmp_path / "talk.webm"))
+    download.partial_path = str(tmp_path / "talk.webm.part")
+    content = os.urandom(100_000)
+    writer = threading.Thread(target=write_slowly, args=(content, download.partial_path, download.path, download))
+    writer.start()
+    reader = download.reader()
+    try:
+        assert reader.read() == content
+    finally:
+        reader.close()
+        writer.join()
+
+
+def test_reader_raises_when_the_download_fails(tmp_path):
+    download = ProgressiveDownload(str(tmp_path / "talk.webm"))
+    download.partial_path = str(tmp_path / "talk.webm.part")
+    with open(download.partial_path, "wb") as file_object:
+        file_object.write(b"half")
+    reader = download.reader()
+    assert reader.read(4) == b"half"
+    download.finish(error=RuntimeError("connection reset"))
+    with pytest.raises(YouTubeDownloadException):
+        reader.read(4)
+    reader.close()
+
+
+def test_audio_is_decoded_while_it_downloads(tmp_path):
+    source = str(tmp_path / "source.webm")
+    make_webm(source, seconds=20)
+    with open(source, "rb") as file_object:
+        content = file_object.read()
+    download = ProgressiveDownload(str(tmp_path / "talk.webm"), duration=20)
+    download.partial_path = str(tmp_path / "talk.webm.part")
+    writer = threading.Thread(target=write_slowly, args=(content, download.partial_path, download.path, download),
+                              kwargs={"block_size": 2048, "pause": 0.01})
+    cache = PCMCache(directory=str(tmp_path / "pcm"))
+    reader = download.reader()
+    writer.start()
+    try:
+        stream = cache.stream("talk", reader, download.duration)
+        assert stream.duration == 20
+        first = next(iter(stream))
+        # The first samples arrive long before the download is done.
+        assert len(first) > 0 and not download.finished
+        samples = np.concatenate([first] + list(stream))
+    finally:
+        reader.close()
+        writer.join()
+    assert abs(len(samples) / PCM_SAMPLE_RATE - 20) < 0.1
+    # The decoded audio was cached along the way, and is what decoding the finished file gives.
+    np.testing.assert_array_equal(cache.get("talk"), samples)
+    from faster_whisper.audio import decode_audio
+    assert len(decode_audio(download.path, sampling_rate=PCM_SAMPLE_RATE)) == len(samples)
+
+
+class SlowFile(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    content = b""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/webm")
+        self.send_header("Content-Length", str(len(self.content)))
+        self.end_headers()
+        try:
+            for start in range(0, len(self.content), 4096):
+                self.wfile.write(self.content[start:start + 4096])
+                time.sleep(0.01)
+        except (BrokenPipeError, ConnectionResetError):
+            # yt-dlp's generic extractor reads the start of a URL to see what it is, then hangs up.
+            self.close_connection = True
+
+
+class FakeQueue:
+    async def add_message(self, message):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_metadata_is_returned_before_the_download_is_done(tmp_path):
+    source = str(tmp_path / "source.webm")
+    make_webm(source, seconds=20)
+    with open(source, "rb") as file_object:
+        SlowFile.content = file_object.read()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowFile)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    audio_directory = tmp_path / "audio"
+    audio_directory.mkdir()
+    url = f"http://127.0.0.1:{server.server_address[1]}/talk.webm"
+    handler = YouTubeHandler(AudioProcessRequest(youtube_url="https://www.youtube.com/watch?v=dQw4w9WgXcQ"))
+    try:
+        info_dict, chapter_dicts, download = await handler.start_progressive_download(
+            url, str(audio_directory), FakeQueue(), asyncio.get_running_loop())
+        assert isinstance(download, ProgressiveDownload)
+        assert not download.finished
+        assert chapter_dicts[0]["title"] == info_dict["title"]
+        path = await download.wait()
+    finally:
+        server.shutdown()
+    assert path == download.path and os.path.dirname(path) == str(audio_directory)
+    with open(path, "rb") as file_object:
+        assert file_object.read() == SlowFile.content
+    assert download.download_speed.endswith("MB/s")
+
+
+class FakeModel:
+    def transcribe(self, samples, **options):
+        duration = len(samples) / PCM_SAMPLE_RATE
+        return iter([]), SimpleNamespace(duration=duration, duration_after_vad=duration)
+
+
+@pytest.mark.asyncio
+async def test_cancelling_stops_a_read_that_waits_for_the_download(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(PCMCacheSingleton, "_instance", None)
+    monkeypatch.setattr("app.service.transcription_code.send_sse_message", lambda queue, event, data: asyncio.sleep(0))
+    source = str(tmp_path / "source.webm")
+    make_webm(source, seconds=20)
+    with open(source, "rb") as file_object:
+        content = file_object.read()
+    download = ProgressiveDownload(str(tmp_path / "talk.webm"), duration=20)
+    download.partial_path = str(tmp_path / "talk.webm.part")
+    # Half the audio has arrived, and then the download stalls.
+    with open(download.partial_path, "wb") as file_object:
+        file_object.write(content[:len(content) // 2])
+    transcriber = TranscribeAudio(window_seconds=60)
+    transcriber._model = FakeModel()
+    task = asyncio.create_task(transcribe_local_audio(transcriber, FakeQueue(), "talk", download, Metadata()))
+    await asyncio.sleep(0.5)
+    task.cancel()
+    start = time.perf_counter()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert time.perf_counter() - start < 1
+    assert download.cancelled
+    assert os.listdir(PCMCacheSingleton.get_cache().directory) == []
+
+
+@pytest.mark.asyncio
+async def test_the_download_is_cancelled_when_the_state_cant_be_set_up(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(TranscriptionStatesSingleton, "_instance", None)
+    download = ProgressiveDownload(str(tmp_path / "talk.webm"))
+    async def extract(self, queue, audio_input):
+        return {"title": "talk"}, [], download
+    monkeypatch.setattr(MetadataExtractor, "extract_metadata_and_chapter_dicts", extract)
+    async def probe(self, audio_input):
+        return None, None
+    monkeypatch.setattr(MetadataExtractor, "probe_metadata_and_chapter_dicts", probe)
+    async def add_new_state(*args, **kwargs):
+        raise RuntimeError("The state cache is full.")
+    monkeypatch.setattr("app.service.transcription_state_code.add_new_state", add_new_state)
+    queue = await initialize_message_queue_manager()
+    with pytest.raises(RuntimeError):
+        await initialize_transcription_state(queue, AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY"))
+    assert download.cancelled
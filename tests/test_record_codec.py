@@ -0,0 +1,139 @@
+import pickle
+
+import pytest
+
+from app.service.audio_processing_model import AudioProcessRequest
+from app.service.metadata_shared_code import Metadata
+from app.service.record_codec_code import FORMAT_VERSION, PREFIX, PackedRecord, RecordFormatException, pack_record
+from app.service.transcription_state_code import (Chapter, SegmentBlockWriter, TranscriptionState, TranscriptionStates,
+                                                  TranscriptSegment, TranscriptSegments, decode_records, encode_records)
+
+
+@pytest.fixture
+def metadata():
+    return Metadata(audio_input=AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY"), title="A talk", tags="one, two")
+
+
+@pytest.fixture
+def transcript_segments(metadata):
+    segments = [TranscriptSegment(float(start), float(start + 3), f" And then number {start} said something.") for start in range(0, 3600, 3)]
+    return TranscriptSegments(key="segments:youtube:bckD_GK80oY_tiny_int8_default", basename="A talk", metadata=metadata,
+                              chapter_dicts=[{"title": "", "start_time": 0.0, "end_time": 0.0}], duration=3600.0, segments=segments)
+
+
+def round_trip(value):
+    records = encode_records(value)
+    return decode_records(records[value.key], records.get)
+
+
+def test_state_round_trip(metadata):
+    state = TranscriptionState(key="key", basename="A talk", metadata=metadata,
+                               chapters=[Chapter(title="Intro", start_time=0.0, end_time=60.0, text="Hello ünïcode.", number=1),
+                                         Chapter(title="Body", start_time=60.0, end_time=120.5, text="Goodbye.", number=2)])
+    # The text of the chapters read back is decompressed when it is read, so the two are compared by what they hold.
+    assert round_trip(state).model_dump() == state.model_dump()
+
+
+def test_segments_round_trip_and_size(transcript_segments):
+    assert round_trip(transcript_segments) == transcript_segments
+    size = sum(len(data) for data in encode_records(transcript_segments).values())
+    assert size < len(pickle.dumps(transcript_segments)) / 4
+
+
+def test_text_is_decoded_on_demand():
+    record = PackedRecord(pack_record("state", {"key": "key"}, {"start_time": [0.0, 1.0]}, ["first", None], texts_per_block=1))
+    assert record.text(1) is None
+    assert list(record._decoded_blocks) == [1]
+    assert record.text(0) == "first"
+    assert record.column("start_time") == [0.0, 1.0]
+
+
+def test_chapter_text_is_decompressed_when_it_is_read(tmp_path, metadata, monkeypatch):
+    states = TranscriptionStates(cache_dir=str(tmp_path / "state_cache"))
+    states.add_state(TranscriptionState(key="key", basename="A talk", metadata=metadata,
+                                        chapters=[Chapter(start_time=0.0, end_time=60.0, text="First."),
+                                                  Chapter(start_time=60.0, end_time=120.0, text="Second.")]))
+    states.memory.clear()
+    read = []
+    text = PackedRecord.text
+    monkeypatch.setattr(PackedRecord, "text", lambda record, index: read.append(index) or text(record, index))
+    state = states.get_state("key")
+    assert state.is_complete()
+    assert read == []
+    assert state.chapters[1].to_dict_with_start_end_strings()["text"] == "Second."
+    assert len(read) == 1
+    assert state.model_dump()["chapters"][0]["text"] == "First."
+
+
+def test_copy_of_a_cached_chapter_keeps_its_text(tmp_path, metadata):
+    states = TranscriptionStates(cache_dir=str(tmp_path / "state_cache"))
+    states.add_state(TranscriptionState(key="key", basename="A talk", metadata=metadata,
+                                        chapters=[Chapter(start_time=0.0, end_time=60.0, text="First.")]))
+    states.memory.clear()
+    chapter = states.get_state("key").chapters[0]
+    copied = chapter.model_copy(deep=True)
+    copied.text += " Changed."
+    assert (chapter.text, copied.text) == ("First.", "First. Changed.")
+
+
+def test_unknown_version_is_a_cache_miss(tmp_path, transcript_segments):
+    states = TranscriptionStates(cache_dir=str(tmp_path / "state_cache"))
+    data = bytearray(encode_records(transcript_segments)[transcript_segments.key])
+    data[PREFIX.size - 5] = FORMAT_VERSION + 1
+    with pytest.raises(RecordFormatException):
+        PackedRecord(bytes(data))
+    states.cache[transcript_segments.key] = bytes(data)
+    assert states.get_segments(transcript_segments.key) is None
+
+
+def test_chapters_are_written_on_their_own(tmp_path, metadata):
+    states = TranscriptionStates(cache_dir=str(tmp_path / "state_cache"))
+    state = TranscriptionState(key="key", basename="A talk", metadata=metadata,
+                               chapters=[Chapter(start_time=0.0, end_time=60.0), Chapter(start_time=60.0, end_time=120.0)])
+    states.add_state(state)
+    assert len(states.cache) == 1  # Only the metadata. No chapter has text yet.
+
+    writes = []
+    set_record = states.cache.set
+    states.cache.set = lambda key, *args, **kwargs: writes.append(key) or set_record(key, *args, **kwargs)
+    states.add_chapter("key", 1, Chapter(start_time=60.0, end_time=120.0, text="Second."))
+    assert writes == ["key#chapter:1"]
+    assert [chapter.text for chapter in states.get_state("key").chapters] == [None, "Second."]
+
+    # With the chapters written, the last write only stores the metadata.
+    writes.clear()
+    state.chapters[1].text = "Second."
+    states.add_state(state, num_chapters_written=2)
+    assert writes == ["key"]
+
+    states.delete_state("key")
+    assert len(states.cache) == 0
+
+
+def test_segments_are_not_visible_until_complete(tmp_path, transcript_segments):
+    states = TranscriptionStates(cache_dir=str(tmp_path / "state_cache"))
+    states.add_segment_block(transcript_segments.key, 0, transcript_segments.segments[:256])
+    assert states.get_segments(transcript_segments.key) is None
+    states.add_segments(transcript_segments, num_blocks_written=1)
+    assert states.get_segments(transcript_segments.key) == transcript_segments
+
+
+@pytest.mark.asyncio
+async def test_segment_blocks_are_written_as_the_windows_are_transcribed(tmp_path, transcript_segments):
+    states = TranscriptionStates(cache_dir=str(tmp_path / "state_cache"))
+    writes = []
+    set_record = states.cache.set
+    states.cache.set = lambda key, *args, **kwargs: writes.append(key) or set_record(key, *args, **kwargs)
+    block_writer = SegmentBlockWriter(states, transcript_segments.key)
+    # Windows of 300 segments. Only full blocks of 256 are written.
+    for end in range(300, 1500, 300):
+        await block_writer.write(transcript_segments.segments[:end])
+    assert block_writer.num_blocks_written == 4
+    assert writes == [f"{transcript_segments.key}#block:{index}" for index in range(4)]
+    assert states.get_segments(transcript_segments.key) is None
+
+    writes.clear()
+    await states.add_segments_async(transcript_segments, block_writer.num_blocks_written)
+    assert writes == [f"{transcript_segments.key}#block:4", transcript_segments.key]
+    states.memory.clear()
+    assert states.get_segments(transcript_segments.key) == transcript_segments
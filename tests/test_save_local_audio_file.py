@@ -0,0 +1,115 @@
+import os
+
+import pytest
+
+from app.service.audio_processing_model import AudioProcessRequest
+from app.service.exceptions_code import UploadValidationException
+from app.service.multipart_upload_code import AudioFormParser
+from app.service.transcription_state_code import TranscriptionStates
+from app.service.upload_writer_code import AudioUploadWriter
+
+RECORDING_ONE = b"ID3\x04\x00\x00\x00\x00\x00\x00 recording one"
+RECORDING_TWO = b"ID3\x04\x00\x00\x00\x00\x00\x00 recording two"
+BOUNDARY = "----recordingboundary"
+CONTENT_TYPE = f"multipart/form-data; boundary={BOUNDARY}"
+
+
+def multipart_body(filename, content, fields=None):
+    body = b""
+    for name, value in (fields or {}).items():
+        body += f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+    body += f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="upload_file"; filename="{filename}"\r\n'.encode()
+    body += b"Content-Type: application/octet-stream\r\n\r\n" + content + b"\r\n"
+    return body + f"--{BOUNDARY}--\r\n".encode()
+
+
+async def chunks_of(body, size):
+    for index in range(0, len(body), size):
+        yield body[index:index + size]
+
+
+async def save_local_audio_file(filename, content, chunk_size=1024):
+    _, saved = await AudioFormParser(CONTENT_TYPE, chunks_of(multipart_body(filename, content), chunk_size)).parse()
+    return saved.location, saved.audio_hash
+
+
+@pytest.fixture
+def audio_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path / "audio"
+
+
+@pytest.mark.asyncio
+async def test_same_content_same_hash(audio_directory):
+    location, audio_hash = await save_local_audio_file("memo.mp3", RECORDING_ONE)
+    other_location, other_hash = await save_local_audio_file("renamed.mp3", RECORDING_ONE, chunk_size=5)
+    assert audio_hash == other_hash
+    assert location == other_location == os.path.join(str(audio_directory), audio_hash + ".mp3")
+    # No leftover temporary files.
+    assert os.listdir(audio_directory) == [audio_hash + ".mp3"]
+
+
+@pytest.mark.asyncio
+async def test_same_name_different_content(audio_directory):
+    _, audio_hash = await save_local_audio_file("memo.mp3", RECORDING_ONE)
+    _, other_hash = await save_local_audio_file("memo.mp3", RECORDING_TWO)
+    assert audio_hash != other_hash
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("filename, content", [
+    ("notes.txt", RECORDING_ONE),
+    ("memo.mp3", b"<html>not audio at all</html>"),
+])
+async def test_rejects_what_is_not_audio(audio_directory, filename, content):
+    with pytest.raises(UploadValidationException):
+        await save_local_audio_file(filename, content)
+    assert not audio_directory.exists() or os.listdir(audio_directory) == []
+
+
+@pytest.mark.asyncio
+async def test_fields_are_read_around_the_file(audio_directory):
+    body = multipart_body("memo.mp3", RECORDING_ONE, {"audio_quality": "tiny", "chapter_chunk_time": "5"})
+    fields, saved = await AudioFormParser(CONTENT_TYPE, chunks_of(body, 7)).parse()
+    assert fields == {"audio_quality": "tiny", "chapter_chunk_time": "5"}
+    assert saved.filename == "memo.mp3"
+    with open(saved.location, "rb") as file_object:
+        assert file_object.read() == RECORDING_ONE
+
+
+@pytest.mark.asyncio
+async def test_body_that_ends_mid_file_leaves_nothing(audio_directory):
+    body = multipart_body("memo.mp3", RECORDING_ONE + b"x" * 100)
+    with pytest.raises(UploadValidationException):
+        await AudioFormParser(CONTENT_TYPE, chunks_of(body[:-60], 16)).parse()
+    assert not audio_directory.exists() or os.listdir(audio_directory) == []
+
+
+@pytest.mark.asyncio
+async def test_rejects_too_big_while_writing(tmp_path):
+    writer = AudioUploadWriter("memo.mp3", audio_directory=str(tmp_path), max_bytes=64)
+    with pytest.raises(UploadValidationException):
+        async with writer:
+            await writer.write(RECORDING_ONE)
+            await writer.write(b"x" * 64)
+    assert writer.num_bytes == len(RECORDING_ONE) + 64
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.asyncio
+async def test_format_is_checked_across_small_chunks(tmp_path):
+    async with AudioUploadWriter("memo.wav", audio_directory=str(tmp_path)) as writer:
+        for index in range(0, 16, 3):
+            await writer.write(b"RIFF\x24\x00\x00\x00WAVEfmt "[index:index + 3])
+        _, audio_hash = await writer.finish()
+    assert writer.audio_format == "wav"
+    assert os.listdir(tmp_path) == [audio_hash + ".wav"]
+
+
+def test_key_uses_hash_not_filename(tmp_path):
+    states = TranscriptionStates(cache_dir=str(tmp_path / "state_cache"))
+    first = AudioProcessRequest(audio_filename="memo.mp3", audio_hash="a" * 64)
+    second = AudioProcessRequest(audio_filename="other.mp3", audio_hash="a" * 64)
+    third = AudioProcessRequest(audio_filename="memo.mp3", audio_hash="b" * 64)
+    assert states.make_key(first) == states.make_key(second)
+    assert states.make_key(first) != states.make_key(third)
@@ -0,0 +1,87 @@
+import time
+
+import pytest
+
+from app.service.audio_processing_model import AudioProcessRequest
+from app.service.message_queue_manager import initialize_message_queue_manager
+from app.service.metadata_shared_code import Metadata
+from app.service.transcription_code import TranscribeAudio
+from app.service.transcription_state_code import (Chapter, TranscriptionStatesSingleton, TranscriptSegment,
+                                                  TranscriptSegments, initialize_transcription_state)
+
+
+@pytest.fixture
+def segments():
+    # An hour of 30 second segments.
+    return [TranscriptSegment(start=float(start), end=float(start + 30), text=f" words at {start}.") for start in range(0, 3600, 30)]
+
+
+@pytest.fixture
+def states(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(TranscriptionStatesSingleton, "_instance", None)
+    return TranscriptionStatesSingleton.get_states()
+
+
+def test_rechaptering_does_not_load_the_model(segments):
+    start = time.time()
+    ten_minute_chapters = TranscribeAudio(chapter_chunk_time=10).make_chapters(segments, 3600.0, [Chapter(start_time=0.0, end_time=0.0)])
+    five_minute_chapters = TranscribeAudio(chapter_chunk_time=5).make_chapters(segments, 3600.0, [Chapter(start_time=0.0, end_time=0.0)])
+    assert time.time() - start < 1
+    assert len(five_minute_chapters) > len(ten_minute_chapters) > 1
+
+
+def test_segments_key_ignores_chapter_chunk_time(states):
+    ten = AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY", chapter_chunk_time=10)
+    five = AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY", chapter_chunk_time=5)
+    other_model = AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY", audio_quality="small")
+    assert states.make_key(ten) != states.make_key(five)
+    assert states.make_segments_key(ten) == states.make_segments_key(five)
+    assert states.make_segments_key(ten) != states.make_segments_key(other_model)
+
+
+@pytest.mark.asyncio
+async def test_cached_segments_skip_the_download(states, segments):
+    cached_input = AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY", chapter_chunk_time=10)
+    chapter_dicts = [{"title": "Video", "start_time": 0.0, "end_time": 0.0}]
+    states.add_segments(TranscriptSegments(key=states.make_segments_key(cached_input), basename="Video",
+                                           metadata=Metadata(title="Video", audio_input=cached_input),
+                                           chapter_dicts=chapter_dicts, duration=3600.0, segments=segments))
+
+    audio_input = AudioProcessRequest(youtube_url="https://www.youtube.com/watch?v=bckD_GK80oY", chapter_chunk_time=5)
+    queue = await initialize_message_queue_manager()
+    # No MetadataExtractor call: there is no network in this test.
+    state, local_audio_filename = await initialize_transcription_state(queue, audio_input)
+    assert local_audio_filename is None
+    assert state.key == states.make_key(audio_input)
+    assert state.metadata.audio_input.chapter_chunk_time == 5
+    assert state.basename == "Video"
+
+
+def add_cached_segments(states, audio_input, segments):
+    states.add_segments(TranscriptSegments(key=states.make_segments_key(audio_input), basename="Video",
+                                           metadata=Metadata(title="Video", audio_input=audio_input),
+                                           duration=3600.0, segments=segments))
+
+
+def test_higher_quality_segments_need_opt_in(states, segments):
+    add_cached_segments(states, AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY", audio_quality="large"), segments)
+    assert states.find_segments(AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY", audio_quality="tiny")) is None
+    found = states.find_segments(AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY", audio_quality="tiny", allow_higher_quality=True))
+    assert found.metadata.audio_input.audio_quality == "large"
+
+
+def test_lower_quality_segments_are_not_used(states, segments):
+    add_cached_segments(states, AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY", audio_quality="default"), segments)
+    audio_input = AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY", audio_quality="medium", allow_higher_quality=True)
+    assert states.find_segments(audio_input) is None
+
+
+@pytest.mark.asyncio
+async def test_metadata_reports_the_model_used(states, segments):
+    add_cached_segments(states, AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY", audio_quality="medium"), segments)
+    audio_input = AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY", audio_quality="small", allow_higher_quality=True)
+    queue = await initialize_message_queue_manager()
+    state, _ = await initialize_transcription_state(queue, audio_input)
+    assert state.metadata.transcription_model == "medium"
+    assert state.metadata.audio_input.audio_quality == "small"
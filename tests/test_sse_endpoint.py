@@ -0,0 +1,60 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app.routes.sse_endpoint import HEARTBEAT_MESSAGE, event_generator, sse_endpoint
+from app.service.message_queue_manager import initialize_message_queue_manager
+from app.service.utils import format_sse
+
+
+def test_heartbeat_is_a_comment():
+    # Lines starting with a colon are ignored by EventSource clients.
+    assert HEARTBEAT_MESSAGE.startswith(b":")
+
+
+@pytest.mark.asyncio
+async def test_idle_event_generators_share_the_encoded_message():
+    queue = await initialize_message_queue_manager()
+    request = SimpleNamespace(app=SimpleNamespace(state=SimpleNamespace(message_queue_manager=queue, task=None)))
+    generators = [event_generator(request) for _ in range(100)]
+    reads = [asyncio.create_task(generator.__anext__()) for generator in generators]
+    await asyncio.sleep(0.05)
+    assert queue.metrics()['subscribers'] == 100
+
+    await queue.add_message(format_sse("status", "hello"))
+    sent = await asyncio.gather(*reads)
+    # Every connection sends the same encoded bytes.
+    assert len({id(message) for message in sent}) == 1
+    assert b"event: status" in sent[0]
+
+    for generator in generators:
+        await generator.aclose()
+    assert queue.metrics()['subscribers'] == 0
+
+
+@pytest.mark.asyncio
+async def test_idle_connections_send_the_shared_bytes():
+    # Through EventSourceResponse, the way /api/v1/sse serves them.
+    queue = await initialize_message_queue_manager()
+    request = SimpleNamespace(app=SimpleNamespace(state=SimpleNamespace(message_queue_manager=queue, task=None)))
+    disconnected = asyncio.Event()
+    bodies = []
+    async def receive():
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            bodies.append(message["body"])
+    responses = [asyncio.create_task((await sse_endpoint(request))({"type": "http"}, receive, send)) for _ in range(10)]
+    await asyncio.sleep(0.05)
+    assert queue.metrics()['subscribers'] == 10
+
+    await queue.add_message(format_sse("status", "hello"))
+    await asyncio.sleep(0.05)
+    assert len(bodies) == 10 and b"event: status" in bodies[0]
+    assert len({id(body) for body in bodies}) == 1
+
+    disconnected.set()
+    await asyncio.gather(*responses)
+    assert queue.metrics()['subscribers'] == 0
@@ -0,0 +1,112 @@
+import os
+
+from diskcache import Cache
+import pytest
+
+from app.service.audio_processing_model import AudioProcessRequest
+from app.service.metadata_shared_code import Metadata
+from app.service.transcription_state_code import KEY_VERSION, KEY_VERSION_KEY, Chapter, TranscriptionState, TranscriptionStates
+
+
+@pytest.fixture
+def states(tmp_path):
+    return TranscriptionStates(cache_dir=str(tmp_path / "state_cache"))
+
+
+@pytest.mark.parametrize("youtube_url", [
+    "https://www.youtube.com/watch?v=bckD_GK80oY",
+    "https://youtube.com/watch?v=bckD_GK80oY&t=30",
+    "https://youtu.be/bckD_GK80oY",
+    "youtu.be/bckD_GK80oY?t=12",
+    "https://www.youtube.com/embed/bckD_GK80oY",
+    "https://m.youtube.com/watch?feature=share&v=bckD_GK80oY",
+])
+def test_url_forms_share_a_key(states, youtube_url):
+    audio_input = AudioProcessRequest(youtube_url=youtube_url, audio_quality="tiny")
+    assert states.make_key(audio_input) == "youtube:bckD_GK80oY_tiny_int8_10"
+
+
+def test_migrate_url_keys(states):
+    audio_input = AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY", audio_quality="tiny")
+    old_key = audio_input.youtube_url + "_tiny_int8_10"
+    state = TranscriptionState(key=old_key, basename="video", metadata=Metadata(audio_input=audio_input),
+                               chapters=[Chapter(start_time=0.0, end_time=0.0, text="hello", number=1)])
+    states.cache[old_key] = state
+
+    assert states.migrate_keys() == 1
+    new_key = states.make_key(audio_input)
+    assert states.get_state(old_key) is None
+    assert states.get_state(new_key).key == new_key
+    assert states.cache[KEY_VERSION_KEY] == KEY_VERSION
+    # Already migrated.
+    assert states.migrate_keys() == 0
+
+
+def test_unsharded_cache_is_moved_into_shards(tmp_path):
+    cache_dir = str(tmp_path / "state_cache")
+    audio_input = AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY", audio_quality="tiny")
+    key = "youtube:bckD_GK80oY_tiny_int8_10"
+    state = TranscriptionState(key=key, basename="video", metadata=Metadata(audio_input=audio_input),
+                               chapters=[Chapter(start_time=0.0, end_time=0.0, text="hello", number=1)])
+    with Cache(cache_dir) as unsharded:
+        unsharded[key] = state
+
+    states = TranscriptionStates(cache_dir=cache_dir)
+    states.migrate_keys()
+    assert not os.path.exists(os.path.join(cache_dir, "cache.db"))
+    assert states.get_state(key).is_complete()
+
+
+def without_fields(model, *field_names):
+    # Unpickling sets __dict__ as it was pickled, so a field a model didn't have then stays missing.
+    for field_name in field_names:
+        del model.__dict__[field_name]
+    return model
+
+
+def baseline_state(key, audio_input):
+    '''A state as the first version of the service pickled it: without the fields added since, and chapters without
+    private attributes.'''
+    audio_input = without_fields(audio_input.model_copy(), "audio_hash", "decoding_profile", "allow_higher_quality", "use_captions")
+    metadata = without_fields(Metadata(audio_input=audio_input), "download_speed", "transcription_model")
+    chapter = Chapter(start_time=0.0, end_time=0.0, number=1)
+    chapter.__dict__["text"] = "hello"
+    object.__setattr__(chapter, "__pydantic_private__", None)
+    return TranscriptionState.model_construct(key=key, basename="audio", metadata=metadata, chapters=[chapter])
+
+
+def test_migrate_baseline_pickles(states):
+    upload_input = AudioProcessRequest(audio_filename="memo.mp3", audio_quality="tiny")
+    upload_key = "memo.mp3_" + upload_input.audio_quality + "_int8_10"
+    youtube_input = AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY", audio_quality="tiny")
+    youtube_key = youtube_input.youtube_url + "_" + youtube_input.audio_quality + "_int8_10"
+    states.cache[upload_key] = baseline_state(upload_key, upload_input)
+    states.cache[youtube_key] = baseline_state(youtube_key, youtube_input)
+    assert "use_captions" not in states.cache[upload_key].metadata.audio_input.__dict__
+
+    assert states.migrate_keys() == 1
+    # The upload was keyed by its filename, which make_key() still uses when there is no audio_hash.
+    state = states.get_state(upload_key)
+    assert state.is_complete() and state.chapters[0].text == "hello"
+    assert state.metadata.audio_input.audio_hash is None and not state.metadata.audio_input.use_captions
+    # Without use_captions, the state isn't keyed as a transcript made from captions.
+    youtube_key = "youtube:bckD_GK80oY_" + youtube_input.audio_quality + "_int8_10"
+    state = states.get_state(youtube_key)
+    assert state.is_complete() and state.metadata.transcription_model is None
+    assert states.make_key(state.metadata.audio_input) == youtube_key
+    # find_segments() looks for captions first when the request asked for them.
+    assert states.find_segments(state.metadata.audio_input) is None
+
+
+def test_migrate_skips_unreadable_entries(states):
+    audio_input = AudioProcessRequest(youtube_url="https://youtu.be/bckD_GK80oY", audio_quality="tiny")
+    broken_key = "broken_tiny_int8_10"
+    broken = baseline_state(broken_key, audio_input)
+    del broken.__dict__["key"]
+    states.cache[broken_key] = broken
+    old_key = audio_input.youtube_url + "_tiny_int8_10"
+    states.cache[old_key] = baseline_state(old_key, audio_input)
+
+    assert states.migrate_keys() == 1
+    assert states.get_state(states.make_key(audio_input)).is_complete()
+    assert states.cache[KEY_VERSION_KEY] == KEY_VERSION
@@ -0,0 +1,37 @@
+import threading
+
+import pytest
+
+from app.service.metadata_shared_code import Metadata
+from app.service.transcription_state_code import Chapter, TranscriptionState, TranscriptionStates
+
+
+@pytest.fixture
+def states(tmp_path):
+    return TranscriptionStates(cache_dir=str(tmp_path / "state_cache"))
+
+
+def make_state(key: str) -> TranscriptionState:
+    return TranscriptionState(key=key, basename="basename", metadata=Metadata(title="title"),
+                              chapters=[Chapter(start_time=0.0, end_time=0.0, text="Some words.")])
+
+
+@pytest.mark.asyncio
+async def test_disk_io_runs_off_the_event_loop(states, monkeypatch):
+    threads = []
+    load = states._load_with_expiry
+    def recording_load(key):
+        threads.append(threading.current_thread())
+        return load(key)
+    monkeypatch.setattr(states, "_load_with_expiry", recording_load)
+
+    await states.add_state_async(make_state("key"))
+    states.memory.clear()
+    assert (await states.get_state_async("key")).is_complete()
+    assert threads and threading.main_thread() not in threads
+    # Now it is in memory and no thread is needed.
+    await states.get_state_async("key")
+    assert len(threads) == 1
+
+    await states.delete_state_async("key")
+    assert await states.get_state_async("key") is None
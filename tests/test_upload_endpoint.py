@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import os
+import time
+from types import SimpleNamespace
+
+from fastapi.testclient import TestClient
+import pytest
+
+import app.routes.process_audio_endpoint as process_audio_endpoint
+from app.service.message_queue_manager import initialize_message_queue_manager
+from app.service.transcription_state_code import TranscriptionStatesSingleton
+from app.service.upload_session_code import UploadSessions
+
+RECORDING = b"RIFF\x24\x00\x00\x00WAVEfmt " + bytes(range(256)) * 40
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(TranscriptionStatesSingleton, "_instance", None)
+    jobs = []
+    def fake_process_audio(queue, audio_input):
+        # Recorded when the task is created, so the test doesn't depend on when the task runs.
+        jobs.append(audio_input)
+        return asyncio.sleep(0)
+    monkeypatch.setattr(process_audio_endpoint, "process_audio", fake_process_audio)
+    from app.main import app
+    with TestClient(app) as client:
+        client.jobs = jobs
+        yield client
+
+
+def test_resumed_upload_becomes_a_job(client):
+    upload = client.post("/api/v1/uploads", json={"filename": "field recording.wav", "size": len(RECORDING)}).json()
+    url = f"/api/v1/uploads/{upload['upload_id']}"
+    middle = len(RECORDING) // 2
+
+    # The second half arrives first, then the connection drops partway through the first half.
+    assert client.put(url, params={"offset": middle}, content=RECORDING[middle:]).json()["ranges"] == [[middle, len(RECORDING)]]
+    client.put(url, params={"offset": 0}, content=RECORDING[:100])
+    status = client.get(url).json()
+    assert status["ranges"] == [[0, 100], [middle, len(RECORDING)]]
+    assert client.post(url + "/finalize", json={}).status_code == 409
+
+    # Resume after the bytes that arrived.
+    client.put(url, params={"offset": 100}, content=RECORDING[100:middle])
+    assert client.get(url).json()["complete"]
+    response = client.post(url + "/finalize", json={"audio_quality": "tiny"}).json()
+    assert response["status"] == "Transcription process has started."
+
+    audio_hash = hashlib.sha256(RECORDING).hexdigest()
+    assert response["audio_url"] == f"/audio/{audio_hash}.wav"
+    assert client.jobs[0].audio_hash == audio_hash
+    assert client.jobs[0].audio_filename == "field recording.wav"
+    assert sorted(os.listdir("audio")) == [audio_hash + ".wav", "uploads"]
+    assert os.listdir("audio/uploads") == []
+    assert client.get(url).status_code == 404
+
+
+def test_chunk_past_the_end_is_rejected(client):
+    upload = client.post("/api/v1/uploads", json={"filename": "memo.wav", "size": 10}).json()
+    response = client.put(f"/api/v1/uploads/{upload['upload_id']}", params={"offset": 5}, content=b"x" * 6)
+    assert response.status_code == 400
+
+
+def test_unsupported_format_is_rejected(client):
+    assert client.post("/api/v1/uploads", json={"filename": "notes.txt", "size": 10}).status_code == 400
+
+
+def test_form_upload_becomes_a_job(client):
+    response = client.post("/api/v1/process_audio", data={"audio_quality": "tiny", "use_captions": "false"},
+                           files={"upload_file": ("memo.wav", RECORDING, "audio/wav")})
+    assert response.json()["status"] == "Transcription process has started."
+    assert client.jobs[0].audio_filename == "memo.wav"
+    assert client.jobs[0].audio_hash == hashlib.sha256(RECORDING).hexdigest()
+    # The upload is served under the name it is stored with.
+    assert client.get(response.json()["audio_url"]).content == RECORDING
+
+
+def test_form_is_described_for_the_swagger_ui(client):
+    request_body = client.get("/openapi.json").json()["paths"]["/api/v1/process_audio"]["post"]["requestBody"]
+    properties = request_body["content"]["multipart/form-data"]["schema"]["properties"]
+    assert properties["upload_file"]["format"] == "binary"
+    assert set(properties) >= {"youtube_url", "audio_quality", "compute_type", "chapter_chunk_time", "use_captions"}
+
+
+def test_chunk_sent_again_with_other_bytes_is_hashed_again(client):
+    upload = client.post("/api/v1/uploads", json={"filename": "memo.wav", "size": len(RECORDING)}).json()
+    url = f"/api/v1/uploads/{upload['upload_id']}"
+    client.put(url, params={"offset": 0}, content=b"x" * 100)
+    client.put(url, params={"offset": 0}, content=RECORDING)
+    client.post(url + "/finalize", json={})
+    assert client.jobs[0].audio_hash == hashlib.sha256(RECORDING).hexdigest()
+
+
+@pytest.mark.asyncio
+async def test_files_of_ended_sessions_are_removed(tmp_path):
+    sessions = UploadSessions(audio_directory=str(tmp_path), ttl=60)
+    live = await sessions.create("live.wav", 10)
+    session_directory = os.path.dirname(live.part_location)
+    old = os.path.join(session_directory, "left-by-a-restart.part")
+    recent = os.path.join(session_directory, "another-process.part")
+    for path in (old, recent):
+        with open(path, "wb") as file_object:
+            file_object.write(b"x")
+    os.utime(old, (time.time() - 120, time.time() - 120))
+    os.utime(live.part_location, (time.time() - 120, time.time() - 120))
+    sessions.remove_expired()
+    assert sorted(os.listdir(session_directory)) == sorted([os.path.basename(live.part_location), "another-process.part"])
+
+
+@pytest.mark.asyncio
+async def test_next_job_stops_the_one_still_running():
+    queue = await initialize_message_queue_manager()
+    subscription = queue.subscribe()
+    async def running_job():
+        while True:
+            await queue.add_message({"event": "status", "data": "old job"})
+            await asyncio.sleep(0.001)
+    previous_task = asyncio.create_task(running_job())
+    request = SimpleNamespace(app=SimpleNamespace(state=SimpleNamespace(message_queue_manager=queue, task=previous_task)))
+    await asyncio.sleep(0.01)
+
+    assert await process_audio_endpoint.prepare_message_queue(request) is queue
+    assert previous_task.cancelled()
+    await queue.add_message({"event": "status", "data": "new job"})
+    await asyncio.sleep(0.01)
+    # The subscriber follows the new job, and only sees its messages.
+    assert [queued_message.data for queued_message in queue.queue] == ["new job"]
+    assert (await subscription.next()).data == "new job"
@@ -0,0 +1,119 @@
+import asyncio
+import os
+import time
+import tracemalloc
+import wave
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from app.service.pcm_cache_code import PCM_SAMPLE_RATE, PCMCache, PCMStream
+from app.service.transcription_code import TranscribeAudio, audio_windows
+
+
+def chunks_of_noise(seconds, chunk_samples=1152):
+    rng = np.random.default_rng(0)
+    for _ in range(seconds * PCM_SAMPLE_RATE // chunk_samples):
+        yield rng.standard_normal(chunk_samples, dtype=np.float32)
+
+
+def peak_bytes_of_windows(seconds):
+    tracemalloc.start()
+    for _ in audio_windows(chunks_of_noise(seconds), 60 * PCM_SAMPLE_RATE, 5 * PCM_SAMPLE_RATE):
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def test_memory_does_not_grow_with_the_audio():
+    assert peak_bytes_of_windows(20 * 60) < 1.2 * peak_bytes_of_windows(3 * 60)
+
+
+def test_windows_split_at_the_quiet_part():
+    audio = np.ones(25 * PCM_SAMPLE_RATE, dtype=np.float32)
+    # A pause 8 seconds into the audio, inside the last 5 seconds of the first 10 second window.
+    audio[8 * PCM_SAMPLE_RATE:int(8.2 * PCM_SAMPLE_RATE)] = 0.0
+    windows = list(audio_windows([audio[:7000], audio[7000:]], 10 * PCM_SAMPLE_RATE, 5 * PCM_SAMPLE_RATE))
+    first_offset, first = windows[0]
+    assert first_offset == 0.0
+    assert 8.0 <= len(first) / PCM_SAMPLE_RATE <= 8.2
+    # Nothing is lost or repeated between the windows.
+    np.testing.assert_array_equal(np.concatenate([samples for _, samples in windows]), audio)
+    assert windows[1][0] == len(first) / PCM_SAMPLE_RATE
+
+
+class FakeModel:
+    '''Returns one segment per window, covering all of it.'''
+    def __init__(self):
+        self.windows = []
+        self.prompts = []
+
+    def transcribe(self, samples, **options):
+        self.windows.append(len(samples))
+        self.prompts.append(options.get("initial_prompt"))
+        duration = len(samples) / PCM_SAMPLE_RATE
+        segment = SimpleNamespace(start=0.0, end=duration, text=f" window {len(self.windows)}")
+        return iter([segment]), SimpleNamespace(duration=duration, duration_after_vad=duration)
+
+
+class FakeQueue:
+    def __init__(self):
+        self.messages = []
+
+    async def add_message(self, message):
+        self.messages.append(message)
+
+
+@pytest.mark.asyncio
+async def test_transcribes_window_by_window_and_fills_the_pcm_cache(tmp_path, monkeypatch):
+    async def send_now(queue, event, data):
+        await queue.add_message({"event": event, "data": data})
+    monkeypatch.setattr("app.service.transcription_code.send_sse_message", send_now)
+    audio_path = str(tmp_path / "talk.wav")
+    with wave.open(audio_path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(PCM_SAMPLE_RATE)
+        wav_file.writeframes((np.ones(25 * PCM_SAMPLE_RATE) * 1000).astype(np.int16).tobytes())
+    cache = PCMCache(directory=str(tmp_path / "pcm"))
+    transcriber = TranscribeAudio(window_seconds=10)
+    transcriber._model = FakeModel()
+
+    segments_by_window = []
+    async def on_window(segments):
+        segments_by_window.append(len(segments))
+    segments, duration = await transcriber.transcribe_segments(FakeQueue(), cache.stream("talk", audio_path), on_window)
+
+    assert all(length <= 10 * PCM_SAMPLE_RATE for length in transcriber._model.windows)
+    assert duration == pytest.approx(25.0, abs=0.1)
+    # The segment times are times in the whole audio, not in the window.
+    assert segments[-1].end == pytest.approx(25.0, abs=0.1)
+    assert [segment.start for segment in segments] == sorted(segment.start for segment in segments)
+    # The segments are handed on as each window is done.
+    assert segments_by_window == list(range(1, len(transcriber._model.windows) + 1))
+    # Each window after the first is prompted with the text before it.
+    assert transcriber._model.prompts[0] is None and transcriber._model.prompts[1] == "window 1"
+    assert cache.get("talk") is not None and len(cache.get("talk")) == pytest.approx(25 * PCM_SAMPLE_RATE, abs=200)
+
+
+@pytest.mark.asyncio
+async def test_cancelling_during_a_read_leaves_nothing_behind(tmp_path, monkeypatch):
+    def slow_chunks():
+        for _ in range(20):
+            time.sleep(0.05)
+            yield np.ones(PCM_SAMPLE_RATE, dtype=np.float32)
+    monkeypatch.setattr("app.service.pcm_cache_code.open_pcm_stream", lambda audio, duration=None: PCMStream(slow_chunks(), 20.0))
+    monkeypatch.setattr("app.service.transcription_code.send_sse_message", lambda queue, event, data: asyncio.sleep(0))
+    cache = PCMCache(directory=str(tmp_path / "pcm"))
+    transcriber = TranscribeAudio(window_seconds=10)
+    transcriber._model = FakeModel()
+    task = asyncio.create_task(transcriber.transcribe_segments(FakeQueue(), cache.stream("talk", "talk.webm")))
+    # The first window takes half a second to read.
+    await asyncio.sleep(0.2)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert transcriber._model.windows == []
+    assert os.listdir(cache.directory) == []
@@ -0,0 +1,120 @@
+import asyncio
+import json
+import time
+import zlib
+from contextlib import asynccontextmanager
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.routes import ws_endpoint
+from app.service.message_queue_manager import initialize_message_queue_manager
+from app.service.utils import format_sse
+
+
+@pytest.fixture
+def client():
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        app.state.task = None
+        app.state.message_queue_manager = await initialize_message_queue_manager()
+        queue = app.state.message_queue_manager
+        await queue.add_message(format_sse("status", "Received audio processing request."))
+        await queue.add_message(format_sse("data", {"num_chapters": 1}))
+        await queue.add_message(format_sse("data", {"chapter": {"number": 1, "text": "hello " * 100}}))
+        yield
+
+    app = FastAPI(lifespan=lifespan)
+    app.include_router(ws_endpoint.router, prefix="/api/v1")
+    with TestClient(app) as client:
+        yield client
+
+
+def test_ws_sends_events_and_handles_commands(client):
+    with client.websocket_connect("/api/v1/ws") as websocket:
+        status = json.loads(websocket.receive_text())
+        assert status == {"event": "status", "id": 1, "data": "Received audio processing request."}
+        num_chapters = json.loads(websocket.receive_text())
+        assert json.loads(num_chapters["data"]) == {"num_chapters": 1}
+        # Chapters come in as compressed binary frames.
+        chapter = json.loads(zlib.decompress(websocket.receive_bytes()))
+        assert chapter["id"] == 3
+        assert json.loads(chapter["data"])["chapter"]["number"] == 1
+
+        websocket.send_json({"command": "ack", "id": 2})
+        websocket.send_json({"command": "resend", "since_id": 0})
+        resent = json.loads(zlib.decompress(websocket.receive_bytes()))
+        assert resent == chapter
+
+        websocket.send_json({"command": "cancel"})
+        cancelled = json.loads(websocket.receive_text())
+        assert cancelled["data"] == "Task cancelled successfully."
+
+
+def test_ws_unknown_command(client):
+    with client.websocket_connect("/api/v1/ws") as websocket:
+        for _ in range(3):
+            websocket.receive()
+        websocket.send_json({"command": "rewind"})
+        reply = json.loads(websocket.receive_text())
+        assert reply["data"] == "Unknown command: rewind"
+
+
+def test_ws_without_a_queue_gets_an_error(client):
+    client.app.state.message_queue_manager.queue = None
+    with client.websocket_connect("/api/v1/ws") as websocket:
+        assert json.loads(websocket.receive_text())["event"] == "server-error"
+
+
+def test_ws_bad_message_id(client):
+    with client.websocket_connect("/api/v1/ws") as websocket:
+        for _ in range(3):
+            websocket.receive()
+        websocket.send_json({"command": "ack", "id": "three"})
+        assert "must be a message id" in json.loads(websocket.receive_text())["data"]
+        websocket.send_json({"command": "resend", "since_id": None})
+        assert "must be a message id" in json.loads(websocket.receive_text())["data"]
+        # The session goes on.
+        websocket.send_json({"command": "resend", "since_id": "2"})
+        assert json.loads(zlib.decompress(websocket.receive_bytes()))["id"] == 3
+
+
+def test_ws_binary_frame_gets_an_error_and_the_session_goes_on(client):
+    with client.websocket_connect("/api/v1/ws") as websocket:
+        for _ in range(3):
+            websocket.receive()
+        websocket.send_bytes(b'{"command": "ack", "id": 3}')
+        assert json.loads(websocket.receive_text())["event"] == "server-error"
+        websocket.send_json({"command": "rewind"})
+        assert json.loads(websocket.receive_text())["data"] == "Unknown command: rewind"
+
+
+def test_ws_disconnect_of_the_last_subscriber_cancels_the_job(client):
+    async def start_job():
+        client.app.state.task = asyncio.create_task(asyncio.sleep(3600))
+    client.portal.call(start_job)
+    with client.websocket_connect("/api/v1/ws") as websocket:
+        for _ in range(3):
+            websocket.receive()
+    deadline = time.time() + 5
+    while not client.app.state.task.done() and time.time() < deadline:
+        time.sleep(0.01)
+    assert client.app.state.task.cancelled()
+
+
+def test_ws_disconnect_leaves_the_job_to_other_subscribers(client):
+    async def start_job():
+        client.app.state.task = asyncio.create_task(asyncio.sleep(3600))
+    client.portal.call(start_job)
+    # E.g. an SSE connection watching the same job.
+    other_subscription = client.portal.call(client.app.state.message_queue_manager.subscribe)
+    with client.websocket_connect("/api/v1/ws") as websocket:
+        for _ in range(3):
+            websocket.receive()
+    deadline = time.time() + 5
+    while client.app.state.message_queue_manager.metrics()["subscribers"] > 1 and time.time() < deadline:
+        time.sleep(0.01)
+    assert client.app.state.message_queue_manager.metrics()["subscribers"] == 1
+    assert not client.app.state.task.done()
+    client.portal.call(other_subscription.close)
@@ -0,0 +1,18 @@
+from app.service.audio_processing_model import AudioProcessRequest
+from app.service.metadata_shared_code import build_metadata_instance
+from app.service.youtube_handler_code import YTDLP_CONCURRENT_FRAGMENTS, YTDLP_HTTP_CHUNK_SIZE, YouTubeHandler, download_speed
+
+
+def test_fragments_are_fetched_concurrently_in_chunks(tmp_path):
+    handler = YouTubeHandler(AudioProcessRequest(youtube_url="https://www.youtube.com/watch?v=dQw4w9WgXcQ"))
+    ydl_opts = handler.get_ydl_opts(str(tmp_path), progress=None)
+    assert ydl_opts["concurrent_fragment_downloads"] == YTDLP_CONCURRENT_FRAGMENTS > 1
+    assert ydl_opts["http_chunk_size"] == YTDLP_HTTP_CHUNK_SIZE
+    assert ydl_opts["fragment_retries"] == ydl_opts["retries"]
+
+
+def test_download_speed_is_in_the_metadata():
+    assert download_speed(21_000_000, 5.0) == "4.2 MB/s"
+    assert download_speed(1, 0.0) == "unknown"
+    metadata = build_metadata_instance({"title": "talk", "duration": 60, "download_speed": download_speed(8_000_000, 2.0)})
+    assert metadata.download_speed == "4.0 MB/s"
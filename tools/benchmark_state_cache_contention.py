@@ -0,0 +1,76 @@
+'''Measures how concurrent writers from several processes contend on the state cache.
+
+Each of NUM_PROCESSES processes writes the records of an hour of segments (what the state cache stores when a job
+completes) NUM_WRITES times. The processes write at the same time. The same writes are made to a single diskcache Cache (how the state
+cache used to be stored) and to a FanoutCache with STATE_CACHE_SHARDS shards. Run from the project root:
+
+    PYTHONPATH=. python tools/benchmark_state_cache_contention.py 8 200
+'''
+import multiprocessing
+import sys
+import tempfile
+import time
+
+from diskcache import Cache, FanoutCache
+
+from app.service.metadata_shared_code import Metadata
+from app.service.transcription_state_code import STATE_CACHE_SHARDS, STATE_CACHE_TIMEOUT, TranscriptSegment, TranscriptSegments, encode_records
+
+NUM_PROCESSES = 8
+NUM_WRITES = 200
+
+
+def make_records() -> dict:
+    segments = [TranscriptSegment(float(start), float(start + 3), f" And then number {start} said something.") for start in range(0, 3600, 3)]
+    return encode_records(TranscriptSegments(key="segments", basename="basename", metadata=Metadata(title="title"),
+                                            duration=3600.0, segments=segments))
+
+
+def open_cache(directory: str, sharded: bool):
+    if sharded:
+        return FanoutCache(directory, shards=STATE_CACHE_SHARDS, timeout=STATE_CACHE_TIMEOUT)
+    return Cache(directory, timeout=STATE_CACHE_TIMEOUT)
+
+
+def write(directory: str, sharded: bool, worker: int, num_writes: int, start_event, latencies):
+    cache = open_cache(directory, sharded)
+    records = make_records()
+    start_event.wait()
+    worst = 0.0
+    for index in range(num_writes):
+        start = time.perf_counter()
+        for key, data in records.items():
+            cache[f"worker{worker}_{index}_{key}"] = data
+        worst = max(worst, time.perf_counter() - start)
+    cache.close()
+    latencies.put(worst)
+
+
+def run(sharded: bool, num_processes: int, num_writes: int) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        # Create the databases before the writers start, so their setup isn't part of the timing.
+        open_cache(directory, sharded).close()
+        start_event = multiprocessing.Event()
+        latencies = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=write, args=(directory, sharded, worker, num_writes, start_event, latencies))
+                     for worker in range(num_processes)]
+        for process in processes:
+            process.start()
+        time.sleep(0.5)
+        start = time.perf_counter()
+        start_event.set()
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - start
+        worst = max(latencies.get() for _ in processes)
+    return {"jobs_per_second": num_processes * num_writes / elapsed, "worst_job_ms": worst * 1000}
+
+
+if __name__ == "__main__":
+    num_processes = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_PROCESSES
+    num_writes = int(sys.argv[2]) if len(sys.argv) > 2 else NUM_WRITES
+    for sharded in (False, True):
+        results = run(sharded, num_processes, num_writes)
+        name = f"FanoutCache ({STATE_CACHE_SHARDS} shards)" if sharded else "Cache"
+        print(f"{name}: {results['jobs_per_second']:.0f} jobs/s, worst job write {results['worst_job_ms']:.1f} ms "
+              f"({num_processes} processes x {num_writes} writes)")
@@ -0,0 +1,167 @@
+'''Measures yt-dlp download throughput with the settings in get_ydl_opts(), against a local stand-in for YouTube.
+
+The stand-in serves a fixture of FIXTURE_MB random bytes two ways, the way YouTube serves audio:
+
+- as DASH: a manifest and NUM_FRAGMENTS fragments. Each request waits LATENCY seconds first (a round trip to a far
+  server), so fragments fetched one at a time spend most of the time waiting.
+- as one file. A request for the whole file is sent at THROTTLED_RATE. A request for a range is sent at FULL_RATE.
+  YouTube slows down clients that ask for the whole file at once.
+
+Each download is made with yt-dlp's defaults and with the service's settings (YTDLP_CONCURRENT_FRAGMENTS,
+YTDLP_HTTP_CHUNK_SIZE). The table lists the throughput, the number of requests and the number of connections they used.
+Run from the project root:
+
+    PYTHONPATH=. python tools/benchmark_youtube_download.py
+'''
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yt_dlp
+
+from app.service.audio_processing_model import AudioProcessRequest
+from app.service.youtube_handler_code import YTDLP_CONCURRENT_FRAGMENTS, YTDLP_HTTP_CHUNK_SIZE, YouTubeHandler, download_speed
+
+FIXTURE_MB = 16
+NUM_FRAGMENTS = 64
+LATENCY = 0.1
+FULL_RATE = 50_000_000
+THROTTLED_RATE = 2_000_000
+BLOCK_SIZE = 64 * 1024
+
+FIXTURE = os.urandom(FIXTURE_MB * 1024 * 1024)
+FRAGMENT_SIZE = len(FIXTURE) // NUM_FRAGMENTS
+
+
+def manifest() -> bytes:
+    segments = "\n".join(f'<SegmentURL media="fragment/{index}"/>' for index in range(NUM_FRAGMENTS))
+    return f'''<?xml version="1.0" encoding="UTF-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT{NUM_FRAGMENTS * 10}S"
+     minBufferTime="PT2S" profiles="urn:mpeg:dash:profile:isoff-on-demand:2011">
+  <Period>
+    <AdaptationSet mimeType="audio/mp4" contentType="audio">
+      <Representation id="audio" codecs="mp4a.40.2" bandwidth="128000" audioSamplingRate="44100">
+        <SegmentList duration="10" timescale="1">
+{segments}
+        </SegmentList>
+      </Representation>
+    </AdaptationSet>
+  </Period>
+</MPD>'''.encode()
+
+
+class StandIn(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    requests = 0
+    connections = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with StandIn.lock:
+            StandIn.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        with StandIn.lock:
+            StandIn.requests += 1
+        rate = FULL_RATE
+        if self.path == "/manifest.mpd":
+            body, content_type = manifest(), "application/dash+xml"
+        elif self.path.startswith("/fragment/"):
+            index = int(self.path.rsplit("/", 1)[1])
+            body, content_type = FIXTURE[index * FRAGMENT_SIZE:(index + 1) * FRAGMENT_SIZE], "audio/mp4"
+            time.sleep(LATENCY)
+        elif self.path == "/audio.m4a":
+            body, content_type = FIXTURE, "audio/mp4"
+            rate = self.send_range_or_throttle()
+            if rate is None:
+                return
+        else:
+            self.send_error(404)
+            return
+        if self.path != "/audio.m4a":
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+        self.send_header("Content-Type", content_type)
+        self.end_headers()
+        if head:
+            return
+        if self.path == "/audio.m4a" and self.range is not None:
+            body = body[self.range[0]:self.range[1] + 1]
+        self.send_paced(body, rate)
+
+    def send_range_or_throttle(self):
+        self.range = None
+        header = self.headers.get("Range")
+        if not header:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(FIXTURE)))
+            self.send_header("Accept-Ranges", "bytes")
+            return THROTTLED_RATE
+        start, _, end = header.replace("bytes=", "").partition("-")
+        start, end = int(start), min(int(end) if end else len(FIXTURE) - 1, len(FIXTURE) - 1)
+        if start >= len(FIXTURE):
+            self.send_error(416)
+            return None
+        self.range = (start, end)
+        self.send_response(206)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Content-Range", f"bytes {start}-{end}/{len(FIXTURE)}")
+        self.send_header("Accept-Ranges", "bytes")
+        return FULL_RATE
+
+    def send_paced(self, body: bytes, rate: int):
+        start = time.perf_counter()
+        try:
+            for offset in range(0, len(body), BLOCK_SIZE):
+                self.wfile.write(body[offset:offset + BLOCK_SIZE])
+                ahead = (offset + BLOCK_SIZE) / rate - (time.perf_counter() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            # yt-dlp's generic extractor reads the start of a URL to see what it is, then hangs up.
+            self.close_connection = True
+
+
+def download(url: str, ydl_opts: dict) -> dict:
+    StandIn.requests = StandIn.connections = 0
+    with tempfile.TemporaryDirectory() as directory:
+        ydl_opts = {**ydl_opts, "outtmpl": os.path.join(directory, "%(id)s.%(ext)s"), "progress_hooks": [],
+                    "logger": None, "verbose": False, "quiet": True, "no_warnings": True, "noprogress": True, "fixup": "never"}
+        start = time.perf_counter()
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info_dict = ydl.extract_info(url, download=True)
+        seconds = time.perf_counter() - start
+        size = os.path.getsize(info_dict["requested_downloads"][0]["filepath"])
+    return {"seconds": seconds, "speed": download_speed(size, seconds), "requests": StandIn.requests, "connections": StandIn.connections}
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    handler = YouTubeHandler(AudioProcessRequest(youtube_url="https://www.youtube.com/watch?v=dQw4w9WgXcQ"))
+    tuned = handler.get_ydl_opts(tempfile.gettempdir(), progress=None)
+    defaults = {key: value for key, value in tuned.items() if key not in ("concurrent_fragment_downloads", "http_chunk_size")}
+    print(f"{FIXTURE_MB} MB fixture. DASH: {NUM_FRAGMENTS} fragments, {LATENCY * 1000:.0f} ms per request. "
+          f"One file: {THROTTLED_RATE / 1e6:.0f} MB/s unranged, {FULL_RATE / 1e6:.0f} MB/s ranged.")
+    print(f"{'download':<10}{'settings':<34}{'seconds':>9}{'throughput':>13}{'requests':>10}{'connections':>13}")
+    for name, url in (("DASH", base + "/manifest.mpd"), ("one file", base + "/audio.m4a")):
+        for label, ydl_opts in (("yt-dlp defaults", defaults),
+                                (f"{YTDLP_CONCURRENT_FRAGMENTS} fragments, {YTDLP_HTTP_CHUNK_SIZE // 1024 // 1024} MB chunks", tuned)):
+            result = download(url, ydl_opts)
+            print(f"{name:<10}{label:<34}{result['seconds']:>9.2f}{result['speed']:>13}{result['requests']:>10}{result['connections']:>13}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+'''Measures what an idle SSE connection costs the server.
+
+Opens NUM_CONNECTIONS connections the way /api/v1/sse serves them: the EventSourceResponse that sse_endpoint()
+returns, run as an ASGI app with a client that never sends anything, around an event generator that subscribes to the
+message queue and waits for a message. Reports the memory per connection and the number of timers the event loop has
+scheduled for them. The event generators schedule none. EventSourceResponse's heartbeat sleeps on one timer per
+connection, which wakes it every HEARTBEAT_INTERVAL seconds to send a ping. Run from the project root:
+
+    python tools/measure_idle_sse_connections.py 5000
+'''
+import asyncio
+import gc
+import sys
+import tracemalloc
+from types import SimpleNamespace
+
+from app.routes.sse_endpoint import sse_endpoint
+from app.service.message_queue_manager import initialize_message_queue_manager
+from app.service.utils import format_sse
+
+NUM_CONNECTIONS = 5000
+
+
+async def serve(request, disconnected: asyncio.Event):
+    response = await sse_endpoint(request)
+
+    async def receive():
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        pass
+
+    await response({"type": "http"}, receive, send)
+
+
+async def measure(num_connections: int) -> dict:
+    queue = await initialize_message_queue_manager()
+    request = SimpleNamespace(app=SimpleNamespace(state=SimpleNamespace(message_queue_manager=queue, task=None)))
+    disconnected = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    tasks = [asyncio.create_task(serve(request, disconnected)) for _ in range(num_connections)]
+    # Let every connection subscribe, park on the queue and start its heartbeat.
+    await asyncio.sleep(0.5)
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    results = {
+        "connections": num_connections,
+        "subscribers": queue.metrics()['subscribers'],
+        "bytes_per_connection": (after - before) / num_connections,
+        "scheduled_timers": len(loop._scheduled),
+    }
+    # The job finishing ends every event generator, and the clients going away ends the responses.
+    await queue.add_message(format_sse("data", "done"))
+    disconnected.set()
+    await asyncio.gather(*tasks)
+    return results
+
+
+if __name__ == "__main__":
+    num_connections = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_CONNECTIONS
+    results = asyncio.run(measure(num_connections))
+    print(f"{results['connections']} idle connections ({results['subscribers']} subscribers)")
+    print(f"{results['bytes_per_connection'] / 1024:.1f} KiB per connection")
+    print(f"{results['scheduled_timers']} timers scheduled (the heartbeats)")